@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+KingsChat Benchmarks
+Repeatable performance numbers for the OAuth callback and message-send paths
+and for CLI start-up.
+
+Everything runs locally: the callback server on an ephemeral port and the
+KingsChat API replaced by mock_server.py. Results are written as JSON and
+can be compared with an earlier run; any metric that got worse by more
+than the threshold fails the run. Start-up is timed through the real
+``python -m kingschat <command> --help`` paths and also fails the run when
+a command adds more than --startup-budget milliseconds to a bare
+interpreter start, with or without a baseline.
+
+Usage:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.10
+    python benchmark.py --only send --send-concurrency 1,10,50
+    python benchmark.py --only startup --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk_send import bulk_send, summarize_results
+from callback_server import CallbackServer, benchmark_broker
+from kingschat.cli import COMMANDS
+from kingschat_client import AsyncKingsChatClient
+from mock_server import MockKingsChatServer, parse_latency
+from percentiles import percentile
+from test_oauth_flow import CallbackHandler, build_oauth_url
+
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_STARTUP_BUDGET_MS = 150  # What a command's --help may add to a bare interpreter start
+
+# Metric name suffixes where a larger value is an improvement
+HIGHER_IS_BETTER = ('_per_s', 'completed', 'sent')
+
+# `python -m kingschat ...` argument lists, timed as typed by a user
+STARTUP_COMMANDS = {
+    'help': ['--help'],
+    **{name.replace('-', '_'): [name, '--help'] for name in COMMANDS}
+}
+
+
+def bench_callback(flows=1000, concurrency=50):
+    """Callback-server redirects/sec and redirect-to-token latency"""
+    report = benchmark_broker(flows, concurrency, port=0)
+    return {
+        'flows_per_s': report['flows_per_s'],
+        'p50_ms': report['latency_ms']['p50'],
+        'p95_ms': report['latency_ms']['p95'],
+        'p99_ms': report['latency_ms']['p99'],
+        'completed': report['completed'] / flows
+    }
+
+
+def _simulated_login(server, mock):
+    """One headless login: build_oauth_url() -> mock redirect -> callback page -> tokens"""
+    started = time.perf_counter()
+    session = server.open_session()
+    oauth_url = build_oauth_url(session.state, auth_url=mock.url,
+                                redirect_uri=f"{server.url}/callback")
+
+    def get(url):
+        parsed_url = urllib.parse.urlparse(url)
+        conn = http.client.HTTPConnection(parsed_url.netloc, timeout=10)
+        try:
+            conn.request('GET', parsed_url.path + ('?' + parsed_url.query if parsed_url.query else ''))
+            response = conn.getresponse()
+            response.read()
+            return response
+        finally:
+            conn.close()
+
+    location = get(oauth_url).getheader('Location')
+    redirect, _, fragment = location.partition('#')
+    get(redirect)
+    # What the callback page's JavaScript does with fragment tokens
+    tokens = urllib.parse.parse_qs(fragment)
+    get(f"{server.url}/token_callback?" + urllib.parse.urlencode({
+        'state': tokens['state'][0],
+        'access_token': tokens['access_token'][0],
+        'refresh_token': tokens['refresh_token'][0]
+    }))
+    ok = session.wait(10) and bool(session.result.get('access_token'))
+    server.broker.close(session.state)
+    return ok, (time.perf_counter() - started) * 1000
+
+
+def bench_login(logins=200, concurrency=20, latency='none'):
+    """End-to-end simulated login time from build_oauth_url() to tokens in hand"""
+    with MockKingsChatServer(latency=parse_latency([latency])) as mock, \
+            CallbackServer(CallbackHandler, port=0) as server, \
+            contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: _simulated_login(server, mock), range(logins)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'logins_per_s': logins / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'completed': sum(1 for ok, _ in results if ok) / logins
+    }
+
+
+def bench_send(messages=2000, concurrency=10, latency='lognormal:20:0.3'):
+    """Send throughput and tail latency against the mock API"""
+    async def run(mock):
+        tokens = mock.state.issue_tokens()
+        client = AsyncKingsChatClient(tokens['access_token'], mock.api_url, pool_size=concurrency)
+        recipients = (mock.state.users[i % len(mock.state.users)]['user_id']
+                      for i in range(messages))
+        started = time.perf_counter()
+        try:
+            results = [r async for r in bulk_send(client, recipients, 'Benchmark message',
+                                                  concurrency)]
+        finally:
+            await client.close()
+        return summarize_results(results, time.perf_counter() - started)
+
+    with MockKingsChatServer(latency=parse_latency([f"new_message={latency}"])) as mock:
+        summary = asyncio.run(run(mock))
+
+    return {
+        'messages_per_s': summary['messages_per_s'],
+        'p50_ms': summary['latency_ms']['p50'],
+        'p95_ms': summary['latency_ms']['p95'],
+        'p99_ms': summary['latency_ms']['p99'],
+        'sent': summary['sent'] / summary['total']
+    }
+
+
+def bench_startup(runs=10):
+    """Median wall time of fresh interpreters running the CLI's cold paths.
+
+    ``python_ms`` is a bare interpreter for reference; the rest are
+    ``python -m kingschat <command> --help`` for every subcommand.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def median_ms(args):
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *args], cwd=here, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append((time.perf_counter() - started) * 1000)
+        return statistics.median(times)
+
+    results = {'python_ms': median_ms(['-c', 'pass'])}
+    for name, args in STARTUP_COMMANDS.items():
+        results[f"{name}_ms"] = median_ms(['-m', 'kingschat', *args])
+    return results
+
+
+def over_budget(startup, budget_ms=DEFAULT_STARTUP_BUDGET_MS):
+    """(name, overhead_ms) for every command slower than a bare interpreter by more than the budget"""
+    return [(name, ms - startup['python_ms']) for name, ms in startup.items()
+            if name != 'python_ms' and ms - startup['python_ms'] > budget_ms]
+
+
+def flatten(results, prefix=''):
+    """{'send': {'c10': {'p95_ms': 1}}} -> {'send.c10.p95_ms': 1}"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return (name, baseline, current, change) for every metric that regressed"""
+    regressions = []
+    current_flat = flatten(current['results'])
+    for name, old in flatten(baseline['results']).items():
+        new = current_flat.get(name)
+        if new is None or not old:
+            continue
+        change = (new - old) / abs(old)
+        higher_is_better = name.endswith(HIGHER_IS_BETTER)
+        if (higher_is_better and change < -threshold) or \
+                (not higher_is_better and change > threshold):
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def run_benchmarks(args):
+    results = {}
+    if 'callback' in args.only:
+        print("Benchmarking callback server...", file=sys.stderr)
+        results['callback'] = bench_callback(args.callback_flows, args.callback_concurrency)
+    if 'login' in args.only:
+        print("Benchmarking simulated login...", file=sys.stderr)
+        results['login'] = bench_login(args.logins, args.login_concurrency, args.login_latency)
+    if 'send' in args.only:
+        results['send'] = {}
+        for concurrency in args.send_concurrency:
+            print(f"Benchmarking send at concurrency {concurrency}...", file=sys.stderr)
+            results['send'][f"c{concurrency}"] = bench_send(args.messages, concurrency,
+                                                            args.send_latency)
+    if 'startup' in args.only:
+        print("Benchmarking CLI start-up...", file=sys.stderr)
+        results['startup'] = bench_startup(args.startup_runs)
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def print_results(report):
+    for name, value in flatten(report['results']).items():
+        print(f"{name:<32}{value:>12.2f}")
+
+
+def parse_args(argv=None):
+    def int_list(value):
+        return [int(v) for v in value.split(',') if v]
+
+    parser = argparse.ArgumentParser(description="Benchmark the callback and send paths")
+    parser.add_argument('--only', type=lambda v: v.split(','), default=['callback', 'login', 'send', 'startup'],
+                        help="comma-separated subset of callback,login,send,startup")
+    parser.add_argument('--output', help="write results as JSON to this path")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare with an earlier JSON result")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative regression per metric (default: 0.10)")
+    parser.add_argument('--callback-flows', type=int, default=1000)
+    parser.add_argument('--callback-concurrency', type=int, default=50)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--login-concurrency', type=int, default=20)
+    parser.add_argument('--login-latency', default='none',
+                        help="mock login latency spec, e.g. fixed:50")
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--send-concurrency', type=int_list, default=[1, 10, 50])
+    parser.add_argument('--send-latency', default='lognormal:20:0.3',
+                        help="mock new_message latency spec")
+    parser.add_argument('--startup-runs', type=int, default=10,
+                        help="interpreter starts per start-up measurement")
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET_MS,
+                        help="milliseconds a command may add to a bare interpreter start "
+                             "(default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    report = run_benchmarks(args)
+    print_results(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ Results written to {args.output}")
+
+    failed = False
+    if 'startup' in report['results']:
+        slow = over_budget(report['results']['startup'], args.startup_budget)
+        if slow:
+            print(f"\n✗ {len(slow)} command(s) over the {args.startup_budget:g}ms start-up budget:")
+            for name, overhead in slow:
+                print(f"  {name}: +{overhead:.1f}ms")
+            failed = True
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n✗ {len(regressions)} metric(s) regressed by more than {args.threshold:.0%}:")
+            for name, old, new, change in regressions:
+                print(f"  {name}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+            return 1
+        print(f"\n✓ No regressions beyond {args.threshold:.0%} against {args.compare}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+KingsChat Broadcast
+Streams a personalised message to an audience of any size in constant memory.
+
+Recipients are read lazily from a CSV or JSONL file (or the contacts API)
+and flow through bulk_send's bounded queue, so only a few dozen are held at
+a time. The message template is compiled once: its literal parts are
+JSON-escaped up front and spliced into a pre-serialized
+``{"message":{"body":{"text":{"body":...}}}}`` envelope, so each recipient
+costs one escape of the substituted values and the sender gets ready-made
+bytes (which are also reused as-is on a 401 retry). Results are aggregated
+on the fly and failures streamed to a file instead of being kept in memory.
+
+Usage:
+    python broadcast.py --source users.csv --template "Hello {name}, welcome!"
+    python broadcast.py --source contacts --template-file welcome.txt --rate 20
+    python broadcast.py --dry-run --count 1000000 --template "Hi {name}" --concurrency 200
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import string
+import sys
+import time
+
+from bulk_send import (DEFAULT_LOG_SAMPLE, DryRunSender, RunningSummary, bulk_send, event_logger,
+                       log_result, shared_limiter)
+from contact_directory import normalize_contact
+from kingschat_client import API_BASE_URL, AsyncKingsChatClient
+from token_manager import CONFIG_FILE, TOKEN_URL, TokenManager
+
+DEFAULT_CONCURRENCY = 10
+PROGRESS_EVERY = 10000
+
+# message_payload() serialized around a placeholder; the text goes in between
+ENVELOPE_PREFIX, ENVELOPE_SUFFIX = (
+    json.dumps({'message': {'body': {'text': {'body': ''}}}}).encode().split(b'""')
+)
+
+
+def _json_fragment(text):
+    """``text`` JSON-escaped, without the surrounding quotes"""
+    return json.dumps(text)[1:-1]
+
+
+class MessageTemplate:
+    """A str.format-style template compiled once and rendered per recipient.
+
+    Fields are looked up in the recipient dict; missing or empty ones fall
+    back to ``defaults`` and then to ''. payload() returns the complete
+    new_message body as bytes, identical to json.dumps(message_payload(text)).
+    """
+
+    def __init__(self, template, defaults=None):
+        self.template = template
+        self.defaults = defaults or {}
+        self._parts = []  # Literal JSON fragments and (field, conversion, spec) tuples
+        self._text_parts = []  # The same with plain literals, for render()
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if literal:
+                self._parts.append(_json_fragment(literal))
+                self._text_parts.append(literal)
+            if field is not None:
+                if not field:
+                    raise ValueError("Template fields must be named, e.g. {name}")
+                self._parts.append((field, conversion, format_spec))
+                self._text_parts.append((field, conversion, format_spec))
+        self.fields = [part[0] for part in self._parts if isinstance(part, tuple)]
+        # A template without fields is the same payload for everyone
+        self._constant = None if self.fields else \
+            ENVELOPE_PREFIX + b'"' + ''.join(self._parts).encode() + b'"' + ENVELOPE_SUFFIX
+
+    def _value(self, recipient, field, conversion, format_spec):
+        value = recipient.get(field)
+        if value is None or value == '':
+            value = self.defaults.get(field, '')
+        if conversion == 'r':
+            value = repr(value)
+        elif conversion in ('s', 'a'):
+            value = str(value) if conversion == 's' else ascii(value)
+        return format(value, format_spec) if format_spec else str(value)
+
+    def render(self, recipient):
+        """The message text for ``recipient``"""
+        return ''.join(part if isinstance(part, str) else self._value(recipient, *part)
+                       for part in self._text_parts)
+
+    def payload(self, recipient):
+        """The new_message request body for ``recipient``, as bytes"""
+        if self._constant is not None:
+            return self._constant
+        chunks = [part if isinstance(part, str) else _json_fragment(self._value(recipient, *part))
+                  for part in self._parts]
+        return ENVELOPE_PREFIX + b'"' + ''.join(chunks).encode() + b'"' + ENVELOPE_SUFFIX
+
+
+def _with_user_id(record):
+    record['user_id'] = normalize_contact(record)['user_id']
+    return record
+
+
+def read_csv(path):
+    """Yield recipient dicts from a CSV file with a header row ('-' for stdin)"""
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        for row in csv.DictReader(f):
+            record = _with_user_id({k.strip(): (v or '').strip() for k, v in row.items() if k})
+            if record['user_id']:
+                yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_jsonl(path):
+    """Yield recipient dicts from a JSON Lines file ('-' for stdin)"""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {'user_id': record}
+            record = _with_user_id(record)
+            if record['user_id']:
+                yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+async def read_contacts(client):
+    """Recipient dicts from /api/contacts (one response, so not lazy)"""
+    response = await client.contacts()
+    contacts = response.get('contacts', []) if isinstance(response, dict) else response
+    return (record for record in (_with_user_id(dict(c)) for c in contacts) if record['user_id'])
+
+
+def open_source(path):
+    if path.endswith(('.jsonl', '.ndjson')):
+        return read_jsonl(path)
+    return read_csv(path)
+
+
+async def broadcast(sender, recipients, template, concurrency=DEFAULT_CONCURRENCY, rate=None,
+                    burst=None, on_result=None, limiter=None):
+    """Send ``template`` to every recipient dict; returns a RunningSummary"""
+    summary = RunningSummary()
+    pairs = ((r['user_id'], template.payload(r)) for r in recipients)
+    async for result in bulk_send(sender, pairs, None, concurrency, rate, burst, limiter):
+        summary.add(result)
+        if on_result is not None:
+            on_result(result)
+    return summary
+
+
+async def run(args):
+    template_text = args.template
+    if args.template_file:
+        with open(args.template_file, encoding='utf-8') as f:
+            template_text = f.read().rstrip('\n')
+    template = MessageTemplate(template_text, dict(d.split('=', 1) for d in args.default or []))
+
+    if args.dry_run:
+        sender = DryRunSender(args.dry_run_latency, args.dry_run_failure_rate)
+    else:
+        sender = AsyncKingsChatClient(base_url=args.base_url, pool_size=args.concurrency,
+                                      token_manager=TokenManager(args.config,
+                                                                 token_url=args.token_url))
+    failures_file = open(args.failures, 'w', newline='') if args.failures else None
+    failures_writer = csv.writer(failures_file) if failures_file else None
+    if failures_writer:
+        failures_writer.writerow(['user_id', 'status', 'error'])
+    log = event_logger(args)
+    limiter = shared_limiter(args)
+
+    def on_result(result):
+        log_result(log, result)
+        if not result.ok and failures_writer:
+            failures_writer.writerow([result.recipient_id, result.status or '', result.error or ''])
+        if args.verbose and not result.ok:
+            print(f"✗ {result.recipient_id} {result.status or ''} {result.error or ''}")
+        if (result.index + 1) % PROGRESS_EVERY == 0:
+            print(f"… {result.index + 1} processed", file=sys.stderr)
+
+    started = time.perf_counter()
+    try:
+        if args.source == 'contacts':
+            recipients = await read_contacts(sender)
+        elif args.source:
+            recipients = open_source(args.source)
+        else:
+            recipients = ({'user_id': f"dry-run-{i}", 'name': f"User {i}"} for i in range(args.count))
+        summary = await broadcast(sender, recipients, template, args.concurrency, args.rate,
+                                  args.burst, on_result, limiter)
+    finally:
+        await sender.close()
+        if limiter is not None:
+            limiter.close()
+        if failures_file:
+            failures_file.close()
+        if log is not None:
+            log.close()
+
+    report = summary.as_dict(time.perf_counter() - started)
+    print(f"\nSent {report['sent']}/{report['total']} in {report['elapsed_s']:.2f}s "
+          f"({report['messages_per_s'] or 0:.1f} msg/s), "
+          f"p50 {report['latency_ms']['p50'] or 0}ms, p95 {report['latency_ms']['p95'] or 0}ms")
+    if report['failures']:
+        print("Failures: " + ', '.join(f"{k}={v}" for k, v in report['failures'].items()))
+    return 0 if report['failed'] == 0 else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a personalised message to many users")
+    parser.add_argument('--source', help="recipients: a .csv or .jsonl file, '-' for CSV on "
+                                         "stdin, or 'contacts' for /api/contacts")
+    template_group = parser.add_mutually_exclusive_group(required=True)
+    template_group.add_argument('--template', help="message with {field} placeholders, e.g. {name}")
+    template_group.add_argument('--template-file')
+    parser.add_argument('--default', action='append', metavar='FIELD=VALUE',
+                        help="fallback for a missing field, e.g. name=there (repeatable)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--rate', type=float, help="maximum messages per second")
+    parser.add_argument('--burst', type=int)
+    parser.add_argument('--shared-budget', action='store_true',
+                        help="share --rate with other processes and back off on 429/5xx")
+    parser.add_argument('--failures', metavar='PATH', help="write failed recipients to this CSV")
+    parser.add_argument('--log', dest='log_path', metavar='PATH',
+                        help="append per-message events to this JSONL log")
+    parser.add_argument('--log-sample', type=float, default=DEFAULT_LOG_SAMPLE,
+                        help="fraction of successful sends written to --log")
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    parser.add_argument('--token-url', default=TOKEN_URL)
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="simulate the API in-process instead of sending")
+    parser.add_argument('--count', type=int, default=1000,
+                        help="number of synthetic recipients for --dry-run without --source")
+    parser.add_argument('--dry-run-latency', type=float, default=80)
+    parser.add_argument('--dry-run-failure-rate', type=float, default=0.0)
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every failure")
+    args = parser.parse_args(argv)
+    if not args.dry_run and not args.source:
+        parser.error("--source is required unless --dry-run is given")
+    if args.dry_run and args.source == 'contacts':
+        parser.error("--source contacts reads the account's contacts from the API; "
+                     "use --count or a file with --dry-run")
+    return args
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(run(parse_args())))
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+KingsChat Bulk Send
+Streams recipients through a bounded pool of asyncio workers.
+
+Sends are paced by a token bucket (messages/sec plus burst) rather than a
+fixed sleep after every message, and results are yielded as each send
+completes. With --dry-run no network is used: an in-process stand-in
+simulates API latency so throughput can be benchmarked offline.
+
+Usage:
+    python bulk_send.py --recipients ids.txt --message "Hello" --rate 20 --burst 40
+    python bulk_send.py --dry-run --count 5000 --concurrency 100 --message "Hello"
+    python bulk_send.py --recipients ids.txt --message "Hello" --log logs/bulk.jsonl
+    python bulk_send.py --to 5d03686cde867f0001b9df3d --message "Hello"
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+
+from kingschat_client import API_BASE_URL, AsyncKingsChatClient, KingsChatAPIError
+from metrics import SEND_QUEUE_DEPTH, SENDS_IN_FLIGHT
+from percentiles import histogram_percentile, percentile
+from token_manager import CONFIG_FILE, TOKEN_URL, TokenManager
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_LOG_SAMPLE = 0.01  # Fraction of successful sends written to --log
+
+
+class TokenBucket:
+    """Token-bucket rate limiter for asyncio.
+
+    Allows ``burst`` sends immediately and ``rate`` sends per second after
+    that. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class SendResult:
+    """Outcome of one message send"""
+
+    def __init__(self, index, recipient_id, ok, status=None, error=None, latency_ms=None,
+                 retry_after=None):
+        self.index = index
+        self.recipient_id = recipient_id
+        self.ok = ok
+        self.status = status
+        self.error = error
+        self.latency_ms = latency_ms
+        self.retry_after = retry_after
+
+    def as_dict(self):
+        return {
+            'index': self.index,
+            'recipient_id': self.recipient_id,
+            'ok': self.ok,
+            'status': self.status,
+            'error': self.error,
+            'latency_ms': self.latency_ms
+        }
+
+
+class DryRunSender:
+    """Offline stand-in for AsyncKingsChatClient.send_message.
+
+    Latency is drawn from a log-normal distribution around ``latency_ms`` and
+    ``failure_rate`` of sends fail with HTTP 500.
+    """
+
+    def __init__(self, latency_ms=80, failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    async def send_message(self, user_id, text):
+        await asyncio.sleep(self._random.lognormvariate(0, 0.35) * self.latency_ms / 1000.0)
+        if self._random.random() < self.failure_rate:
+            raise KingsChatAPIError(500, 'simulated failure', f"/users/{user_id}/new_message")
+        return {}
+
+    async def close(self):
+        pass
+
+
+async def _send_one(sender, index, recipient_id, text):
+    started = time.perf_counter()
+    try:
+        await sender.send_message(recipient_id, text)
+        return SendResult(index, recipient_id, True, status=200,
+                          latency_ms=(time.perf_counter() - started) * 1000)
+    except KingsChatAPIError as e:
+        return SendResult(index, recipient_id, False, status=e.status, error=e.body[:200],
+                          latency_ms=(time.perf_counter() - started) * 1000,
+                          retry_after=e.retry_after)
+    except Exception as e:
+        return SendResult(index, recipient_id, False, error=f"{type(e).__name__}: {e}",
+                          latency_ms=(time.perf_counter() - started) * 1000)
+
+
+async def bulk_send(sender, recipients, message, concurrency=DEFAULT_CONCURRENCY,
+                    rate=None, burst=None, limiter=None):
+    """Send ``message`` to every recipient id and yield SendResults as they complete.
+
+    ``recipients`` may be any iterable or async iterable, including a
+    generator over a huge file; at most ``2 * concurrency`` recipients are buffered at a time.
+    ``message`` is either a string or a callable taking the recipient id.
+    Recipients given as (recipient_id, message) pairs carry their own
+    message (text or a pre-encoded payload), and ``message`` is ignored.
+    ``limiter`` replaces the token bucket (e.g. a shared, adaptive
+    rate_limiter.SharedRateLimiter); if it has record(), every result is
+    reported back to it.
+    """
+    if limiter is None and rate:
+        limiter = TokenBucket(rate, burst)
+    record = getattr(limiter, 'record', None)
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+    results = asyncio.Queue()
+
+    async def produce():
+        try:
+            if hasattr(recipients, '__aiter__'):
+                index = 0
+                async for recipient_id in recipients:
+                    await pending.put((index, recipient_id))
+                    SEND_QUEUE_DEPTH.inc()
+                    index += 1
+            else:
+                for index, recipient_id in enumerate(recipients):
+                    await pending.put((index, recipient_id))
+                    SEND_QUEUE_DEPTH.inc()
+        except Exception as e:
+            results.put_nowait(e)  # A failure while reading recipients; raised below
+            return
+        for _ in range(concurrency):
+            await pending.put(None)
+
+    async def work():
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                SEND_QUEUE_DEPTH.dec()
+                index, recipient_id = item
+                if isinstance(recipient_id, tuple):
+                    recipient_id, text = recipient_id
+                else:
+                    text = message(recipient_id) if callable(message) else message
+                SENDS_IN_FLIGHT.inc()
+                try:
+                    if limiter is not None:
+                        await limiter.acquire()
+                    result = await _send_one(sender, index, recipient_id, text)
+                finally:
+                    SENDS_IN_FLIGHT.dec()
+                if record is not None:
+                    record(result)
+                await results.put(result)
+        except Exception as e:
+            results.put_nowait(e)  # Raised by the consumer below
+        finally:
+            results.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    tasks = [producer] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        finished_workers = 0
+        while finished_workers < concurrency:
+            result = await results.get()
+            if result is None:
+                finished_workers += 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not pending.empty():  # Recipients never picked up when stopped early
+            if pending.get_nowait() is not None:
+                SEND_QUEUE_DEPTH.dec()
+
+
+class RunningSummary:
+    """Counts and latency percentiles without keeping per-message results.
+
+    Latencies are bucketed to whole milliseconds, so memory is bounded by
+    the slowest response, not by the number of messages.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.failures = {}
+        self.latency_buckets = {}
+
+    def add(self, result):
+        self.total += 1
+        if result.ok:
+            self.sent += 1
+        else:
+            key = str(result.status or result.error)
+            self.failures[key] = self.failures.get(key, 0) + 1
+        bucket = int(result.latency_ms or 0)
+        self.latency_buckets[bucket] = self.latency_buckets.get(bucket, 0) + 1
+
+    def percentile(self, pct):
+        return histogram_percentile(self.latency_buckets, pct)
+
+    def as_dict(self, elapsed):
+        return {
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.total - self.sent,
+            'failures': self.failures,
+            'elapsed_s': elapsed,
+            'messages_per_s': self.total / elapsed if elapsed else None,
+            'latency_ms': {'p50': self.percentile(50), 'p95': self.percentile(95),
+                           'p99': self.percentile(99)}
+        }
+
+
+def summarize_results(results, elapsed):
+    """Like RunningSummary.as_dict() for a list of results, with unbucketed latencies"""
+    latencies = sorted(r.latency_ms for r in results)
+    failures = {}
+    for r in results:
+        if not r.ok:
+            key = str(r.status or r.error)
+            failures[key] = failures.get(key, 0) + 1
+    return {
+        'total': len(results),
+        'sent': sum(1 for r in results if r.ok),
+        'failed': sum(failures.values()),
+        'failures': failures,
+        'elapsed_s': elapsed,
+        'messages_per_s': len(results) / elapsed if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        }
+    }
+
+
+def shared_limiter(args):
+    """A SharedRateLimiter for --shared-budget, or None; the caller must close() it"""
+    if not getattr(args, 'shared_budget', False):
+        return None
+    # Imported here so a plain send does not load sqlite3
+    from rate_limiter import DEFAULT_RATE, SharedRateLimiter
+
+    return SharedRateLimiter(rate=args.rate or DEFAULT_RATE, burst=args.burst,
+                             concurrency=args.concurrency)
+
+
+def event_logger(args):
+    """A StructuredLogger for --log, or None; failures are always written, successes sampled"""
+    if not getattr(args, 'log_path', None):
+        return None
+    from structured_log import StructuredLogger
+
+    return StructuredLogger(args.log_path, sample={'Message sent': args.log_sample})
+
+
+def log_result(log, result):
+    if log is None:
+        return
+    if result.ok:
+        log.info('Message sent', user_id=result.recipient_id, latency_ms=round(result.latency_ms, 1))
+    else:
+        log.error('Message failed', user_id=result.recipient_id, status=result.status,
+                  error=result.error, latency_ms=round(result.latency_ms, 1))
+
+
+def read_recipients(path):
+    """Yield recipient ids from a file (one per line, '-' for stdin)"""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+async def run(args):
+    if args.dry_run:
+        sender = DryRunSender(args.dry_run_latency, args.dry_run_failure_rate)
+    else:
+        sender = AsyncKingsChatClient(base_url=args.base_url, pool_size=args.concurrency,
+                                      token_manager=TokenManager(args.config,
+                                                                 token_url=args.token_url))
+    if args.recipients:
+        recipients = read_recipients(args.recipients)
+    elif args.dry_run and not args.to:
+        recipients = (f"dry-run-{i}" for i in range(args.count))
+    else:
+        recipients = ()
+    recipients = itertools.chain(args.to, recipients)
+
+    summary = RunningSummary()
+    log = event_logger(args)
+    # Per-message results are streamed into the --json file, not kept in memory
+    json_file = open(args.json_path, 'w') if args.json_path else None
+    if json_file is not None:
+        json_file.write('{"results": [')
+    limiter = shared_limiter(args)
+    started = time.perf_counter()
+    try:
+        async for result in bulk_send(sender, recipients, args.message, args.concurrency,
+                                      args.rate, args.burst, limiter):
+            summary.add(result)
+            log_result(log, result)
+            if json_file is not None:
+                json_file.write((',\n' if summary.total > 1 else '\n') +
+                                json.dumps(result.as_dict()))
+            if args.verbose or not result.ok:
+                mark = '✓' if result.ok else '✗'
+                detail = '' if result.ok else f" {result.status or ''} {result.error or ''}"
+                print(f"{mark} {result.index + 1} {result.recipient_id} "
+                      f"{result.latency_ms:.0f}ms{detail}")
+    finally:
+        await sender.close()
+        if limiter is not None:
+            limiter.close()
+        if log is not None:
+            log.close()
+
+    summary = summary.as_dict(time.perf_counter() - started)
+    if json_file is not None:
+        json_file.write('\n], "summary": ' + json.dumps(summary, indent=2) + '}\n')
+        json_file.close()
+    print(f"\nSent {summary['sent']}/{summary['total']} in {summary['elapsed_s']:.2f}s "
+          f"({summary['messages_per_s'] or 0:.1f} msg/s), "
+          f"p50 {summary['latency_ms']['p50'] or 0:.0f}ms, "
+          f"p95 {summary['latency_ms']['p95'] or 0:.0f}ms")
+    return 0 if summary['failed'] == 0 else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Send one message to many KingsChat users")
+    parser.add_argument('--recipients', help="file with one user id per line ('-' for stdin)")
+    parser.add_argument('--to', action='append', default=[], metavar='USER_ID',
+                        help="send to this user id as well (repeatable)")
+    parser.add_argument('--message', required=True)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--rate', type=float, help="maximum messages per second")
+    parser.add_argument('--burst', type=int, help="messages allowed at once before --rate applies")
+    parser.add_argument('--shared-budget', action='store_true',
+                        help="share --rate with other processes and back off on 429/5xx "
+                             "(see rate_limiter.py)")
+    parser.add_argument('--base-url', default=API_BASE_URL,
+                        help="API base URL, e.g. a local stand-in server")
+    parser.add_argument('--token-url', default=TOKEN_URL, help="OAuth token endpoint for refreshes")
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="simulate the API in-process instead of sending")
+    parser.add_argument('--count', type=int, default=1000,
+                        help="number of simulated recipients for --dry-run without --recipients")
+    parser.add_argument('--dry-run-latency', type=float, default=80,
+                        help="median simulated send latency in ms")
+    parser.add_argument('--dry-run-failure-rate', type=float, default=0.0)
+    parser.add_argument('--json', dest='json_path', metavar='PATH',
+                        help="write the summary and per-message results as JSON")
+    parser.add_argument('--log', dest='log_path', metavar='PATH',
+                        help="append per-message events to this JSONL log")
+    parser.add_argument('--log-sample', type=float, default=DEFAULT_LOG_SAMPLE,
+                        help="fraction of successful sends written to --log")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every result")
+    args = parser.parse_args(argv)
+    if not args.dry_run and not args.recipients and not args.to:
+        parser.error("--recipients or --to is required unless --dry-run is given")
+    return args
+
+
+def main(argv=None):
+    return asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+OAuth Callback Server
+Long-lived, threaded HTTP server shared by the OAuth test scripts.
+
+Requests are dispatched through a routing table instead of a single do_GET.
+Every login flow gets its own session keyed by the OAuth ``state`` nonce, so
+many flows can complete concurrently against one listener; each session
+signals completion with a threading.Event so callers wake up the moment
+tokens arrive rather than polling a global flag.
+
+Every server also answers GET /metrics with the process's metrics in
+Prometheus text format (see metrics.py); a server started with
+``profiling=True`` additionally serves sampled hot stacks at
+GET /debug/profile?seconds=N.
+
+Run directly to benchmark the broker under concurrent simulated redirects:
+
+    python callback_server.py --flows 500 --concurrency 50
+"""
+
+import argparse
+import http.client
+import json
+import math
+import secrets
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from metrics import (CALLBACK_LATENCY, CALLBACK_SESSIONS_PENDING, CALLBACK_TO_TOKEN, CONTENT_TYPE,
+                     DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS, REGISTRY, SamplingProfiler)
+from percentiles import percentile
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8090
+POLL_INTERVAL = 0.05  # How quickly serve_forever() notices stop()
+DEFAULT_MAX_SESSIONS = 4096
+MAX_DRAIN_BYTES = 1 << 20  # Larger unread request bodies close the connection instead
+DEFAULT_SESSION_TTL = 600  # Seconds a login may stay pending before it is dropped
+
+
+class RoutingHandler(BaseHTTPRequestHandler):
+    """Request handler that dispatches on (method, path) via ``routes``.
+
+    Subclasses map ``('GET', '/callback')`` style keys to the name of the
+    handler method, e.g. ``routes = {('GET', '/callback'): 'handle_callback'}``.
+    Paths with parameters go in ``pattern_routes`` as (method, compiled
+    regex, name) tuples; named groups are passed as keyword arguments.
+    ``builtin_routes`` are served by every handler unless ``routes``
+    overrides them. A request body the handler did not read (a 404, or an
+    error sent before reading) is drained afterwards, so it is not parsed
+    as the next request on a keep-alive connection.
+    """
+
+    routes = {}
+    pattern_routes = []
+    builtin_routes = {
+        ('GET', '/metrics'): 'handle_metrics',
+        ('GET', '/debug/profile'): 'handle_debug_profile'
+    }
+    disable_nagle_algorithm = True  # Headers and body are written separately
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        started = time.perf_counter()
+        self.status = None
+        self._body_read = False
+        parsed_url = urllib.parse.urlparse(self.path)
+        route = parsed_url.path
+        handler_name = self.routes.get((method, route)) or self.builtin_routes.get((method, route))
+        kwargs = {}
+        if handler_name is None:
+            for route_method, pattern, name in self.pattern_routes:
+                match = pattern.fullmatch(parsed_url.path) if route_method == method else None
+                if match:
+                    handler_name, kwargs, route = name, match.groupdict(), pattern.pattern
+                    break
+            else:
+                self.send_text('Not Found', status=404)
+                route = 'unmatched'  # Arbitrary paths must not become label values
+
+        try:
+            if handler_name is not None:
+                self.parsed_url = parsed_url
+                self.query_params = urllib.parse.parse_qs(parsed_url.query)
+                getattr(self, handler_name)(**kwargs)
+            self._drain_body()
+        finally:
+            CALLBACK_LATENCY.observe(time.perf_counter() - started, type(self).__name__,
+                                     f"{method} {route}", self.status or 'error')
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def handle_metrics(self):
+        self.send_body(REGISTRY.render(), CONTENT_TYPE)
+
+    def handle_debug_profile(self):
+        """Sample all threads for ?seconds=N and return the hottest stacks, folded"""
+        callback_server = getattr(self.server, 'callback_server', None)
+        if callback_server is None or not callback_server.profiling:
+            self.send_text('Not Found', status=404)
+            return
+        try:
+            seconds = float(self.query_params.get('seconds', [DEFAULT_PROFILE_SECONDS])[0])
+        except ValueError:
+            seconds = math.nan
+        if not math.isfinite(seconds):
+            self.send_text('seconds must be a finite number', status=400)
+            return
+        seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+        profiler = SamplingProfiler().profile(seconds)
+        header = f"# {profiler.samples} samples over {seconds:g}s\n"
+        self.send_text(header + profiler.folded(include_idle='idle' in self.query_params))
+
+    @property
+    def callback_server(self):
+        """The CallbackServer that owns this request"""
+        return self.server.callback_server
+
+    def log_event(self, type_, message, **data):
+        """Queue a structured event on the server's event log, if it has one.
+
+        Writing happens on the logger's thread, never on the request thread.
+        """
+        callback_server = getattr(self.server, 'callback_server', None)
+        if callback_server is not None and callback_server.event_log is not None:
+            callback_server.event_log.log(type_, message, **data)
+
+    def notify_login(self, access_token=None, user_id=None, name=None):
+        """Hand a completed login to the server's notifier, if it has one; never blocks"""
+        callback_server = getattr(self.server, 'callback_server', None)
+        if callback_server is not None and callback_server.notifier is not None:
+            callback_server.notifier.submit(user_id, name, access_token)
+
+    def resolve_session(self, state=None):
+        """Look up the login session named by ``state`` or the ``state`` query parameter.
+
+        Without either, the only pending session is used (see
+        CallbackBroker.resolve). Sends a 400 response and returns None when
+        no session matches.
+        """
+        state = state or self.query_params.get('state', [None])[0]
+        session = self.callback_server.broker.resolve(state)
+        if session is None:
+            self.send_text('Unknown or expired state', status=400)
+        return session
+
+    def _content_length(self):
+        try:
+            return max(0, int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            return None
+
+    def read_body(self):
+        content_length = self._content_length()
+        self._body_read = True
+        return self.rfile.read(content_length) if content_length else b''
+
+    def _drain_body(self):
+        if self._body_read:
+            return
+        self._body_read = True
+        content_length = self._content_length()
+        if content_length is None or content_length > MAX_DRAIN_BYTES:
+            self.close_connection = True
+        elif content_length:
+            self.rfile.read(content_length)
+
+    def read_json(self):
+        """Decode the request body as JSON, returning None if it is not valid"""
+        try:
+            return json.loads(self.read_body().decode())
+        except ValueError:
+            return None
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_html(self, html, status=200):
+        self.send_body(html, 'text/html', status)
+
+    def send_text(self, text, status=200):
+        self.send_body(text, 'text/plain', status)
+
+    def log_message(self, format, *args):
+        pass  # Suppress server logs
+
+
+class OAuthSession:
+    """Result slot for one login flow, identified by its ``state`` nonce"""
+
+    def __init__(self, state, expires_at):
+        self.state = state
+        self.expires_at = expires_at
+        self.opened_at = time.monotonic()
+        self.result = {}
+        self.done = threading.Event()
+
+    def record(self, **values):
+        """Store intermediate values without completing the flow"""
+        self.result.update(values)
+
+    def complete(self, **values):
+        """Store the final values and wake up anyone in wait()"""
+        self.result.update(values)
+        if not self.done.is_set() and values.get('access_token'):
+            CALLBACK_TO_TOKEN.observe(time.monotonic() - self.opened_at)
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Block until complete() is called; returns False on timeout"""
+        return self.done.wait(timeout)
+
+
+class CallbackBroker:
+    """Bounded, expiring map of in-flight login sessions keyed by state.
+
+    Sessions live in insertion order, so expired entries are always at the
+    front and eviction is O(1) per session. The provider's form POST does
+    not echo ``state``; such a callback goes to the one pending session, and
+    concurrent logins carry their state in the redirect URI's path instead
+    (``/callback/<state>``, see test_oauth_flow.build_oauth_url). When ``max_sessions`` is reached
+    the oldest pending login is completed with ``error='evicted'``, so its
+    waiter wakes up instead of sitting out its timeout.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl=DEFAULT_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self):
+        """Start a new login flow and return its session"""
+        session = OAuthSession(secrets.token_urlsafe(16), time.monotonic() + self.ttl)
+        with self._lock:
+            self._expire()
+            while len(self._sessions) >= self.max_sessions:
+                _, evicted = self._sessions.popitem(last=False)
+                evicted.complete(error='evicted',
+                                 error_message="Too many logins pending; this one was dropped")
+            self._sessions[session.state] = session
+        return session
+
+    def resolve(self, state):
+        """Return the live session for ``state``, or None.
+
+        Without a state, returns the pending session if there is exactly one.
+        """
+        with self._lock:
+            self._expire()
+            if state:
+                return self._sessions.get(state)
+            if len(self._sessions) == 1:
+                return next(iter(self._sessions.values()))
+            return None
+
+    def close(self, state):
+        """Forget a session once its caller has collected the result"""
+        with self._lock:
+            self._sessions.pop(state, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.expires_at > now:
+                break
+            self._sessions.popitem(last=False)
+
+
+class _CallbackHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Bursts of redirects must not overflow the backlog
+
+
+class CallbackServer:
+    """Threaded callback server that runs until stopped.
+
+    Each login calls ``open_session()`` and puts ``session.state`` into its
+    authorization URL; handlers complete the matching session and
+    ``session.wait()`` returns as soon as that happens. ``profiling``
+    enables the /debug/profile route. Handlers pass completed logins to
+    ``notifier`` (a login_notifier.LoginNotifier) with notify_login().
+    """
+
+    def __init__(self, handler_class, host=DEFAULT_HOST, port=DEFAULT_PORT, broker=None,
+                 event_log=None, profiling=False, notifier=None):
+        self.httpd = _CallbackHTTPServer((host, port), handler_class)
+        self.httpd.callback_server = self
+        self.broker = broker or CallbackBroker()
+        self.event_log = event_log  # A structured_log.StructuredLogger, or None
+        self.profiling = profiling
+        self.notifier = notifier
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        CALLBACK_SESSIONS_PENDING.set_function(self.broker.__len__)
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, args=(POLL_INTERVAL,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def open_session(self):
+        return self.broker.open()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        CALLBACK_SESSIONS_PENDING.set_function(None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _BenchmarkHandler(RoutingHandler):
+    routes = {('GET', '/callback'): 'handle_callback'}
+
+    def handle_callback(self):
+        session = self.resolve_session()
+        if session is None:
+            return
+        session.complete(access_token=self.query_params.get('access_token', [None])[0])
+        self.send_text('OK')
+
+
+def benchmark_broker(flows=500, concurrency=50, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Complete ``flows`` logins through one listener with ``concurrency`` redirects in flight.
+
+    Each simulated browser opens a session, hits /callback with its state and
+    waits on the session event, so the measured latency is redirect-to-tokens.
+    """
+    local = threading.local()
+
+    def simulate(index):
+        session = server.open_session()
+        started = time.perf_counter()
+        if getattr(local, 'conn', None) is None:
+            local.conn = http.client.HTTPConnection(*server.httpd.server_address[:2], timeout=10)
+        query = urllib.parse.urlencode({'state': session.state, 'access_token': f"token-{index}"})
+        local.conn.request('GET', f"/callback?{query}")
+        response = local.conn.getresponse()
+        response.read()
+        ok = session.wait(10) and session.result['access_token'] == f"token-{index}"
+        server.broker.close(session.state)
+        return ok, (time.perf_counter() - started) * 1000
+
+    with CallbackServer(_BenchmarkHandler, host, port) as server:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(simulate, range(flows)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'flows': flows,
+        'concurrency': concurrency,
+        'completed': sum(1 for ok, _ in results if ok),
+        'elapsed_s': elapsed,
+        'flows_per_s': flows / elapsed if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OAuth callback broker")
+    parser.add_argument('--flows', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    report = benchmark_broker(args.flows, args.concurrency, port=args.port)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+KingsChat Contact Directory
+Local SQLite index of /api/contacts for instant recipient search.
+
+search_users.php answers each query with a dozen users?username= calls
+plus a full /api/contacts pull. Here contacts are synced into SQLite once
+(and refreshed incrementally: only rows whose content changed are written)
+and every keystroke is answered locally: exact and prefix matches come from
+a NOCASE index, substring matches from an FTS5 trigram index, and fuzzy
+matches by re-ranking trigram candidates.
+
+Usage:
+    python contact_directory.py sync
+    python contact_directory.py search mayo
+"""
+
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from kingschat_client import API_BASE_URL, KingsChatClient
+from token_manager import CONFIG_FILE, TokenManager
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+DEFAULT_DB = os.path.join(ROOT_DIR, 'contacts.db')
+DEFAULT_LIMIT = 20
+DEFAULT_MAX_AGE = 900  # Seconds before sync() pulls /api/contacts again
+FUZZY_CANDIDATES = 200
+FUZZY_CUTOFF = 0.6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    rowid INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    name TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    avatar_url TEXT,
+    data TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contacts_username ON contacts(username);
+CREATE INDEX IF NOT EXISTS contacts_name ON contacts(name);
+CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+    username, name, content='contacts', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS contacts_ai AFTER INSERT ON contacts BEGIN
+    INSERT INTO contacts_fts(rowid, username, name) VALUES (new.rowid, new.username, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS contacts_ad AFTER DELETE ON contacts BEGIN
+    INSERT INTO contacts_fts(contacts_fts, rowid, username, name)
+    VALUES ('delete', old.rowid, old.username, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS contacts_au AFTER UPDATE ON contacts BEGIN
+    INSERT INTO contacts_fts(contacts_fts, rowid, username, name)
+    VALUES ('delete', old.rowid, old.username, old.name);
+    INSERT INTO contacts_fts(rowid, username, name) VALUES (new.rowid, new.username, new.name);
+END;
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def normalize_contact(contact):
+    """Flatten a contact or user object to the fields the picker needs"""
+    user_id = contact.get('user_id') or contact.get('id') or \
+        (contact.get('user_jid') or '').split('@', 1)[0]
+    avatar = contact.get('avatar')
+    avatar_url = contact.get('avatar_url') or (avatar.get('url') if isinstance(avatar, dict) else None)
+    return {
+        'user_id': user_id,
+        'username': contact.get('username') or '',
+        'name': contact.get('name') or '',
+        'avatar_url': avatar_url
+    }
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+class ContactDirectory:
+    """SQLite-backed contact index; one instance per thread"""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM contacts').fetchone()[0]
+
+    def last_sync(self):
+        row = self.db.execute("SELECT value FROM sync_state WHERE key = 'last_sync'").fetchone()
+        return float(row[0]) if row else None
+
+    def upsert(self, contacts, now=None):
+        """Insert or update contacts, skipping rows whose content is unchanged.
+
+        Returns (ids_seen, rows_written).
+        """
+        now = now or time.time()
+        known = dict(self.db.execute('SELECT user_id, digest FROM contacts'))
+        seen = set()
+        changed = []
+        for contact in contacts:
+            data = json.dumps(contact, sort_keys=True)
+            fields = normalize_contact(contact)
+            if not fields['user_id']:
+                continue
+            seen.add(fields['user_id'])
+            digest = hashlib.sha1(data.encode()).hexdigest()
+            if known.get(fields['user_id']) != digest:
+                changed.append((fields['user_id'], fields['username'], fields['name'],
+                                fields['avatar_url'], data, digest, now))
+
+        with self.db:
+            self.db.executemany("""
+                INSERT INTO contacts (user_id, username, name, avatar_url, data, digest, synced_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username, name = excluded.name,
+                    avatar_url = excluded.avatar_url, data = excluded.data,
+                    digest = excluded.digest, synced_at = excluded.synced_at
+            """, changed)
+        return seen, len(changed)
+
+    def sync(self, client, max_age=DEFAULT_MAX_AGE, force=False):
+        """Refresh the index from /api/contacts unless it is younger than ``max_age``.
+
+        Contacts that disappeared from the account are removed. Returns a
+        summary dict, or None if the sync was skipped.
+        """
+        last_sync = self.last_sync()
+        if not force and last_sync is not None and time.time() - last_sync < max_age:
+            return None
+
+        response = client.contacts()
+        contacts = response.get('contacts', []) if isinstance(response, dict) else response
+        now = time.time()
+        seen, written = self.upsert(contacts, now)
+
+        with self.db:
+            existing = [row[0] for row in self.db.execute('SELECT user_id FROM contacts')]
+            removed = [(user_id,) for user_id in existing if user_id not in seen]
+            self.db.executemany('DELETE FROM contacts WHERE user_id = ?', removed)
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_sync', ?)", (str(now),)
+            )
+        return {'contacts': len(seen), 'written': written, 'removed': len(removed)}
+
+    def get(self, user_id):
+        row = self.db.execute(
+            'SELECT user_id, username, name, avatar_url FROM contacts WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def search(self, query, limit=DEFAULT_LIMIT, fuzzy=True):
+        """Exact, prefix, substring and (optionally) fuzzy matches, best first"""
+        query = query.strip().lstrip('@')
+        if not query:
+            return []
+
+        results = []
+        seen = set()
+
+        def add(rows, match):
+            for row in rows:
+                if row['user_id'] not in seen and len(results) < limit:
+                    seen.add(row['user_id'])
+                    results.append(dict(row, match=match))
+
+        columns = 'user_id, username, name, avatar_url'
+        add(self.db.execute(f"""
+            SELECT {columns} FROM contacts WHERE username = ? OR user_id = ? LIMIT ?
+        """, (query, query, limit)), 'exact')
+
+        prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if len(results) < limit:
+            add(self.db.execute(f"""
+                SELECT {columns} FROM contacts WHERE username LIKE ? ESCAPE '\\'
+                UNION
+                SELECT {columns} FROM contacts WHERE name LIKE ? ESCAPE '\\'
+                ORDER BY username LIMIT ?
+            """, (prefix, prefix, limit)), 'prefix')
+
+        if len(results) < limit and len(query) >= 3:
+            add(self.db.execute(f"""
+                SELECT {', '.join('c.' + c for c in columns.split(', '))}
+                FROM contacts_fts f JOIN contacts c ON c.rowid = f.rowid
+                WHERE contacts_fts MATCH ? ORDER BY rank LIMIT ?
+            """, (_fts_phrase(query), limit)), 'substring')
+
+        if fuzzy and len(results) < limit and len(query) >= 3:
+            add(self._fuzzy(query, columns), 'fuzzy')
+
+        return results
+
+    def _fuzzy(self, query, columns):
+        """Rank contacts sharing any trigram with ``query`` by similarity"""
+        lowered = query.lower()
+        trigrams = {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+        match = ' OR '.join(_fts_phrase(t) for t in trigrams)
+        candidates = self.db.execute(f"""
+            SELECT {', '.join('c.' + c for c in columns.split(', '))}
+            FROM contacts_fts f JOIN contacts c ON c.rowid = f.rowid
+            WHERE contacts_fts MATCH ? ORDER BY rank LIMIT ?
+        """, (match, FUZZY_CANDIDATES)).fetchall()
+
+        scored = []
+        for row in candidates:
+            score = max(
+                difflib.SequenceMatcher(None, lowered, row['username'].lower()).ratio(),
+                difflib.SequenceMatcher(None, lowered, row['name'].lower()).ratio()
+            )
+            if score >= FUZZY_CUTOFF:
+                scored.append((score, row))
+        scored.sort(key=lambda item: -item[0])
+        return [row for _, row in scored]
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync and search the local contact directory")
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sync_parser = subparsers.add_parser('sync', help="refresh the index from /api/contacts")
+    sync_parser.add_argument('--force', action='store_true', help="sync even if the index is fresh")
+    sync_parser.add_argument('--max-age', type=float, default=DEFAULT_MAX_AGE)
+    search_parser = subparsers.add_parser('search', help="search the local index")
+    search_parser.add_argument('query')
+    search_parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT)
+    search_parser.add_argument('--no-fuzzy', action='store_true')
+    search_parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    directory = ContactDirectory(args.db)
+    if args.command == 'sync':
+        with KingsChatClient(base_url=args.base_url,
+                             token_manager=TokenManager(args.config)) as client:
+            summary = directory.sync(client, max_age=args.max_age, force=args.force)
+        if summary is None:
+            print("✓ Contact index is fresh; use --force to sync anyway")
+        else:
+            print(f"✓ Synced {summary['contacts']} contacts "
+                  f"({summary['written']} written, {summary['removed']} removed)")
+        return 0
+
+    started = time.perf_counter()
+    results = directory.search(args.query, args.limit, fuzzy=not args.no_fuzzy)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for result in results:
+            print(f"{result['match']:<10}{result['user_id']:<26}@{result['username']:<24}{result['name']}")
+        print(f"\n{len(results)} result(s) in {elapsed_ms:.1f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+KingsChat JWT Verifier
+Checks RS256 access tokens in-process instead of calling /api/profile.
+
+KingsChat access tokens are RS256 JWTs with a ``kid`` header and
+``exp``/``aud``/``sub`` claims. The issuer's public keys are fetched from a
+JWKS endpoint once and cached with a TTL; a token signed with an unknown
+``kid`` triggers one (rate-limited) refetch, which picks up key rotation.
+Signature, expiry and audience are then checked locally, and tokens that
+already verified are remembered until they expire, so repeat checks are a
+dictionary lookup.
+
+The RSA maths is plain Python (PKCS#1 v1.5 with SHA-256), so there is no
+extra dependency. generate_keypair() and sign_rs256() exist for tests and
+the mock server.
+
+Usage:
+    python jwt_verifier.py                        # verify the token in kc_config.json
+    python jwt_verifier.py TOKEN --audience conference_calls
+    python jwt_verifier.py --self-test 1000       # local keypair, batch timing
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+from kingschat_client import ConnectionPool
+from token_manager import CONFIG_FILE, claim_timestamp, load_config
+
+# Standard discovery location on the token issuer; override with --jwks-url
+JWKS_URL = "https://connect.kingsch.at/.well-known/jwks.json"
+DEFAULT_JWKS_TTL = 3600
+MIN_REFETCH_INTERVAL = 30  # Seconds between refetches triggered by unknown kids
+DEFAULT_LEEWAY = 30  # Seconds of clock skew tolerated for exp/nbf
+DEFAULT_CACHE_SIZE = 4096
+
+# DER prefix of DigestInfo for SHA-256 (RFC 8017, section 9.2)
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+class TokenVerificationError(Exception):
+    """Raised when a token is malformed, expired, for another audience or badly signed"""
+
+
+def b64url_decode(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _int_from_b64url(data):
+    return int.from_bytes(b64url_decode(data), 'big')
+
+
+def _int_to_b64url(value):
+    return b64url_encode(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+def _emsa_pkcs1_v15(message, size):
+    """EMSA-PKCS1-v1_5 encoding of SHA-256(message) for a ``size``-byte modulus"""
+    digest_info = SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+    padding = size - len(digest_info) - 3
+    if padding < 8:
+        raise ValueError("RSA modulus too short for SHA-256")
+    return b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+
+
+class RSAPublicKey:
+    def __init__(self, n, e, kid=None):
+        self.n = n
+        self.e = e
+        self.kid = kid
+        self.size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        if jwk.get('kty') != 'RSA':
+            raise ValueError(f"Unsupported key type: {jwk.get('kty')}")
+        return cls(_int_from_b64url(jwk['n']), _int_from_b64url(jwk['e']), jwk.get('kid'))
+
+    def to_jwk(self):
+        return {'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': self.kid,
+                'n': _int_to_b64url(self.n), 'e': _int_to_b64url(self.e)}
+
+    def verify(self, message, signature):
+        if len(signature) != self.size:
+            return False
+        s = int.from_bytes(signature, 'big')
+        if s >= self.n:
+            return False
+        encoded = pow(s, self.e, self.n).to_bytes(self.size, 'big')
+        return hmac.compare_digest(encoded, _emsa_pkcs1_v15(message, self.size))
+
+
+class RSAPrivateKey:
+    def __init__(self, p, q, e=65537, kid=None):
+        self.p, self.q, self.e = p, q, e
+        self.n = p * q
+        self.d = pow(e, -1, (p - 1) * (q - 1))
+        self.dp, self.dq, self.qinv = self.d % (p - 1), self.d % (q - 1), pow(q, -1, p)
+        self.kid = kid
+        self.size = (self.n.bit_length() + 7) // 8
+
+    def public_key(self):
+        return RSAPublicKey(self.n, self.e, self.kid)
+
+    def sign(self, message):
+        m = int.from_bytes(_emsa_pkcs1_v15(message, self.size), 'big')
+        # CRT: two half-size exponentiations instead of one full-size
+        m1, m2 = pow(m, self.dp, self.p), pow(m, self.dq, self.q)
+        s = m2 + self.q * ((self.qinv * (m1 - m2)) % self.p)
+        return s.to_bytes(self.size, 'big')
+
+
+def _is_probable_prime(n, rounds=40):
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d, r = d // 2, r + 1
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime(bits, e):
+    while True:
+        candidate = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        if candidate % e != 1 and _is_probable_prime(candidate):
+            return candidate
+
+
+def generate_keypair(bits=2048, kid=None, e=65537):
+    """New RSA keypair for tests; returns an RSAPrivateKey (see .public_key())"""
+    while True:
+        p, q = _random_prime(bits // 2, e), _random_prime(bits // 2, e)
+        if p != q and (p * q).bit_length() == bits:
+            return RSAPrivateKey(p, q, e, kid or secrets.token_hex(8))
+
+
+def sign_rs256(claims, private_key):
+    header = {'alg': 'RS256', 'kid': private_key.kid, 'typ': 'JWT'}
+    signing_input = (b64url_encode(json.dumps(header, separators=(',', ':')).encode()) + '.' +
+                     b64url_encode(json.dumps(claims, separators=(',', ':')).encode()))
+    return signing_input + '.' + b64url_encode(private_key.sign(signing_input.encode()))
+
+
+class JWKSCache:
+    """Public keys by kid, refetched after ``ttl`` or when an unknown kid shows up.
+
+    ``fetch`` returns a JWKS dict; by default it is fetched from ``url``.
+    On a failed refetch the previous keys stay in use; with no keys to fall
+    back on, get() raises TokenVerificationError.
+    """
+
+    def __init__(self, url=JWKS_URL, ttl=DEFAULT_JWKS_TTL, fetch=None,
+                 min_refetch_interval=MIN_REFETCH_INTERVAL, timeout=10):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.fetch_count = 0
+        self._fetch = fetch or self._fetch_url
+        self._pool = None
+        if fetch is None:
+            parsed_url = urllib.parse.urlparse(url)
+            self._path = parsed_url.path or '/'
+            self._pool = ConnectionPool(f"{parsed_url.scheme}://{parsed_url.netloc}",
+                                        maxsize=1, timeout=timeout, connect_timeout=timeout)
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_jwks(cls, jwks):
+        """Fixed key set, e.g. loaded from a file or built in a test"""
+        return cls(fetch=lambda: jwks, ttl=float('inf'))
+
+    def _fetch_url(self):
+        response = self._pool.request('GET', self._path, headers={'Accept': 'application/json'})
+        if not response.ok:
+            raise TokenVerificationError(f"JWKS fetch failed: HTTP {response.status}")
+        return response.json()
+
+    def _refresh(self):
+        self.fetch_count += 1
+        self._fetched_at = time.monotonic()
+        jwks = self._fetch()
+        keys = {}
+        for jwk in jwks.get('keys', []):
+            if jwk.get('kty') == 'RSA' and jwk.get('use', 'sig') == 'sig':
+                key = RSAPublicKey.from_jwk(jwk)
+                keys[key.kid] = key
+        self._keys = keys
+
+    def get(self, kid):
+        now = time.monotonic()
+        key = self._keys.get(kid)
+        fresh = self._fetched_at is not None and now - self._fetched_at < self.ttl
+        if key is not None and fresh:
+            return key
+        with self._lock:
+            key = self._keys.get(kid)
+            fresh = self._fetched_at is not None and now - self._fetched_at < self.ttl
+            recently = self._fetched_at is not None and \
+                now - self._fetched_at < self.min_refetch_interval
+            if not fresh or (key is None and not recently):
+                try:
+                    self._refresh()
+                except Exception as e:
+                    if not self._keys:
+                        raise TokenVerificationError(f"Could not load signing keys: {e}") from e
+                key = self._keys.get(kid)
+        if key is None:
+            raise TokenVerificationError(f"Unknown signing key: {kid}")
+        return key
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+
+class JWTVerifier:
+    """Verify RS256 tokens against a JWKSCache.
+
+    ``audience`` (a string or several) must intersect the token's ``aud``
+    when given; likewise ``issuer`` must equal ``iss``. Verified tokens are
+    kept in an LRU of ``cache_size`` entries until they expire.
+    """
+
+    def __init__(self, jwks, audience=None, issuer=None, leeway=DEFAULT_LEEWAY,
+                 cache_size=DEFAULT_CACHE_SIZE, require_exp=True):
+        self.jwks = jwks
+        self.audience = {audience} if isinstance(audience, str) else set(audience or ())
+        self.issuer = issuer
+        self.leeway = leeway
+        self.require_exp = require_exp
+        self.cache_size = cache_size
+        self._verified = OrderedDict()  # token -> (claims, expires_at)
+        self._lock = threading.Lock()
+
+    def verify(self, token, now=None):
+        """Return the token's claims, or raise TokenVerificationError"""
+        now = time.time() if now is None else now
+        with self._lock:
+            cached = self._verified.get(token)
+            if cached is not None:
+                self._verified.move_to_end(token)
+        if cached is not None:
+            claims, expires_at = cached
+            if expires_at is not None and now > expires_at + self.leeway:
+                raise TokenVerificationError("Token expired")
+            return claims
+
+        claims, expires_at = self._verify_uncached(token, now)
+        if self.cache_size:
+            with self._lock:
+                self._verified[token] = (claims, expires_at)
+                if len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+        return claims
+
+    def _verify_uncached(self, token, now):
+        try:
+            signing_input, _, signature = token.rpartition('.')
+            encoded_header, encoded_claims = signing_input.split('.')
+            header = json.loads(b64url_decode(encoded_header))
+            claims = json.loads(b64url_decode(encoded_claims))
+            signature = b64url_decode(signature)
+        except (AttributeError, ValueError):
+            raise TokenVerificationError("Malformed token")
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise TokenVerificationError("Malformed token")
+        if header.get('alg') != 'RS256':
+            raise TokenVerificationError(f"Unsupported algorithm: {header.get('alg')}")
+
+        key = self.jwks.get(header.get('kid'))
+        try:
+            verified = key.verify(signing_input.encode(), signature)
+        except ValueError as e:
+            raise TokenVerificationError(f"Unusable signing key {key.kid}: {e}") from e
+        if not verified:
+            raise TokenVerificationError("Invalid signature")
+
+        expires_at = claim_timestamp(claims.get('exp'))
+        if expires_at is None and self.require_exp:
+            raise TokenVerificationError("Token has no exp claim")
+        if expires_at is not None and now > expires_at + self.leeway:
+            raise TokenVerificationError("Token expired")
+        not_before = claim_timestamp(claims.get('nbf'))
+        if not_before is not None and now < not_before - self.leeway:
+            raise TokenVerificationError("Token not yet valid")
+        if self.audience:
+            aud = claims.get('aud')
+            aud = {aud} if isinstance(aud, str) else set(aud or ())
+            if not aud & self.audience:
+                raise TokenVerificationError(f"Token audience {sorted(aud)} not accepted")
+        if self.issuer is not None and claims.get('iss') != self.issuer:
+            raise TokenVerificationError(f"Unexpected issuer: {claims.get('iss')}")
+        return claims, expires_at
+
+    def is_valid(self, token):
+        try:
+            self.verify(token)
+            return True
+        except TokenVerificationError:
+            return False
+
+    def verify_many(self, tokens):
+        """Yield (token, claims, error) for each token; error is None when valid"""
+        now = time.time()
+        for token in tokens:
+            try:
+                yield token, self.verify(token, now), None
+            except TokenVerificationError as e:
+                yield token, None, e
+
+
+def self_test(count, bits=2048):
+    """Sign ``count`` tokens with a fresh keypair and time batch verification"""
+    started = time.perf_counter()
+    private_key = generate_keypair(bits)
+    keygen_ms = (time.perf_counter() - started) * 1000
+    jwks = JWKSCache.from_jwks({'keys': [private_key.public_key().to_jwk()]})
+    verifier = JWTVerifier(jwks, audience='kingschat', cache_size=count)
+    exp = int((time.time() + 3600) * 1000)
+    tokens = [sign_rs256({'sub': f"user{i}", 'aud': ['kingschat'], 'exp': exp}, private_key)
+              for i in range(count)]
+    forged = tokens[0][:-8] + ('A' * 8 if not tokens[0].endswith('A' * 8) else 'B' * 8)
+
+    started = time.perf_counter()
+    valid = sum(1 for _, claims, _ in verifier.verify_many(tokens) if claims is not None)
+    cold_us = (time.perf_counter() - started) * 1e6 / count
+    started = time.perf_counter()
+    sum(1 for _ in verifier.verify_many(tokens))
+    warm_us = (time.perf_counter() - started) * 1e6 / count
+    return {
+        'keygen_ms': keygen_ms,
+        'tokens': count,
+        'valid': valid,
+        'forged_rejected': not verifier.is_valid(forged),
+        'verify_us': cold_us,
+        'cached_verify_us': warm_us
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify KingsChat JWTs offline")
+    parser.add_argument('tokens', nargs='*', help="tokens to verify (default: kc_config.json)")
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    parser.add_argument('--jwks-url', default=JWKS_URL)
+    parser.add_argument('--jwks-file', help="read keys from a JWKS JSON file instead")
+    parser.add_argument('--audience', action='append', help="accepted audience (repeatable)")
+    parser.add_argument('--issuer')
+    parser.add_argument('--leeway', type=float, default=DEFAULT_LEEWAY)
+    parser.add_argument('--self-test', type=int, metavar='N',
+                        help="verify N tokens signed by a locally generated keypair")
+    args = parser.parse_args(argv)
+
+    if args.self_test:
+        report = self_test(args.self_test)
+        print(f"Generated a 2048-bit keypair in {report['keygen_ms']:.0f}ms")
+        print(f"{report['valid']}/{report['tokens']} tokens valid, forged token "
+              f"{'rejected' if report['forged_rejected'] else 'ACCEPTED'}")
+        print(f"Verify: {report['verify_us']:.1f}µs/token, cached: "
+              f"{report['cached_verify_us']:.2f}µs/token")
+        return 0 if report['forged_rejected'] and report['valid'] == report['tokens'] else 1
+
+    if args.jwks_file:
+        with open(args.jwks_file) as f:
+            jwks = JWKSCache.from_jwks(json.load(f))
+    else:
+        jwks = JWKSCache(args.jwks_url)
+    verifier = JWTVerifier(jwks, args.audience, args.issuer, args.leeway)
+    tokens = args.tokens or [load_config(args.config).get('access_token', '')]
+
+    failures = 0
+    try:
+        for token, claims, error in verifier.verify_many(tokens):
+            if error is None:
+                expires_at = claim_timestamp(claims.get('exp'))
+                remaining = f"{(expires_at - time.time()) / 60:.0f} min left" if expires_at else "no exp"
+                print(f"✓ Valid token for {claims.get('sub')} ({remaining})")
+            else:
+                failures += 1
+                print(f"✗ {error}: {token[:24]}...")
+    except Exception as e:
+        print(f"✗ Could not load signing keys from {args.jwks_url}: {e}")
+        return 1
+    finally:
+        jwks.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,8 @@
+"""
+KingsChat command-line tools.
+
+The ``kingschat`` console command (kingschat/cli.py) fronts the scripts in
+this directory; settings they all share live in kingschat/config.py.
+"""
+
+__version__ = '0.1.0'
@@ -0,0 +1,3 @@
+from kingschat.cli import main
+
+raise SystemExit(main())
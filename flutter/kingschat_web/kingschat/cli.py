@@ -0,0 +1,120 @@
+"""
+KingsChat CLI
+One ``kingschat`` command in front of the login, probe, token, send and
+resolve tools.
+
+Only argparse and sys are imported up front. A subcommand's module (and
+through it asyncio, sqlite3, the HTTP client and so on) is imported when
+that subcommand runs, so ``kingschat --help`` or a typo costs a bare
+interpreter start rather than the whole toolset. Each subcommand parses
+its own options; ``kingschat send --help`` is bulk_send.py's help.
+
+Usage:
+    kingschat login
+    kingschat probe --rounds 5
+    kingschat verify-token --self-test 1000
+    kingschat send --recipients recipients.txt --message "Hello"
+    kingschat resolve usernames.txt --output resolved.csv
+
+    python -m kingschat --help
+"""
+
+import argparse
+import importlib
+import sys
+
+from kingschat import __version__
+
+
+def login(argv):
+    """Log in through the browser and store the tokens in kc_config.json"""
+    from kingschat.config import CONFIG_FILE
+
+    parser = argparse.ArgumentParser(prog='kingschat login', description=login.__doc__)
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="seconds to wait for the OAuth callback")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="print the login URL instead of opening a browser")
+    parser.add_argument('--no-save', action='store_true', help="don't write the tokens anywhere")
+    parser.add_argument('--notify', action='store_true',
+                        help="send the login notifications from the account in --config")
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    args = parser.parse_args(argv)
+
+    from test_oauth_flow import run_login
+    from token_manager import load_config, save_config, token_expiry
+
+    notifier = None
+    if args.notify:
+        from kingschat_client import KingsChatClient
+        from login_notifier import LoginNotifier
+        from token_manager import TokenManager
+
+        client = KingsChatClient(token_manager=TokenManager(args.config))
+        notifier = LoginNotifier(client)
+    try:
+        result = run_login(timeout=args.timeout, open_browser=not args.no_browser,
+                           notifier=notifier)
+    finally:
+        if notifier is not None:
+            notifier.close()
+            notifier.client.close()
+    access_token = (result or {}).get('access_token')
+    if not access_token:
+        return 1
+    if args.no_save:
+        return 0
+
+    config = load_config(args.config)
+    config['access_token'] = access_token
+    if result.get('refresh_token'):
+        config['refresh_token'] = result['refresh_token']
+    expires_at = token_expiry(access_token)
+    if expires_at:
+        config['expires_at'] = int(expires_at)
+    save_config(config, args.config)
+    print(f"✓ Tokens saved to {args.config}")
+    return 0
+
+
+# name -> (module, function, leading arguments, description)
+COMMANDS = {
+    'login': (__name__, 'login', [], "log in through the browser and save the tokens"),
+    'probe': ('test_oauth_flow', 'main', ['--test-api'], "time the KingsChat API endpoints"),
+    'verify-token': ('jwt_verifier', 'main', [], "verify JWTs offline"),
+    'send': ('bulk_send', 'main', [], "send a message to many users"),
+    'resolve': ('username_resolver', 'main', [], "resolve usernames to user ids"),
+}
+
+
+def usage():
+    width = max(len(name) for name in COMMANDS)
+    lines = ["usage: kingschat [--version] <command> [options]", "", "commands:"]
+    lines += [f"  {name:<{width}}  {command[3]}" for name, command in COMMANDS.items()]
+    lines += ["", "Run 'kingschat <command> --help' for a command's options."]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ('-h', '--help', 'help'):
+        print(usage())
+        return 0 if argv else 2
+    if argv[0] == '--version':
+        print(f"kingschat {__version__}")
+        return 0
+
+    name, rest = argv[0], argv[1:]
+    if name not in COMMANDS:
+        print(f"kingschat: unknown command '{name}'\n\n{usage()}", file=sys.stderr)
+        return 2
+
+    module_name, function_name, leading, _ = COMMANDS[name]
+    function = getattr(importlib.import_module(module_name), function_name)
+    # The subcommand's argparse takes its program name from sys.argv[0]
+    sys.argv[0] = f"kingschat {name}"
+    return function(leading + rest)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,41 @@
+"""
+KingsChat Configuration
+Settings shared by the login, token, client and CLI modules.
+
+Kept free of imports beyond the standard library's os so that reading a
+constant never costs more than this file.
+
+The token file is kc_config.json, which the PHP pages use too. It is
+looked up in the working directory first, then at the repository root when
+the tools run from a checkout; an installed copy has no repository around
+it, so there it lives in the working directory. Set KINGSCHAT_CONFIG to use
+another file.
+"""
+
+import os
+
+# Three levels up from flutter/kingschat_web/kingschat/ in a source checkout
+_CHECKOUT_ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               '..', '..', '..'))
+
+
+def _root_dir():
+    """The directory holding kc_config.json: the working directory or the checkout root"""
+    cwd = os.getcwd()
+    for directory in (cwd, _CHECKOUT_ROOT):
+        if os.path.isfile(os.path.join(directory, 'kc_config.json')):
+            return directory
+    return cwd
+
+
+ROOT_DIR = _root_dir()
+
+# Configuration (matching the Flutter app and the PHP pages)
+CLIENT_ID = "619b30ea-a682-47fb-b90f-5b8e780b89ca"
+AUTH_URL = "https://accounts.kingsch.at"
+API_BASE_URL = "https://connect.kingsch.at/api"
+TOKEN_URL = "https://connect.kingsch.at/oauth2/token"
+SCOPES = ["kingschat"]
+REDIRECT_URI = "http://localhost:8090/callback"
+
+CONFIG_FILE = os.environ.get('KINGSCHAT_CONFIG') or os.path.join(ROOT_DIR, 'kc_config.json')
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+KingsChat API Client
+Reusable client for the KingsChat REST API built on keep-alive connection pools.
+
+Every request reuses an idle HTTP(S) connection when one is available, so
+DNS, TCP and TLS setup is paid once per pooled connection instead of once
+per call. KingsChatClient is thread-safe; AsyncKingsChatClient exposes the
+same calls as coroutines for asyncio code.
+"""
+
+import email.utils
+import http.client
+import json
+import queue
+import select
+import threading
+import time
+import urllib.parse
+
+from kingschat.config import API_BASE_URL
+from metrics import API_LATENCY, API_UNAUTHORIZED_RETRIES, endpoint_label
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10          # Seconds to wait for a response
+DEFAULT_CONNECT_TIMEOUT = 5   # Seconds to wait for TCP/TLS setup
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
+
+class KingsChatAPIError(Exception):
+    """Raised when the API answers with a non-2xx status"""
+
+    def __init__(self, status, body, path=None, headers=None):
+        self.status = status
+        self.body = body
+        self.path = path
+        self.headers = headers or {}
+        super().__init__(f"HTTP {status} from {path}: {body[:200]!r}")
+
+    @property
+    def retry_after(self):
+        """Seconds asked for by a Retry-After header, or None"""
+        return parse_retry_after(self.headers)
+
+
+class ApiResponse:
+    """Status, headers and raw body of one API call, plus its timings in ms"""
+
+    def __init__(self, status, headers, body, connect_ms=0.0, ttfb_ms=None, total_ms=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.connect_ms = connect_ms
+        self.ttfb_ms = ttfb_ms
+        self.total_ms = total_ms
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def json(self):
+        """Decode the body as JSON; empty bodies (common for new_message) become {}"""
+        if not self.body or not self.body.strip():
+            return {}
+        return json.loads(self.body)
+
+
+class ConnectionPool:
+    """Bounded pool of keep-alive connections to a single origin.
+
+    At most ``maxsize`` connections exist at once; callers beyond that block
+    until one is returned. Idle connections are reused most-recently-used
+    first so that the warmest sockets stay busy.
+    """
+
+    def __init__(self, origin, maxsize=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        parsed_url = urllib.parse.urlparse(origin)
+        self.scheme = parsed_url.scheme
+        self.netloc = parsed_url.netloc
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._closed = False
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.connect_timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.connect_timeout)
+
+    def _acquire(self):
+        self._slots.acquire()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_connection(), True
+            if not _is_dropped(conn):
+                return conn, False
+            conn.close()
+
+    def _release(self, conn, reusable):
+        if reusable and not self._closed:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def request(self, method, path, body=None, headers=None):
+        """Send one request and return an ApiResponse.
+
+        Idle connections the server has closed are discarded before use. If
+        a reused connection still turns out to be dead, the request is
+        retried once on a fresh connection, but only when it is idempotent
+        or was not fully written, so a POST the server may have processed is
+        never sent twice. Any other failure is raised to the caller.
+        """
+        for attempt in range(2):
+            conn, is_new = self._acquire()
+            reusable = False
+            written = False
+            started = time.perf_counter()
+            try:
+                connect_ms = 0.0
+                if is_new:
+                    conn.connect()
+                    conn.sock.settimeout(self.timeout)
+                    connect_ms = (time.perf_counter() - started) * 1000
+
+                request_sent = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers or {})
+                written = True
+                response = conn.getresponse()
+                ttfb_ms = (time.perf_counter() - request_sent) * 1000
+                data = response.read()
+                reusable = not response.will_close
+                return ApiResponse(
+                    response.status, dict(response.getheaders()), data,
+                    connect_ms=connect_ms, ttfb_ms=ttfb_ms,
+                    total_ms=(time.perf_counter() - started) * 1000
+                )
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if is_new or attempt or (written and method not in IDEMPOTENT_METHODS):
+                    raise
+            finally:
+                self._release(conn, reusable)
+
+    def close(self):
+        """Close every idle connection; connections in use close when returned"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class KingsChatClient:
+    """Thread-safe KingsChat API client sharing one connection pool.
+
+    ``access_token`` may be changed at any time; it is read per request.
+    With a ``token_manager`` (see token_manager.py) the token is taken from
+    the manager instead, and a 401 triggers one shared refresh and a retry.
+    """
+
+    def __init__(self, access_token=None, base_url=API_BASE_URL, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 token_manager=None):
+        parsed_url = urllib.parse.urlparse(base_url)
+        self.access_token = access_token
+        self.token_manager = token_manager
+        self.base_path = parsed_url.path.rstrip('/')
+        self.pool_size = pool_size
+        self.pool = ConnectionPool(
+            f"{parsed_url.scheme}://{parsed_url.netloc}", maxsize=pool_size,
+            timeout=timeout, connect_timeout=connect_timeout
+        )
+
+    def request(self, method, path, payload=None):
+        """Call ``{base_url}{path}`` and return the raw ApiResponse"""
+        body = None
+        if payload is not None:
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+
+        if self.token_manager is None:
+            return self._send(method, path, body, self.access_token)
+
+        token = self.token_manager.get_token()
+        response = self._send(method, path, body, token)
+        if response.status == 401:
+            API_UNAUTHORIZED_RETRIES.inc(endpoint_label(path))
+            token = self.token_manager.refresh(stale_token=token)
+            response = self._send(method, path, body, token)
+        return response
+
+    def _send(self, method, path, body, token):
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.pool.request(method, self.base_path + path, body=body, headers=headers)
+            status = response.status
+            return response
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, endpoint_label(path), method, status)
+
+    def _call(self, method, path, payload=None):
+        response = self.request(method, path, payload)
+        if not response.ok:
+            raise KingsChatAPIError(response.status, response.body.decode(errors='replace'), path,
+                                    response.headers)
+        return response.json()
+
+    def profile(self):
+        return self._call('GET', '/profile')
+
+    def contacts(self):
+        return self._call('GET', '/contacts')
+
+    def user(self, user_id):
+        return self._call('GET', f"/users/{urllib.parse.quote(user_id, safe='')}")
+
+    def user_by_username(self, username):
+        """Look up a user by exact username; returns None if there is no such user"""
+        try:
+            return self._call('GET', '/users?' + urllib.parse.urlencode({'username': username}))
+        except KingsChatAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def send_message(self, user_id, text):
+        """Send a text message to a user; ``text`` may be a pre-encoded JSON payload"""
+        payload = text if isinstance(text, bytes) else message_payload(text)
+        return self._call('POST', f"/users/{urllib.parse.quote(user_id, safe='')}/new_message", payload)
+
+    def add_contact(self, user_id):
+        """Add a user to the account's contacts; returns {'user': {...}} for the added user"""
+        return self._call('POST', '/contacts', {'user_id': user_id})
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncKingsChatClient:
+    """asyncio front-end for KingsChatClient.
+
+    Calls run on a private thread pool sized to the connection pool, so at
+    most ``pool_size`` requests are in flight and none block the event loop.
+    asyncio and concurrent.futures are imported here rather than at module
+    level, so synchronous tools start without them.
+    """
+
+    def __init__(self, access_token=None, base_url=API_BASE_URL, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 token_manager=None, client=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.client = client or KingsChatClient(
+            access_token, base_url, pool_size=pool_size, timeout=timeout,
+            connect_timeout=connect_timeout, token_manager=token_manager
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.client.pool_size, thread_name_prefix='kingschat'
+        )
+
+    async def _run(self, func, *args):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def request(self, method, path, payload=None):
+        return await self._run(self.client.request, method, path, payload)
+
+    async def profile(self):
+        return await self._run(self.client.profile)
+
+    async def contacts(self):
+        return await self._run(self.client.contacts)
+
+    async def user(self, user_id):
+        return await self._run(self.client.user, user_id)
+
+    async def user_by_username(self, username):
+        return await self._run(self.client.user_by_username, username)
+
+    async def send_message(self, user_id, text):
+        return await self._run(self.client.send_message, user_id, text)
+
+    async def add_contact(self, user_id):
+        return await self._run(self.client.add_contact, user_id)
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def _is_dropped(conn):
+    """True if an idle connection was closed by the server (or has unexpected data waiting)"""
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def message_payload(text):
+    """The new_message request body for a plain text message"""
+    return {'message': {'body': {'text': {'body': text}}}}
+
+
+def parse_retry_after(headers):
+    """Retry-After (delay in seconds or an HTTP date) from a header dict, in seconds"""
+    value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+KingsChat Log Analyzer
+Streams error.log and logs/bulk.log in constant memory and reports on them.
+
+Files are read in fixed-size binary chunks and matched with precompiled
+byte patterns; multi-line print_r dumps in error.log are skipped without
+being decoded. The byte offset reached in each file is remembered in a
+state file, so a re-run only processes what was appended since (a
+truncated or rotated file is read from the start again).
+
+Reports per bulk run throughput, per-message send latency (the gap between
+"Sending message i/N" and "Message i sent successfully"), HTTP response and
+failure codes, 401s and token-refresh frequency.
+
+Usage:
+    python log_analyzer.py                     # new bytes since the last run
+    python log_analyzer.py --full --json report.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+from collections import OrderedDict
+
+from percentiles import histogram_percentile
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+ERROR_LOG = os.path.join(ROOT_DIR, 'error.log')
+BULK_LOG = os.path.join(ROOT_DIR, 'logs', 'bulk.log')
+STATE_FILE = os.path.join(ROOT_DIR, 'logs', '.log_analyzer_state.json')
+CHUNK_SIZE = 1 << 20
+MAX_LINE = 1 << 20  # Longer lines are skipped rather than buffered
+MAX_PENDING = 10000  # Unmatched "Sending" lines kept between runs
+
+MONTHS = {m.encode(): i for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1
+)}
+
+# [2025-03-10 18:32:54] [INFO] [User: ysE7...] Sending message 1/10 to Name (5d03...)
+BULK_LINE = re.compile(
+    rb'\[(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\] \[(\w+)\] \[User: ([^\]]*)\] (.*)'
+)
+BULK_START = re.compile(rb'Starting bulk test - Total messages: (\d+)')
+BULK_SENDING = re.compile(rb'Sending message (\d+)/(\d+) to .*\(([^)]*)\)\s*$')
+BULK_SENT = re.compile(rb'Message (\d+) sent successfully')
+DIGITS = re.compile(rb'\d+')
+
+# [09-Mar-2025 10:47:52 Europe/Berlin] Response code: 200
+ERROR_LINE = re.compile(rb'\[(\d\d)-(\w{3})-(\d{4}) (\d\d):(\d\d):(\d\d) [^\]]*\] (.*)')
+RESPONSE_CODE = re.compile(rb'(?:Message |Notification |Profile API |Contacts API )?'
+                           rb'[Rr]esponse [Cc]ode: (\d{3})')
+API_STATUS = re.compile(rb'(?:API returned status|HTTP code:?) (\d{3})')
+# Refresh lines of token_refresh.php, dashboard.php, oauth_handler.php, bulk_message_test.php
+# and send_welcome_message.php
+REFRESH_ATTEMPT = re.compile(rb'Attempting to refresh (?:KingsChat )?token')
+REFRESH_SUCCESS = re.compile(rb'(?:KingsChat )?[Tt]oken refreshed successfully')
+REFRESH_FAILURE = re.compile(rb'Failed to refresh KingsChat token|Token refresh failed|'
+                             rb'Failed to execute token refresh command')
+
+
+def read_lines(path, offset=0, chunk_size=CHUNK_SIZE, max_line=MAX_LINE):
+    """Yield (line, end_offset) for every complete line after ``offset``.
+
+    A trailing line without a newline is left for the next run. Lines
+    longer than ``max_line`` bytes are skipped, so memory stays bounded.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remainder = b''
+        skipping = False  # Inside an over-long line; drop bytes up to its newline
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = remainder + chunk
+            start = 0
+            if skipping:
+                end = data.find(b'\n')
+                if end < 0:
+                    offset += len(data)
+                    remainder = b''
+                    continue
+                offset += end + 1
+                start = end + 1
+                skipping = False
+            while True:
+                end = data.find(b'\n', start)
+                if end < 0:
+                    break
+                offset += end + 1 - start
+                if end - start <= max_line:
+                    yield data[start:end].rstrip(b'\r'), offset
+                start = end + 1
+            remainder = data[start:]
+            if len(remainder) > max_line:
+                offset += len(remainder)
+                remainder = b''
+                skipping = True
+
+
+class LatencyHistogram:
+    """Counts of whole-second latencies; constant memory however many samples"""
+
+    def __init__(self, counts=None):
+        self.counts = {int(k): v for k, v in (counts or {}).items()}
+
+    def add(self, seconds):
+        self.counts[seconds] = self.counts.get(seconds, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, pct):
+        return histogram_percentile(self.counts, pct)
+
+    def summary(self):
+        total = self.total
+        return {
+            'samples': total,
+            'mean_s': sum(k * v for k, v in self.counts.items()) / total if total else None,
+            'p50_s': self.percentile(50),
+            'p95_s': self.percentile(95),
+            'p99_s': self.percentile(99)
+        }
+
+
+class BulkLogAnalyzer:
+    """Runs, send latency and errors from logs/bulk.log"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.pending = OrderedDict((tuple(k.split('|', 1)), v)
+                                   for k, v in state.get('pending', []))
+        self.open_runs = state.get('open_runs', {})
+        self.latency = LatencyHistogram()
+        self.runs = []
+        self.levels = {}
+        self.errors = {}
+        self.lines = 0
+        self._last_ts = (None, None)
+
+    def _timestamp(self, match):
+        key = match.group(1, 2, 3, 4, 5, 6)
+        if self._last_ts[0] != key:
+            dt = datetime.datetime(*map(int, key))
+            self._last_ts = (key, int(dt.timestamp()))
+        return self._last_ts[1]
+
+    def feed(self, line):
+        match = BULK_LINE.match(line)
+        if match is None:
+            return
+        self.lines += 1
+        ts = self._timestamp(match)
+        level = match.group(7).decode()
+        user = match.group(8).decode()
+        message = match.group(9)
+        self.levels[level] = self.levels.get(level, 0) + 1
+
+        if message.startswith(b'Sending message'):
+            sending = BULK_SENDING.match(message)
+            if sending:
+                self.pending[(user, sending.group(1).decode())] = ts
+                if len(self.pending) > MAX_PENDING:
+                    self.pending.popitem(last=False)
+        elif message.startswith(b'Message') and message.endswith(b'sent successfully'):
+            sent = BULK_SENT.match(message)
+            started = self.pending.pop((user, sent.group(1).decode()), None) if sent else None
+            if started is not None:
+                self.latency.add(ts - started)
+            run = self.open_runs.get(user)
+            if run is not None:
+                run['sent'] += 1
+                run['last'] = ts
+        elif message.startswith(b'Starting bulk test'):
+            start = BULK_START.match(message)
+            self._close_run(user, completed=False)
+            self.open_runs[user] = {
+                'user': user, 'start': ts, 'last': ts, 'sent': 0,
+                'total': int(start.group(1)) if start else None
+            }
+        elif message.startswith(b'Bulk test completed'):
+            run = self.open_runs.get(user)
+            if run is not None:
+                run['last'] = ts
+            self._close_run(user, completed=True)
+
+        if level not in ('INFO', 'DEBUG'):
+            shape = DIGITS.sub(b'N', message[:120]).decode(errors='replace')
+            self.errors[shape] = self.errors.get(shape, 0) + 1
+
+    def _close_run(self, user, completed):
+        run = self.open_runs.pop(user, None)
+        if run is None:
+            return
+        duration = run['last'] - run['start']
+        self.runs.append({
+            'user': run['user'],
+            'started': datetime.datetime.fromtimestamp(run['start']).isoformat(sep=' '),
+            'total': run['total'],
+            'sent': run['sent'],
+            'duration_s': duration,
+            'messages_per_s': run['sent'] / duration if duration else None,
+            'completed': completed
+        })
+
+    def state(self):
+        return {
+            'pending': [[f"{user}|{index}", ts] for (user, index), ts in self.pending.items()],
+            'open_runs': self.open_runs
+        }
+
+    def report(self):
+        finished = [r for r in self.runs if r['messages_per_s']]
+        return {
+            'lines': self.lines,
+            'levels': self.levels,
+            'runs': self.runs,
+            'runs_in_progress': len(self.open_runs),
+            'mean_messages_per_s': sum(r['messages_per_s'] for r in finished) / len(finished)
+                                   if finished else None,
+            'send_latency': self.latency.summary(),
+            'errors': self.errors
+        }
+
+
+class ErrorLogAnalyzer:
+    """Response codes, failures, 401s and token refreshes from error.log"""
+
+    def __init__(self, state=None):
+        self.entries = 0
+        self.response_codes = {}
+        self.failures = {}
+        self.unauthorized = 0
+        self.refresh_attempts = 0
+        self.refresh_successes = 0
+        self.refresh_failures = 0
+        self.php_errors = {}
+        self.first_ts = None
+        self.last_ts = None
+        self._last_ts = (None, None)
+
+    def _timestamp(self, match):
+        key = match.group(1, 2, 3, 4, 5, 6)
+        if self._last_ts[0] != key:
+            day, month, year, hour, minute, second = key
+            dt = datetime.datetime(int(year), MONTHS.get(month, 1), int(day),
+                                   int(hour), int(minute), int(second))
+            self._last_ts = (key, int(dt.timestamp()))
+        return self._last_ts[1]
+
+    def feed(self, line):
+        # Continuation lines of print_r dumps never start with a timestamp
+        if not line.startswith(b'['):
+            return
+        match = ERROR_LINE.match(line)
+        if match is None:
+            return
+        self.entries += 1
+        ts = self._timestamp(match)
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+        message = match.group(7)
+
+        if b'esponse' in message:
+            code = RESPONSE_CODE.match(message)
+            if code:
+                self._status(code.group(1).decode(), response=True)
+                return
+        if b'efresh' in message:
+            if REFRESH_ATTEMPT.search(message):
+                self.refresh_attempts += 1
+            elif REFRESH_SUCCESS.match(message):
+                self.refresh_successes += 1
+            elif REFRESH_FAILURE.match(message):
+                self.refresh_failures += 1
+        status = API_STATUS.search(message)
+        if status:
+            self._status(status.group(1).decode(), response=False)
+        elif message.startswith(b'Received 401'):
+            self.unauthorized += 1
+        if message.startswith(b'PHP '):
+            kind = message[4:message.find(b':')].decode(errors='replace')
+            self.php_errors[kind] = self.php_errors.get(kind, 0) + 1
+
+    def _status(self, status, response):
+        if response:
+            self.response_codes[status] = self.response_codes.get(status, 0) + 1
+        if status[0] != '2':
+            self.failures[status] = self.failures.get(status, 0) + 1
+        if status == '401':
+            self.unauthorized += 1
+
+    def state(self):
+        return {}
+
+    def report(self):
+        hours = (self.last_ts - self.first_ts) / 3600 if self.first_ts is not None else 0
+        return {
+            'entries': self.entries,
+            'response_codes': self.response_codes,
+            'failures': self.failures,
+            'unauthorized': self.unauthorized,
+            'token_refresh': {
+                'attempts': self.refresh_attempts,
+                'succeeded': self.refresh_successes,
+                'failed': self.refresh_failures,
+                'per_hour': self.refresh_attempts / hours if hours else None
+            },
+            'php_errors': self.php_errors
+        }
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def analyze_file(path, analyzer_class, file_state=None, chunk_size=CHUNK_SIZE):
+    """Feed the unread part of ``path`` to a new analyzer.
+
+    Returns (analyzer, new_file_state, bytes_read).
+    """
+    file_state = file_state or {}
+    stat = os.stat(path)
+    offset = file_state.get('offset', 0)
+    if file_state.get('inode') != stat.st_ino or stat.st_size < offset:
+        offset, file_state = 0, {}
+
+    analyzer = analyzer_class(file_state.get('analyzer'))
+    end_offset = offset
+    for line, end_offset in read_lines(path, offset, chunk_size):
+        analyzer.feed(line)
+
+    new_state = {'inode': stat.st_ino, 'offset': end_offset, 'analyzer': analyzer.state()}
+    return analyzer, new_state, end_offset - offset
+
+
+def print_report(report):
+    bulk = report.get('bulk')
+    if bulk:
+        print(f"=== {bulk['path']} ({bulk['bytes_read']} new bytes) ===")
+        print(f"Lines: {bulk['lines']}, runs finished: {len(bulk['runs'])}, "
+              f"in progress: {bulk['runs_in_progress']}")
+        for run in bulk['runs']:
+            rate = f"{run['messages_per_s']:.2f} msg/s" if run['messages_per_s'] else '-'
+            status = '✓' if run['completed'] else '✗'
+            print(f"  {status} {run['started']}  {run['sent']}/{run['total']} "
+                  f"in {run['duration_s']}s  {rate}")
+        latency = bulk['send_latency']
+        if latency['samples']:
+            print(f"Send latency: mean {latency['mean_s']:.2f}s, p50 {latency['p50_s']}s, "
+                  f"p95 {latency['p95_s']}s, p99 {latency['p99_s']}s "
+                  f"({latency['samples']} messages)")
+        for shape, count in sorted(bulk['errors'].items(), key=lambda i: -i[1])[:10]:
+            print(f"  ✗ {count}x {shape}")
+
+    errors = report.get('error')
+    if errors:
+        print(f"\n=== {errors['path']} ({errors['bytes_read']} new bytes) ===")
+        print(f"Entries: {errors['entries']}")
+        print(f"Response codes: {errors['response_codes'] or '-'}")
+        print(f"Failure codes: {errors['failures'] or '-'}")
+        print(f"401 Unauthorized: {errors['unauthorized']}")
+        refresh = errors['token_refresh']
+        per_hour = f"{refresh['per_hour']:.1f}/h" if refresh['per_hour'] else '-'
+        print(f"Token refreshes: {refresh['attempts']} attempted, {refresh['succeeded']} ok, "
+              f"{refresh['failed']} failed ({per_hour})")
+        if errors['php_errors']:
+            print(f"PHP errors: {errors['php_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze KingsChat Blast logs incrementally")
+    parser.add_argument('--error-log', default=ERROR_LOG)
+    parser.add_argument('--bulk-log', default=BULK_LOG)
+    parser.add_argument('--state', default=STATE_FILE, help="where per-file offsets are kept")
+    parser.add_argument('--full', action='store_true',
+                        help="ignore saved offsets and analyze the whole files")
+    parser.add_argument('--no-save', action='store_true', help="do not update the state file")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--json', dest='json_path', metavar='PATH',
+                        help="also write the report as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    state = {} if args.full else load_state(args.state)
+    report = {}
+    for key, path, analyzer_class in (('bulk', args.bulk_log, BulkLogAnalyzer),
+                                      ('error', args.error_log, ErrorLogAnalyzer)):
+        if not os.path.exists(path):
+            continue
+        abs_path = os.path.abspath(path)
+        analyzer, state[abs_path], bytes_read = analyze_file(
+            path, analyzer_class, state.get(abs_path), args.chunk_size
+        )
+        report[key] = dict(path=path, bytes_read=bytes_read, **analyzer.report())
+
+    print_report(report)
+    if args.json_path == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not args.no_save:
+        save_state(state, args.state)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+KingsChat Login Notifier
+Sends login notifications from a background worker, off the login request.
+
+On each login the PHP pages send a welcome message, a "you have successfully
+logged in" notice and a contact add one after another inside the login
+request, each with its own 401 refresh-and-retry. Here a login handler only
+puts an event on a bounded local queue (when it is full the event is
+dropped and counted) and returns, so a login costs no more than its OAuth
+callback. A dispatcher thread coalesces repeat logins by the same user
+within a window into one set of notifications, and skips the contact add
+for users already in the contact directory or added earlier (the last
+MAX_KNOWN_CONTACTS of them are remembered in memory). The remaining
+calls go to a thread pool over one pooled KingsChatClient, where a 401
+costs one shared token refresh. When a login did not come with a name, it
+is looked up through a ProfileCache.
+
+The user id defaults to the ``sub`` claim of the login's access token, so
+the callback handler needs no API call to find it.
+
+Usage:
+    notifier = LoginNotifier(client, contacts_db=DEFAULT_DB)
+    server = CallbackServer(CallbackHandler, notifier=notifier)  # handlers call notify_login()
+    notifier.close()
+
+    python login_notifier.py --logins 2000 --users 200 --latency fixed:50
+"""
+
+import argparse
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from contact_directory import DEFAULT_DB, ContactDirectory, normalize_contact
+from kingschat_client import KingsChatAPIError, KingsChatClient
+from metrics import LOGIN_EVENTS, LOGIN_NOTIFICATIONS
+from profile_cache import ProfileCache
+from rate_limiter import is_congestion
+from token_manager import decode_jwt_claims
+
+DEFAULT_WINDOW = 300  # Seconds in which repeat logins by one user are notified once
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RETRIES = 2
+DEFAULT_QUEUE_SIZE = 10000
+MAX_KNOWN_CONTACTS = 100000  # Contact ids remembered in memory, least recently used dropped
+RETRY_BACKOFF = 0.5  # Seconds before the first retry; doubled for each one after
+
+WELCOME, NOTICE, CONTACT = 'welcome', 'notice', 'contact'
+KINDS = (WELCOME, NOTICE, CONTACT)
+
+# The texts send_welcome_message.php and the login notifier send
+WELCOME_MESSAGE = ("Welcome to KingsBlast, {name}! Your login was successful. You can now use "
+                   "the system to send messages to your KingsChat contacts.")
+LOGIN_NOTICE = ("Hello {name}, you have successfully logged in to KingsChat Blast at {time}. "
+                "If this wasn't you, please contact support immediately.")
+
+
+class LoginNotifier:
+    """Queue-fed sender of login notifications; submit() never blocks.
+
+    ``kinds`` picks which of welcome, notice and contact are sent per login.
+    ``contacts_db`` is a contact_directory.py database: users found there
+    are not added again, and users this notifier adds are written to it.
+    ``event_log`` (a StructuredLogger) receives one event per call. An
+    event that fails to dispatch is counted in ``stats['errors']`` and the
+    dispatcher carries on with the next one.
+    """
+
+    def __init__(self, client, kinds=KINDS, window=DEFAULT_WINDOW,
+                 concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, contacts_db=None,
+                 cache=None, queue_size=DEFAULT_QUEUE_SIZE, event_log=None):
+        self.client = client
+        self.kinds = tuple(kinds)
+        self.window = window
+        self.retries = retries
+        self.contacts_db = contacts_db
+        self.cache = cache if cache is not None else ProfileCache(client)
+        self._owns_cache = cache is None
+        self.event_log = event_log
+        self.stats = {'notified': 0, 'coalesced': 0, 'dropped': 0, 'invalid': 0, 'sent': 0,
+                      'failed': 0, 'contacts_skipped': 0, 'retries': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._recent = OrderedDict()  # user_id -> time of the login last notified
+        self._known_contacts = OrderedDict()  # user_id -> None, least recently used first
+        self._added = []  # Users added by pool threads, for the dispatcher to store
+        # Caps queued calls, so a surge backs up into the bounded queue instead of the pool
+        self._slots = threading.BoundedSemaphore(concurrency * 2)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix='login-notifier')
+        self._thread = threading.Thread(target=self._run, name='login-notifier', daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id=None, name=None, access_token=None):
+        """Queue one login; returns False if the queue was full and it was dropped"""
+        try:
+            self._queue.put_nowait((time.time(), user_id, name, access_token))
+        except queue.Full:
+            self._count('dropped')
+            LOGIN_EVENTS.inc('dropped')
+            return False
+        return True
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _log(self, type_, message, **data):
+        if self.event_log is not None:
+            self.event_log.log(type_, message, **data)
+
+    def _run(self):
+        directory = None
+        if self.contacts_db:
+            try:
+                directory = ContactDirectory(self.contacts_db)
+            except Exception as e:
+                self._failed("Contact directory unavailable", e)
+        try:
+            while True:
+                event = self._queue.get()
+                if event is None:
+                    break
+                try:
+                    self._store_added(directory)
+                    self._dispatch(event, directory)
+                except Exception as e:
+                    self._failed("Login notification not dispatched", e)
+            self._executor.shutdown(wait=True)
+            try:
+                self._store_added(directory)
+            except Exception as e:
+                self._failed("Added contacts not stored", e)
+        finally:
+            if directory is not None:
+                directory.close()
+
+    def _failed(self, message, error):
+        self._count('errors')
+        self._log('error', message, error=f"{type(error).__name__}: {error}")
+
+    def _dispatch(self, event, directory):
+        logged_in_at, user_id, name, access_token = event
+        if not user_id and access_token:
+            user_id = decode_jwt_claims(access_token).get('sub')
+        if not user_id:
+            self._count('invalid')
+            LOGIN_EVENTS.inc('invalid')
+            self._log('error', "Login notification not sent: No user ID found")
+            return
+
+        while self._recent and next(iter(self._recent.values())) <= logged_in_at - self.window:
+            self._recent.popitem(last=False)
+        if user_id in self._recent:
+            self._count('coalesced')
+            LOGIN_EVENTS.inc('coalesced')
+            return
+        self._recent[user_id] = logged_in_at
+        self._count('notified')
+        LOGIN_EVENTS.inc('notified')
+
+        for kind in self.kinds:
+            if kind == CONTACT and self._is_known_contact(user_id, directory):
+                self._count('contacts_skipped')
+                LOGIN_NOTIFICATIONS.inc(kind, 'skipped')
+                continue
+            self._slots.acquire()
+            self._executor.submit(self._notify, kind, user_id, name, logged_in_at)
+
+    def _is_known_contact(self, user_id, directory):
+        with self._lock:
+            if user_id in self._known_contacts:
+                self._known_contacts.move_to_end(user_id)
+                return True
+        if directory is not None and directory.get(user_id) is not None:
+            with self._lock:
+                self._remember_contact(user_id)
+            return True
+        return False
+
+    def _remember_contact(self, user_id):
+        """Mark ``user_id`` known; call with the lock held"""
+        self._known_contacts[user_id] = None
+        self._known_contacts.move_to_end(user_id)
+        if len(self._known_contacts) > MAX_KNOWN_CONTACTS:
+            self._known_contacts.popitem(last=False)
+
+    def _store_added(self, directory):
+        with self._lock:
+            added, self._added = self._added, []
+        if directory is not None and added:
+            directory.upsert(added)
+
+    def _with_retries(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except KingsChatAPIError as e:
+                if not is_congestion(e.status) or attempt == self.retries:
+                    raise
+                delay = e.retry_after or RETRY_BACKOFF * 2 ** attempt
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                delay = RETRY_BACKOFF * 2 ** attempt
+            self._count('retries')
+            time.sleep(delay)
+
+    def _display_name(self, user_id):
+        try:
+            user = self.cache.get(user_id)
+        except Exception:
+            user = None
+        return (user or {}).get('name') or 'User'
+
+    def _notify(self, kind, user_id, name, logged_in_at):
+        try:
+            if kind == CONTACT:
+                response = self._with_retries(self.client.add_contact, user_id)
+                user = response.get('user') if isinstance(response, dict) else None
+                with self._lock:
+                    self._remember_contact(user_id)
+                    if isinstance(user, dict):
+                        contact = normalize_contact(user)
+                        contact['user_id'] = contact['user_id'] or user_id
+                        self._added.append(contact)
+            else:
+                template = WELCOME_MESSAGE if kind == WELCOME else LOGIN_NOTICE
+                text = template.format(
+                    name=name or self._display_name(user_id),
+                    time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged_in_at))
+                )
+                self._with_retries(self.client.send_message, user_id, text)
+        except Exception as e:
+            error = f"HTTP {e.status}" if isinstance(e, KingsChatAPIError) else \
+                f"{type(e).__name__}: {e}"
+            self._count('failed')
+            LOGIN_NOTIFICATIONS.inc(kind, 'error')
+            self._log('error', "Login notification failed", kind=kind, user_id=user_id,
+                      error=error)
+        else:
+            self._count('sent')
+            LOGIN_NOTIFICATIONS.inc(kind, 'sent')
+            self._log('success', "Login notification", kind=kind, user_id=user_id)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Send everything already queued, then stop"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._owns_cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a login surge against the mock API and compare notifying in the "
+                    "login request with the background notifier"
+    )
+    parser.add_argument('--logins', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200, help="distinct users logging in")
+    parser.add_argument('--latency', default='fixed:50', help="mock API latency spec")
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--inline-sample', type=int, default=20,
+                        help="logins timed with the calls made in the request, as the PHP does")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    from mock_server import MockKingsChatServer, parse_latency
+
+    rng = random.Random(args.seed)
+    with MockKingsChatServer(users=args.users, latency=parse_latency([args.latency])) as mock:
+        tokens = mock.state.issue_tokens()
+        user_ids = [user['user_id'] for user in mock.state.users]
+        with KingsChatClient(tokens['access_token'], mock.api_url,
+                             pool_size=args.concurrency) as client:
+            inline = []
+            for user_id in user_ids[:args.inline_sample]:
+                name = mock.state.by_id[user_id]['name']
+                started = time.perf_counter()
+                client.send_message(user_id, WELCOME_MESSAGE.format(name=name))
+                client.send_message(user_id, LOGIN_NOTICE.format(name=name, time=time.ctime()))
+                client.add_contact(user_id)
+                inline.append((time.perf_counter() - started) * 1000)
+            baseline = mock.state.stats()['requests']
+
+            notifier = LoginNotifier(client, window=args.window, concurrency=args.concurrency)
+            started = time.perf_counter()
+            for _ in range(args.logins):
+                notifier.submit(rng.choice(user_ids))
+            submit_us = (time.perf_counter() - started) * 1e6 / args.logins
+            notifier.close()
+            drained_s = time.perf_counter() - started
+
+        requests = mock.state.stats()['requests']
+        api_calls = sum(requests.values()) - sum(baseline.values())
+
+    stats = notifier.stats
+    inline_ms = sorted(inline)[len(inline) // 2] if inline else 0.0
+    print(f"Inline (in the login request): {inline_ms:.1f}ms added per login (median), "
+          f"{args.logins * len(KINDS)} API calls for {args.logins} logins")
+    print(f"Notifier: {submit_us:.1f}µs per login, {stats['notified']} notified, "
+          f"{stats['coalesced']} coalesced, {stats['dropped']} dropped, {api_calls} API calls, "
+          f"drained in {drained_s:.2f}s")
+    print(f"{'✓' if not stats['failed'] else '✗'} {stats['sent']} call(s) sent, "
+          f"{stats['failed']} failed, {stats['contacts_skipped']} contact add(s) skipped")
+    return 0 if not stats['failed'] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+KingsChat Metrics
+In-process counters, gauges and latency histograms in Prometheus text format.
+
+The API client, token manager, bulk sender and callback server record into
+one process-wide REGISTRY; any CallbackServer then serves it at /metrics.
+Recording is a dict lookup, a bisect over the bucket bounds and a few
+additions under a lock, cheap enough to leave on in every request path.
+Label values are kept low-cardinality: API paths are reduced to endpoint
+templates such as /users/:id/new_message before they are used as labels.
+
+An opt-in SamplingProfiler reads every thread's stack with
+sys._current_frames() at a fixed interval and reports the hottest stacks
+in folded form (one "frame;frame;frame count" line per stack, ready for
+flamegraph.pl or speedscope), without a debugger or a restart. A server
+started with profiling enabled serves it at /debug/profile?seconds=N.
+
+Usage:
+    python metrics.py --url http://localhost:8090                # print /metrics
+    python metrics.py --url http://localhost:8090 --profile 10   # hot stacks for 10s
+    python metrics.py --benchmark 1000000                        # recording overhead
+"""
+
+import argparse
+import bisect
+import re
+import sys
+import threading
+import time
+import urllib.request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+DEFAULT_PROFILE_SECONDS = 5
+MAX_PROFILE_SECONDS = 60
+DEFAULT_TOP_STACKS = 50
+
+_USER_PATH = re.compile(r'/users/[^/?]+')
+
+
+def endpoint_label(path):
+    """``path`` without its query string and with user ids replaced by :id"""
+    return _USER_PATH.sub('/users/:id', path.split('?', 1)[0])
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # Label value tuple -> value (or per-child state)
+        self._lock = threading.Lock()
+
+    def _labels(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labels}")
+        return ''.join(f'{name}="{_escape(value)}",'
+                       for name, value in zip(self.labelnames, labels)).rstrip(',')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:  # Copy histogram children so a concurrent observe() cannot tear them
+            items = [(labels, list(value) if isinstance(value, list) else value)
+                     for labels, value in self._values.items()]
+        items.sort(key=lambda item: tuple(map(str, item[0])))
+        for labels, value in items:
+            lines.extend(self._render_child(labels, value))
+        return lines
+
+    def _render_child(self, labels, value):
+        label_text = self._labels(labels)
+        suffix = f"{{{label_text}}}" if label_text else ''
+        return [f"{self.name}{suffix} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type_name = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from a function at scrape time"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, func, *labels):
+        """Read the value from ``func()`` at scrape time; pass None to remove it"""
+        with self._lock:
+            if func is None:
+                self._functions.pop(labels, None)
+                self._values.pop(labels, None)
+            else:
+                self._functions[labels] = func
+
+    def value(self, *labels):
+        func = self._functions.get(labels)
+        return func() if func is not None else self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        for labels, func in functions:
+            try:
+                value = func()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[labels] = value
+        return super().render()
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram with a running sum and count per label set"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._values.get(labels)
+            if child is None:
+                # Per-bucket (not yet cumulative) counts, then sum
+                child = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            child[index] += 1
+            child[-1] += value
+
+    def count(self, *labels):
+        child = self._values.get(labels)
+        return sum(child[:-1]) if child else 0
+
+    def _render_child(self, labels, child):
+        label_text = self._labels(labels)
+        prefix = label_text + ',' if label_text else ''
+        suffix = f"{{{label_text}}}" if label_text else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child[:-1]):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{prefix}le="{_format_value(float(bound))}"}} '
+                         f'{cumulative}')
+        lines.append(f"{self.name}_sum{suffix} {_format_value(child[-1])}")
+        lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Named metrics, rendered together in registration order"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.type_name}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+API_LATENCY = REGISTRY.histogram(
+    'kingschat_api_request_duration_seconds',
+    "KingsChat API request latency, including the wait for a pooled connection",
+    ('endpoint', 'method', 'status')
+)
+API_UNAUTHORIZED_RETRIES = REGISTRY.counter(
+    'kingschat_api_unauthorized_retries_total',
+    "Requests retried after a 401 and a token refresh", ('endpoint',)
+)
+TOKEN_REFRESHES = REGISTRY.counter(
+    'kingschat_token_refreshes_total',
+    "Token refreshes by outcome (refreshed, reused a newer token from disk, error)", ('result',)
+)
+TOKEN_REFRESH_LATENCY = REGISTRY.histogram(
+    'kingschat_token_refresh_duration_seconds', "Time spent in one token refresh"
+)
+SEND_QUEUE_DEPTH = REGISTRY.gauge(
+    'kingschat_send_queue_depth', "Recipients buffered in bulk_send, waiting for a worker"
+)
+SENDS_IN_FLIGHT = REGISTRY.gauge(
+    'kingschat_sends_in_flight', "Messages being sent right now (rate-limit wait included)"
+)
+CALLBACK_LATENCY = REGISTRY.histogram(
+    'kingschat_callback_request_duration_seconds',
+    "Request handling time of the local HTTP servers, by handler class",
+    ('handler', 'route', 'status')
+)
+CALLBACK_TO_TOKEN = REGISTRY.histogram(
+    'kingschat_callback_to_token_seconds',
+    "Time from opening a login session to receiving its tokens",
+    buckets=(1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+)
+CALLBACK_SESSIONS_PENDING = REGISTRY.gauge(
+    'kingschat_callback_sessions_pending', "Login sessions waiting for their callback"
+)
+LOGIN_EVENTS = REGISTRY.counter(
+    'kingschat_login_events_total',
+    "Logins handed to the notification worker (notified, coalesced, dropped, invalid)", ('result',)
+)
+LOGIN_NOTIFICATIONS = REGISTRY.counter(
+    'kingschat_login_notifications_total',
+    "Login notification calls by kind (welcome, notice, contact) and outcome", ('kind', 'result')
+)
+
+
+class SamplingProfiler:
+    """Samples every thread's Python stack and counts identical stacks.
+
+    Costs nothing until start() (or profile()) is called. Sampling runs on
+    its own daemon thread and only holds the GIL long enough to walk the
+    frames, so the profiled code keeps running at close to full speed.
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._skip = set()  # Threads not worth sampling: the sampler and whoever waits on it
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or thread_id in self._skip:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:"
+                             f"{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def profile(self, seconds):
+        """Sample for ``seconds`` (blocking, and not sampling the caller) and return self"""
+        self._skip.add(threading.get_ident())
+        self.start()
+        time.sleep(seconds)
+        self.stop()
+        self._skip.discard(threading.get_ident())
+        return self
+
+    def folded(self, top=DEFAULT_TOP_STACKS, include_idle=False):
+        """The ``top`` hottest stacks as folded-stack text, most frequent first.
+
+        Threads parked in a wait (idle pool workers, serve_forever's select)
+        are left out unless ``include_idle`` is true.
+        """
+        stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+        if not include_idle:
+            stacks = [(stack, count) for stack, count in stacks if not _is_idle(stack)]
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks[:top])
+
+
+_IDLE_FRAMES = ('wait (threading.py', 'select (selectors.py', '_worker (thread.py',
+                'get (queue.py', 'accept (socket.py')
+
+
+def _is_idle(stack):
+    leaf = stack.rsplit(';', 1)[-1]
+    return leaf.startswith(_IDLE_FRAMES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read metrics or hot stacks from a callback server")
+    parser.add_argument('--url', help="callback server base URL, e.g. http://localhost:8090")
+    parser.add_argument('--profile', type=float, metavar='SECONDS',
+                        help="fetch /debug/profile instead of /metrics")
+    parser.add_argument('--benchmark', type=int, metavar='OBSERVATIONS',
+                        help="measure the cost of recording into a labelled histogram")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        histogram = Registry().histogram('benchmark_seconds', "Benchmark", ('endpoint', 'status'))
+        started = time.perf_counter()
+        for i in range(args.benchmark):
+            histogram.observe(0.042, '/users/:id/new_message', 200)
+        per_call = (time.perf_counter() - started) * 1e6 / args.benchmark
+        print(f"{args.benchmark} observations: {per_call:.2f}µs each")
+        return 0
+    if not args.url:
+        parser.error("give --url or --benchmark")
+
+    if args.profile:
+        url = f"{args.url.rstrip('/')}/debug/profile?seconds={args.profile:g}"
+        timeout = args.profile + 10
+    else:
+        url, timeout = f"{args.url.rstrip('/')}/metrics", 10
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            sys.stdout.write(response.read().decode())
+    except OSError as e:
+        print(f"✗ {url}: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
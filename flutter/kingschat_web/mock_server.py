@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+KingsChat Mock Server
+Self-contained stand-in for accounts.kingsch.at and connect.kingsch.at.
+
+Serves the implicit-flow login redirect, oauth2/token and the API routes the
+tools use (/api/profile, GET and POST /api/contacts, /api/users?username=,
+/api/users/{id} and /api/users/{id}/new_message) from one threaded,
+keep-alive server.
+Latency per route follows a configurable distribution, and 401/429/5xx
+responses can be injected at given rates. With auto-approve the login
+redirects straight back with tokens, so no browser is needed. With
+--sign-tokens the access tokens are RS256 JWTs signed by a freshly
+generated key published at /.well-known/jwks.json.
+
+Usage:
+    python mock_server.py --port 9000 --latency lognormal:40:0.5 --fault 429=0.02 --fault 500=0.01
+
+Point the tools at it with --base-url http://localhost:9000 (or
+http://localhost:9000/api for the API client).
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer
+
+from callback_server import RoutingHandler
+from jwt_verifier import generate_keypair, sign_rs256
+
+DEFAULT_PORT = 9000
+DEFAULT_USERS = 1000
+DEFAULT_TOKEN_LIFETIME = 3600  # Seconds
+SENDER_USER_ID = "67c6d4860b20977035865f98"
+
+
+class Latency:
+    """Random delay in seconds described by a spec string.
+
+    ``fixed:MS``, ``uniform:LOW_MS:HIGH_MS``, ``normal:MEAN_MS:SD_MS`` or
+    ``lognormal:MEDIAN_MS:SIGMA``; ``none`` (or an empty spec) never delays.
+    """
+
+    def __init__(self, spec='none', rng=None):
+        self.spec = spec or 'none'
+        self._random = rng or random.Random()
+        kind, *params = self.spec.split(':')
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        expected = {'none': 0, 'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+        if kind not in expected or len(self.params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec: {spec!r}")
+
+    def sample(self):
+        if self.kind == 'none':
+            return 0.0
+        if self.kind == 'fixed':
+            ms = self.params[0]
+        elif self.kind == 'uniform':
+            ms = self._random.uniform(*self.params)
+        elif self.kind == 'normal':
+            ms = self._random.normalvariate(*self.params)
+        else:
+            ms = self.params[0] * self._random.lognormvariate(0, self.params[1])
+        return max(0.0, ms) / 1000.0
+
+
+def parse_faults(specs):
+    """Turn ['429=0.02', '500=0.01'] into {429: 0.02, 500: 0.01}"""
+    faults = {}
+    for spec in specs or []:
+        status, _, rate = spec.partition('=')
+        faults[int(status)] = float(rate)
+    return faults
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def mock_user(index):
+    """Deterministic fake KingsChat user number ``index``"""
+    return {
+        'user_id': hashlib.md5(f"user-{index}".encode()).hexdigest()[:24],
+        'username': f"user{index}",
+        'name': f"Mock User {index}",
+        'avatar_url': None,
+        'private_account': False,
+        'posts_count': index % 50,
+        'verified': index % 97 == 0
+    }
+
+
+class MockState:
+    """Users, issued tokens and request counters shared by all handler threads"""
+
+    def __init__(self, users=DEFAULT_USERS, token_lifetime=DEFAULT_TOKEN_LIFETIME,
+                 latency=None, faults=None, auto_approve=True, token_delivery='fragment',
+                 accept_any_token=False, sign_tokens=False, seed=None):
+        self.users = [mock_user(i) for i in range(users)]
+        self.by_id = {u['user_id']: u for u in self.users}
+        self.by_username = {u['username'].lower(): u for u in self.users}
+        self.sender = {'user_id': SENDER_USER_ID, 'username': 'kingsblast', 'name': 'KingsBlast'}
+        self.token_lifetime = token_lifetime
+        self.latency = latency or {}
+        self.faults = faults or {}
+        self.auto_approve = auto_approve
+        self.token_delivery = token_delivery
+        self.accept_any_token = accept_any_token
+        self.signing_key = generate_keypair() if sign_tokens else None
+        self.access_tokens = {}
+        self.refresh_tokens = set()
+        self.counters = {}
+        self.messages = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def delay_for(self, route):
+        latency = self.latency.get(route) or self.latency.get('*')
+        return latency.sample() if latency else 0.0
+
+    def pick_fault(self):
+        with self._lock:
+            roll = self._random.random()
+        for status, rate in self.faults.items():
+            if roll < rate:
+                return status
+            roll -= rate
+        return None
+
+    def issue_tokens(self):
+        """Mint a JWT-shaped access token (exp in milliseconds, like KingsChat) and a refresh token"""
+        expires_at = time.time() + self.token_lifetime
+        claims = {
+            'exp': int(expires_at * 1000), 'sub': SENDER_USER_ID, 'iss': 'kingschat',
+            'aud': ['kingschat'], 'jti': secrets.token_hex(8)
+        }
+        if self.signing_key is not None:
+            access_token = sign_rs256(claims, self.signing_key)
+        else:
+            header = _b64url(json.dumps({'alg': 'none', 'typ': 'JWT'}).encode())
+            access_token = f"{header}.{_b64url(json.dumps(claims).encode())}.mock"
+        refresh_token = secrets.token_urlsafe(24)
+        with self._lock:
+            self.access_tokens[access_token] = expires_at
+            self.refresh_tokens.add(refresh_token)
+        return {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in_millis': self.token_lifetime * 1000
+        }
+
+    def token_valid(self, token):
+        if not token:
+            return False
+        if self.accept_any_token:
+            return True
+        expires_at = self.access_tokens.get(token)
+        return expires_at is not None and expires_at > time.time()
+
+    def record_message(self, user_id):
+        with self._lock:
+            self.messages[user_id] = self.messages.get(user_id, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': dict(self.counters),
+                'messages_sent': sum(self.messages.values()),
+                'recipients': len(self.messages),
+                'tokens_issued': len(self.access_tokens)
+            }
+
+
+class MockHandler(RoutingHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = {
+        ('GET', '/'): 'handle_authorize',
+        ('GET', '/approve'): 'handle_approve',
+        ('POST', '/oauth2/token'): 'handle_token',
+        ('GET', '/api/profile'): 'handle_profile',
+        ('GET', '/api/contacts'): 'handle_contacts',
+        ('POST', '/api/contacts'): 'handle_add_contact',
+        ('GET', '/api/users'): 'handle_user_by_username',
+        ('GET', '/.well-known/jwks.json'): 'handle_jwks',
+        ('GET', '/__mock/stats'): 'handle_stats'
+    }
+    pattern_routes = [
+        ('GET', re.compile(r'/api/users/(?P<user_id>[^/]+)'), 'handle_user'),
+        ('POST', re.compile(r'/api/users/(?P<user_id>[^/]+)/new_message'), 'handle_new_message')
+    ]
+
+    @property
+    def state(self):
+        return self.server.mock_state
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(json.dumps(data), 'application/json', status, headers)
+
+    def _begin(self, route, authenticated=True):
+        """Apply latency, fault injection and auth for ``route``.
+
+        Returns False if a response has already been sent.
+        """
+        self.state.count(route)
+        delay = self.state.delay_for(route)
+        if delay:
+            time.sleep(delay)
+
+        fault = self.state.pick_fault()
+        if fault is not None:
+            self.state.count(f"fault:{fault}")
+            headers = {'Retry-After': '1'} if fault == 429 else None
+            self.send_json({'error': 'injected', 'status': fault}, status=fault, headers=headers)
+            return False
+
+        if authenticated:
+            auth = self.headers.get('Authorization', '')
+            token = auth[7:] if auth.startswith('Bearer ') else None
+            if not self.state.token_valid(token):
+                self.send_json({'error': 'unauthorized'}, status=401)
+                return False
+        return True
+
+    def _redirect_with_tokens(self, params):
+        redirect_uri = params.get('redirect_uri', [None])[0]
+        if not redirect_uri:
+            self.send_text('Missing redirect_uri', status=400)
+            return
+        values = self.state.issue_tokens()
+        values.pop('expires_in_millis')
+        state = params.get('state', [None])[0]
+        if state:
+            values['state'] = state
+        encoded = urllib.parse.urlencode(values)
+        separator = '#' if self.state.token_delivery == 'fragment' else \
+            ('&' if '?' in redirect_uri else '?')
+        self.send_response(302)
+        self.send_header('Location', f"{redirect_uri}{separator}{encoded}")
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_authorize(self):
+        if not self._begin('authorize', authenticated=False):
+            return
+        if self.state.auto_approve:
+            self._redirect_with_tokens(self.query_params)
+            return
+        approve_url = '/approve?' + self.parsed_url.query
+        self.send_html(f"""<!DOCTYPE html>
+        <html><head><title>Mock KingsChat Login</title></head>
+        <body><h1>Mock KingsChat Login</h1>
+        <p><a id="approve" href="{approve_url}">Approve</a></p></body></html>""")
+
+    def handle_approve(self):
+        self._redirect_with_tokens(self.query_params)
+
+    def handle_token(self):
+        form = urllib.parse.parse_qs(self.read_body().decode())
+        if not self._begin('token', authenticated=False):
+            return
+        if form.get('grant_type', [None])[0] != 'refresh_token':
+            self.send_json({'error': 'unsupported_grant_type'}, status=400)
+            return
+        refresh_token = form.get('refresh_token', [None])[0]
+        if not refresh_token or (refresh_token not in self.state.refresh_tokens
+                                 and not self.state.accept_any_token):
+            self.send_json({'error': 'invalid_grant'}, status=400)
+            return
+        self.send_json(self.state.issue_tokens())
+
+    def handle_profile(self):
+        if self._begin('profile'):
+            self.send_json({'profile': {'user': self.state.sender}})
+
+    def handle_contacts(self):
+        if self._begin('contacts'):
+            self.send_json({'contacts': self.state.users})
+
+    def handle_add_contact(self):
+        payload = self.read_json()
+        if not self._begin('add_contact'):
+            return
+        user_id = payload.get('user_id') if isinstance(payload, dict) else None
+        user = self.state.by_id.get(user_id)
+        if user is None:
+            self.send_json({'error': 'not_found'}, status=404)
+        else:
+            self.send_json({'user': user})
+
+    def handle_user_by_username(self):
+        if not self._begin('users'):
+            return
+        username = self.query_params.get('username', [''])[0].lower()
+        user = self.state.by_username.get(username)
+        if user is None:
+            self.send_json({'error': 'not_found'}, status=404)
+        else:
+            self.send_json(user)
+
+    def handle_user(self, user_id):
+        if not self._begin('user'):
+            return
+        user = self.state.by_id.get(user_id)
+        if user is None:
+            self.send_json({'error': 'not_found'}, status=404)
+        else:
+            self.send_json(user)
+
+    def handle_new_message(self, user_id):
+        payload = self.read_json()
+        if not self._begin('new_message'):
+            return
+        try:
+            text = payload['message']['body']['text']['body']
+        except (KeyError, TypeError):
+            text = None
+        if not isinstance(text, str):
+            self.send_json({'error': 'invalid_message'}, status=400)
+            return
+        self.state.record_message(user_id)
+        self.send_body(b'', 'application/json')
+
+    def handle_jwks(self):
+        if not self._begin('jwks', authenticated=False):
+            return
+        key = self.state.signing_key
+        self.send_json({'keys': [key.public_key().to_jwk()] if key is not None else []})
+
+    def handle_stats(self):
+        self.send_json(self.state.stats())
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class MockKingsChatServer:
+    """Run the mock on a background thread; port 0 picks a free port"""
+
+    def __init__(self, host='localhost', port=0, **state_options):
+        self.httpd = _MockHTTPServer((host, port), MockHandler)
+        self.httpd.mock_state = self.state = MockState(**state_options)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api"
+
+    @property
+    def token_url(self):
+        return f"{self.url}/oauth2/token"
+
+    @property
+    def jwks_url(self):
+        return f"{self.url}/.well-known/jwks.json"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_latency(specs):
+    """Turn ['lognormal:40:0.5', 'new_message=fixed:100'] into {route: Latency}"""
+    latency = {}
+    for spec in specs or []:
+        route, _, distribution = spec.rpartition('=')
+        latency[route or '*'] = Latency(distribution)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local KingsChat stand-in server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                        help="number of generated users/contacts")
+    parser.add_argument('--latency', action='append', metavar='[ROUTE=]SPEC',
+                        help="latency distribution, e.g. lognormal:40:0.5 or "
+                             "new_message=uniform:50:150 (repeatable)")
+    parser.add_argument('--fault', action='append', metavar='STATUS=RATE',
+                        help="inject an HTTP status at a rate, e.g. 429=0.02 (repeatable)")
+    parser.add_argument('--token-lifetime', type=int, default=DEFAULT_TOKEN_LIFETIME)
+    parser.add_argument('--token-delivery', choices=['fragment', 'query'], default='fragment',
+                        help="where the login redirect puts tokens")
+    parser.add_argument('--manual-approve', action='store_true',
+                        help="show an Approve page instead of redirecting immediately")
+    parser.add_argument('--accept-any-token', action='store_true',
+                        help="accept any bearer and refresh token, e.g. from kc_config.json")
+    parser.add_argument('--sign-tokens', action='store_true',
+                        help="issue RS256 tokens and serve their key at /.well-known/jwks.json")
+    args = parser.parse_args()
+
+    server = MockKingsChatServer(
+        args.host, args.port, users=args.users, latency=parse_latency(args.latency),
+        faults=parse_faults(args.fault), token_lifetime=args.token_lifetime,
+        auto_approve=not args.manual_approve, token_delivery=args.token_delivery,
+        accept_any_token=args.accept_any_token, sign_tokens=args.sign_tokens
+    )
+    print(f"✓ Mock KingsChat server on {server.url} (API: {server.api_url})")
+    tokens = server.state.issue_tokens()
+    print(f"Access token: {tokens['access_token']}")
+    print(f"Refresh token: {tokens['refresh_token']}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping mock server")
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
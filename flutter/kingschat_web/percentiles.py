@@ -0,0 +1,32 @@
+"""
+KingsChat Percentiles
+Nearest-rank percentiles shared by the probe, benchmark, send and log tools.
+
+percentile() works on a sorted list of samples; histogram_percentile() on
+{value: count} buckets, for callers that keep counts instead of samples so
+memory stays bounded however many values they see.
+"""
+
+import math
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def histogram_percentile(counts, pct):
+    """Nearest-rank percentile of {value: count} buckets"""
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = max(1, int(math.ceil(pct / 100.0 * total)))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+    return None
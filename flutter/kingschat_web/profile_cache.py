@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+KingsChat Profile Cache
+In-memory cache for users/{id} and users?username= lookups.
+
+Entries live in a bounded LRU with a per-entry TTL. Unknown users (404s)
+are cached too, for a shorter time, so a mistyped username is not looked
+up again on every keystroke. An entry past its TTL but still inside the
+stale window is returned at once while a background refresh fetches the
+new version (stale-while-revalidate). Concurrent lookups of the same key
+share one request, and get_many() fetches all misses of a batch in
+parallel over the client's connection pool.
+
+Usage:
+    python profile_cache.py 6811d9b00df12d54adecc0ab --repeat 3
+    python profile_cache.py --username mayowa --username pastor_chris
+"""
+
+import argparse
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from kingschat_client import API_BASE_URL, KingsChatAPIError, KingsChatClient
+from token_manager import CONFIG_FILE, TokenManager
+
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TTL = 600  # Seconds an entry is fresh
+DEFAULT_STALE_TTL = 3600  # Seconds past the TTL an entry may still be served while refreshing
+DEFAULT_NEGATIVE_TTL = 60  # Seconds a "no such user" answer is remembered
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'stale_until')
+
+    def __init__(self, value, expires_at, stale_until):
+        self.value = value
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class ProfileCache:
+    """Thread-safe LRU + TTL cache in front of KingsChatClient user lookups.
+
+    Keys are ('id', user_id) or ('username', lowercase username); a user
+    found by username is also stored under its id. Lookups return the user
+    dict, or None for users that do not exist. Other API errors are raised
+    and never cached.
+    """
+
+    def __init__(self, client, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL,
+                 stale_ttl=DEFAULT_STALE_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, max_workers=None):
+        self.client = client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {'hits': 0, 'stale_hits': 0, 'negative_hits': 0, 'misses': 0,
+                      'fetches': 0, 'refreshes': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._inflight = {}  # key -> Future shared by everyone waiting on that lookup
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or getattr(client, 'pool_size', 10),
+            thread_name_prefix='profile-cache'
+        )
+
+    @staticmethod
+    def key_for(user_id=None, username=None):
+        if username is not None:
+            return ('username', username.strip().lstrip('@').lower())
+        return ('id', user_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fetch(self, key):
+        kind, value = key
+        if kind == 'username':
+            return self.client.user_by_username(value)
+        try:
+            return self.client.user(value)
+        except KingsChatAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def _store(self, key, user, now=None):
+        now = time.time() if now is None else now
+        ttl = self.ttl if user is not None else self.negative_ttl
+        entry = _Entry(user, now + ttl, now + ttl + (self.stale_ttl if user is not None else 0))
+        with self._lock:
+            self._put(key, entry)
+            user_id = (user or {}).get('user_id') or (user or {}).get('id')
+            if key[0] == 'username' and user_id:
+                self._put(('id', user_id), entry)
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _start_fetch(self, key, refresh=False):
+        """Return the Future for ``key``, starting a fetch unless one is in flight.
+
+        Must be called with the lock held.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            return future, False
+        future = self._inflight[key] = Future()
+        self.stats['refreshes' if refresh else 'fetches'] += 1
+        return future, True
+
+    def _run_fetch(self, key, future):
+        try:
+            user = self._fetch(key)
+            self._store(key, user)
+            future.set_result(user)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _lookup(self, key, now, inline=True):
+        """(found, value, future): a usable cached value, or the Future to wait on.
+
+        A miss is fetched on the calling thread, or on the executor when
+        ``inline`` is false; stale hits are always refreshed on the executor.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.stale_until:
+                self._entries.move_to_end(key)
+                if now < entry.expires_at:
+                    self.stats['negative_hits' if entry.value is None else 'hits'] += 1
+                    return True, entry.value, None
+                self.stats['stale_hits'] += 1
+                future, started = self._start_fetch(key, refresh=True)
+                if started:
+                    self._executor.submit(self._run_fetch, key, future)
+                return True, entry.value, None
+            self.stats['misses'] += 1
+            future, started = self._start_fetch(key)
+            if started and not inline:
+                self._executor.submit(self._run_fetch, key, future)
+        if started and inline:
+            self._run_fetch(key, future)
+        return False, None, future
+
+    def get(self, user_id=None, username=None):
+        """Cached user by id or username; None if the user does not exist"""
+        found, value, future = self._lookup(self.key_for(user_id, username), time.time())
+        return value if found else future.result()
+
+    def get_many(self, keys, by='id'):
+        """Look up many ids (or usernames with ``by='username'``) at once.
+
+        Duplicates are looked up once and misses are fetched in parallel.
+        Returns {key: user}, where user is None for unknown users and the
+        exception instance for lookups that failed.
+        """
+        now = time.time()
+        results = {}
+        waiting = {}
+        for original in keys:
+            if original in results or original in waiting:
+                continue
+            key = self.key_for(username=original) if by == 'username' else self.key_for(original)
+            found, value, future = self._lookup(key, now, inline=False)
+            if found:
+                results[original] = value
+            else:
+                waiting[original] = future
+        for original, future in waiting.items():
+            try:
+                results[original] = future.result()
+            except Exception as e:
+                results[original] = e
+        return results
+
+    async def get_async(self, user_id=None, username=None):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, user_id, username)
+
+    async def get_many_async(self, keys, by='id'):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_many, list(keys), by)
+
+    def prime(self, user, username=None):
+        """Store a user found elsewhere (e.g. under another spelling of ``username``)"""
+        user_id = user.get('user_id') or user.get('id')
+        self._store(self.key_for(username=username) if username else self.key_for(user_id), user)
+
+    def invalidate(self, user_id=None, username=None):
+        with self._lock:
+            self._entries.pop(self.key_for(user_id, username), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up KingsChat users through the profile cache")
+    parser.add_argument('user_ids', nargs='*')
+    parser.add_argument('--username', action='append', default=[])
+    parser.add_argument('--repeat', type=int, default=2, help="lookup rounds, to show cache hits")
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    args = parser.parse_args()
+    if not args.user_ids and not args.username:
+        parser.error("give user ids and/or --username")
+
+    with KingsChatClient(base_url=args.base_url, token_manager=TokenManager(args.config)) as client:
+        cache = ProfileCache(client)
+        try:
+            for round_number in range(1, args.repeat + 1):
+                started = time.perf_counter()
+                results = {}
+                if args.user_ids:
+                    results.update(cache.get_many(args.user_ids))
+                if args.username:
+                    results.update(cache.get_many(args.username, by='username'))
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                print(f"Round {round_number}: {len(results)} lookup(s) in {elapsed_ms:.2f}ms")
+                if round_number == 1:
+                    for key, user in results.items():
+                        if isinstance(user, Exception):
+                            print(f"  ✗ {key}: {user}")
+                        elif user is None:
+                            print(f"  ✗ {key}: not found")
+                        else:
+                            print(f"  ✓ {key}: {user.get('name', '')} (@{user.get('username', '')})")
+            print("Cache: " + ', '.join(f"{k}={v}" for k, v in cache.stats.items()))
+        finally:
+            cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+KingsChat Rate Limiter
+One request budget for every process on the host that talks to KingsChat.
+
+The budget is a token bucket stored in a small SQLite file, so bulk runs,
+broadcasts, the send queue and the scheduler draw from the same allowance
+instead of each assuming it has the account to itself. Each acquire is a
+single short BEGIN IMMEDIATE transaction that reserves a token and returns
+how long to wait for it. From asyncio every transaction runs on one
+background thread per limiter, so a busy database (another process holding
+the write lock) never stalls the event loop.
+
+The shared rate adapts AIMD-style: a 429, a 5xx or a latency spike cuts it
+in half (at most once per cooldown, however many workers see the same
+burst of errors), and successful sends raise it by a fixed amount per
+second back towards the configured ceiling. A Retry-After pauses everyone
+until the given time. Each process also adapts its own concurrency the
+same way, so in-flight requests shrink along with the rate.
+
+Usage:
+    python bulk_send.py --recipients ids.txt --message "Hi" --rate 20 --shared-budget
+    python rate_limiter.py                 # show the shared budget
+    python rate_limiter.py --reset
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+DEFAULT_DB = os.path.join(ROOT_DIR, 'rate_limit.db')
+DEFAULT_KEY = 'kingschat'
+DEFAULT_RATE = 10.0  # Requests/sec ceiling for the whole host
+MIN_RATE = 0.5
+DECREASE_FACTOR = 0.5
+ADDITIVE_INCREASE = 1.0  # Requests/sec gained per second of healthy traffic
+DECREASE_COOLDOWN = 1.0  # Seconds between shared rate cuts
+LATENCY_SPIKE_FACTOR = 3.0  # Latency this many times the running average counts as congestion
+LATENCY_WARMUP = 20  # Samples before spikes are judged
+FLUSH_INTERVAL = 0.5  # Seconds between writes of accumulated successes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS budgets (
+    key TEXT PRIMARY KEY,
+    rate REAL NOT NULL,
+    max_rate REAL NOT NULL,
+    burst REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    last_decrease REAL NOT NULL DEFAULT 0,
+    decreases INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def is_congestion(status):
+    """429, 5xx, or no response at all (timeout, refused connection)"""
+    return status is None or status == 429 or status >= 500
+
+
+class SharedRateLimiter:
+    """Cross-process token bucket with AIMD rate and per-process AIMD concurrency.
+
+    Use acquire()/record() around each request (bulk_send does this when
+    given ``limiter=``); reserve() is the synchronous primitive for code
+    outside asyncio. acquire() awaits its reservation on the limiter's
+    database thread, and the rate updates triggered by record()/observe()
+    are queued to that thread without waiting; ``errors`` counts the ones
+    that failed. Wall-clock time is used because it is shared between
+    processes.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB, rate=DEFAULT_RATE, burst=None, key=DEFAULT_KEY,
+                 concurrency=10, min_concurrency=1):
+        self.db_path = db_path
+        self.key = key
+        self.max_rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.max_concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(concurrency)
+        self.inflight = 0
+        self._slot_freed = None
+        self._successes = 0
+        self._last_flush = time.time()
+        self._latency_avg = None
+        self._latency_samples = 0
+        self._last_local_decrease = 0.0
+        self.errors = 0
+        # One thread owns every transaction made on behalf of the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rate-limiter')
+
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.db.execute("""
+            INSERT OR IGNORE INTO budgets (key, rate, max_rate, burst, tokens, updated)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (key, self.max_rate, self.max_rate, self.burst, self.burst, time.time()))
+
+    def _transaction(self, func):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute(
+                'SELECT rate, tokens, updated, blocked_until, last_decrease FROM budgets WHERE key = ?',
+                (self.key,)
+            ).fetchone()
+            result = func(time.time(), *row)
+            self.db.execute('COMMIT')
+            return result
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def reserve(self):
+        """Reserve the next token in the shared bucket; returns seconds to wait before using it"""
+        def take(now, rate, tokens, updated, blocked_until, last_decrease):
+            start = max(now, updated)
+            tokens = min(self.burst, tokens + (start - updated) * rate) - 1
+            # A negative balance is a queue of reservations, served at the current rate
+            ready_at = max(blocked_until, start + max(0.0, -tokens) / rate)
+            self.db.execute('UPDATE budgets SET tokens = ?, updated = ? WHERE key = ?',
+                            (tokens, start, self.key))
+            return max(0.0, ready_at - now)
+        return self._transaction(take)
+
+    async def acquire(self):
+        """Wait for a concurrency slot in this process and a token in the shared budget"""
+        if self._slot_freed is None:
+            self._slot_freed = asyncio.Event()
+        while self.inflight >= int(self.concurrency):
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        self.inflight += 1
+        try:
+            wait = await asyncio.get_running_loop().run_in_executor(self._executor, self.reserve)
+            if wait:
+                await asyncio.sleep(wait)
+        except BaseException:
+            self._release()
+            raise
+
+    def _background(self, func, *args):
+        """Run ``func`` on the database thread without waiting for it"""
+        self._executor.submit(func, *args).add_done_callback(self._count_error)
+
+    def _count_error(self, future):
+        if future.exception() is not None:
+            self.errors += 1
+
+    def _release(self):
+        self.inflight = max(0, self.inflight - 1)
+        if self._slot_freed is not None:
+            self._slot_freed.set()
+
+    def record(self, result):
+        """Feed one outcome (a bulk_send.SendResult) back and free its slot"""
+        self._release()
+        self.observe(result.status, result.latency_ms, getattr(result, 'retry_after', None))
+
+    def observe(self, status, latency_ms=None, retry_after=None):
+        """Adjust the local concurrency and the shared rate for one response"""
+        spike = False
+        if latency_ms is not None and not is_congestion(status):
+            if self._latency_avg is None:
+                self._latency_avg = latency_ms
+            spike = self._latency_samples >= LATENCY_WARMUP and \
+                latency_ms > LATENCY_SPIKE_FACTOR * self._latency_avg
+            self._latency_samples += 1
+            self._latency_avg += 0.1 * (latency_ms - self._latency_avg)
+
+        if is_congestion(status) or spike or retry_after:
+            now = time.time()
+            if now - self._last_local_decrease >= DECREASE_COOLDOWN:
+                self.concurrency = max(self.min_concurrency, self.concurrency * DECREASE_FACTOR)
+                self._last_local_decrease = now
+            self._successes = 0
+            self._background(self._decrease, retry_after)
+        elif status < 400:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self._successes += 1
+            if time.time() - self._last_flush >= FLUSH_INTERVAL:
+                successes, self._successes = self._successes, 0
+                self._last_flush = time.time()
+                self._background(self._grow, successes)
+
+    def _decrease(self, retry_after):
+        def cut(now, rate, tokens, updated, blocked_until, last_decrease):
+            if retry_after:
+                blocked_until = max(blocked_until, now + retry_after)
+                # Queued reservations resume at the current rate once the block ends
+                updated = max(updated, blocked_until)
+            if now - last_decrease >= DECREASE_COOLDOWN:
+                rate = max(MIN_RATE, rate * DECREASE_FACTOR)
+                last_decrease = now
+                self.db.execute('UPDATE budgets SET decreases = decreases + 1 WHERE key = ?',
+                                (self.key,))
+            # Drop any saved-up burst so the lower rate applies at once
+            self.db.execute("""
+                UPDATE budgets SET rate = ?, tokens = MIN(tokens, 0), updated = ?,
+                                   blocked_until = ?, last_decrease = ?
+                WHERE key = ?
+            """, (rate, updated, blocked_until, last_decrease, self.key))
+        self._transaction(cut)
+
+    def flush(self):
+        """Apply the additive increase for successes seen since the last flush"""
+        successes, self._successes = self._successes, 0
+        self._last_flush = time.time()
+        self._executor.submit(self._grow, successes).result()
+
+    def _grow(self, successes):
+        if not successes:
+            return
+
+        def grow(now, rate, tokens, updated, blocked_until, last_decrease):
+            # ADDITIVE_INCREASE per second of traffic at the current rate
+            new_rate = min(self.max_rate, rate + ADDITIVE_INCREASE * successes / rate)
+            if new_rate > rate:
+                self.db.execute('UPDATE budgets SET rate = ? WHERE key = ?', (new_rate, self.key))
+        self._transaction(grow)
+
+    def state(self):
+        row = self.db.execute("""
+            SELECT rate, max_rate, burst, tokens, updated, blocked_until, decreases
+            FROM budgets WHERE key = ?
+        """, (self.key,)).fetchone()
+        keys = ('rate', 'max_rate', 'burst', 'tokens', 'updated', 'blocked_until', 'decreases')
+        return dict(zip(keys, row))
+
+    def reset(self):
+        self.db.execute("""
+            UPDATE budgets SET rate = ?, max_rate = ?, burst = ?, tokens = ?, updated = ?,
+                               blocked_until = 0, last_decrease = 0, decreases = 0
+            WHERE key = ?
+        """, (self.max_rate, self.max_rate, self.burst, self.burst, time.time(), self.key))
+
+    def close(self):
+        """Apply pending updates, then close the database"""
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or reset the shared KingsChat request budget")
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--key', default=DEFAULT_KEY)
+    parser.add_argument('--reset', action='store_true', help="restore the full rate and burst")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help="ceiling used when creating or resetting the budget")
+    parser.add_argument('--burst', type=float)
+    args = parser.parse_args()
+
+    limiter = SharedRateLimiter(args.db, args.rate, args.burst, args.key)
+    if args.reset:
+        limiter.reset()
+        print(f"✓ Budget '{args.key}' reset to {args.rate:g} req/s")
+    state = limiter.state()
+    blocked = state['blocked_until'] - time.time()
+    print(f"Budget '{args.key}': {state['rate']:.2f}/{state['max_rate']:g} req/s, "
+          f"burst {state['burst']:g}, {state['decreases']} backoff(s)"
+          + (f", blocked for {blocked:.1f}s" if blocked > 0 else ""))
+    limiter.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
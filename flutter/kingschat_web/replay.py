@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+KingsChat Traffic Replay
+Turns error.log and logs/bulk.log into a replay trace and plays it back.
+
+``extract`` reads both logs with log_analyzer's streaming parsers and writes
+a compact JSONL trace: one line per callback request or message send, with
+its offset in seconds from the start of the trace and the virtual user
+(bulk.log user, or "php" for error.log) that made it. Tokens, codes and
+user ids never enter the trace; callbacks keep only their method and
+parameter names, and recipients become small integers. Sends logged in the
+same second are spread evenly across it.
+
+``run`` starts the mock API (mock_server.py) and the OAuth callback server
+(test_oauth_flow.CallbackHandler) in-process and replays the trace
+open-loop: every event is issued at its scheduled time, divided by
+--speed, whether or not earlier ones have finished. --virtual-users plays
+that many copies of the trace side by side, each with its own recipients.
+Callbacks are sent the way they arrived: a logged POST becomes a form POST
+to /callback/<state>, a GET becomes the matching redirect.
+The report gives throughput, latency percentiles and status counts per
+operation, plus schedule lag (how late events were issued) so a saturated
+harness is not mistaken for a slow server.
+
+Usage:
+    python replay.py extract
+    python replay.py run --speed 10 --virtual-users 20
+    python replay.py run --speed 100 --virtual-users 200 --latency new_message=lognormal:40:0.5
+    python replay.py run --speed 0 --max-in-flight 50    # as fast as possible
+"""
+
+import argparse
+import asyncio
+import heapq
+import http.client
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from callback_server import CallbackServer
+from kingschat_client import AsyncKingsChatClient, KingsChatAPIError
+from log_analyzer import (BULK_LINE, BULK_LOG, BULK_SENDING, ERROR_LINE, ERROR_LOG, MONTHS,
+                          ROOT_DIR, read_lines)
+from mock_server import MockKingsChatServer, parse_faults, parse_latency
+from percentiles import percentile
+from test_oauth_flow import CallbackHandler
+
+DEFAULT_TRACE = os.path.join(ROOT_DIR, 'logs', 'replay_trace.jsonl')
+DEFAULT_SPEED = 1.0
+DEFAULT_MAX_GAP = 5.0  # Trace seconds an idle stretch is shortened to
+DEFAULT_MAX_IN_FLIGHT = 100
+REPLAY_MESSAGE = "Replayed message"
+PHP_USER = 'php'
+
+# Message response code: 200 / Welcome message retry response code: 401 /
+# send_message.php's bare "Response code: 200"
+SEND_RESPONSE_CODE = re.compile(rb'(?:.*essage (?:retry )?r|R)esponse code: (\d{3})')
+PRINT_R_KEY = re.compile(rb'\s*\[([^\]]+)\] =>')
+
+
+def _error_timestamp(match):
+    day, month, year, hour, minute, second = match.group(1, 2, 3, 4, 5, 6)
+    return time.mktime((int(year), MONTHS.get(month, 1), int(day),
+                        int(hour), int(minute), int(second), 0, 0, -1))
+
+
+def _bulk_timestamp(match):
+    return time.mktime(tuple(map(int, match.group(1, 2, 3, 4, 5, 6))) + (0, 0, -1))
+
+
+def _body_fields(raw):
+    """Parameter names of a logged request body, JSON or form-encoded"""
+    raw = raw.strip()
+    try:
+        body = json.loads(raw)
+        return set(body) if isinstance(body, dict) else set()
+    except ValueError:
+        return set(urllib.parse.parse_qs(raw.decode(errors='replace'), keep_blank_values=True))
+
+
+class TraceExtractor:
+    """Collects trace events from the logs; recipients are numbered as first seen.
+
+    error.log holds two callback formats: callback_enhanced.php's
+    ``=== CALLBACK DEBUG START`` block with REQUEST_* lines, and
+    callback.php's ``Callback.php started`` followed by print_r dumps of
+    the POST and GET data and the raw body. Some callback.php requests were
+    logged from ``Raw input data:`` on, so that line starts a callback of
+    its own when the current one already has a body.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.recipients = {}
+        self._callback = None  # Callback request being read from error.log
+        self._has_body = False  # Whether its raw body has been seen
+        self._print_r = None  # Which print_r dump continuation lines belong to
+
+    def _recipient(self, recipient_id):
+        return self.recipients.setdefault(recipient_id, len(self.recipients))
+
+    def feed_bulk(self, line):
+        match = BULK_LINE.match(line)
+        if match is None:
+            return
+        message = match.group(9)
+        if message.startswith(b'Sending message'):
+            sending = BULK_SENDING.match(message)
+            if sending:
+                self.events.append({'t': _bulk_timestamp(match), 'vu': match.group(8).decode(),
+                                    'op': 'send', 'to': self._recipient(sending.group(3))})
+
+    def feed_error(self, line):
+        if not line.startswith(b'['):
+            if self._callback is not None and self._print_r is not None:
+                key = PRINT_R_KEY.match(line)
+                if key:
+                    self._add_fields(self._print_r, [key.group(1).decode(errors='replace')])
+            return
+        match = ERROR_LINE.match(line)
+        if match is None:
+            return
+        message = match.group(7)
+        self._print_r = None
+
+        if message.startswith((b'=== CALLBACK DEBUG START', b'Callback.php started')):
+            self._start_callback(match)
+        elif self._callback is not None and message.startswith(b'REQUEST_'):
+            name, _, value = message.decode(errors='replace').partition(': ')
+            if name == 'REQUEST_METHOD':
+                self._callback['method'] = value.strip()
+            elif name == 'REQUEST_URI':
+                query = urllib.parse.urlparse(value.strip()).query
+                self._callback['query'] = sorted(urllib.parse.parse_qs(query))
+        elif self._callback is not None and message.startswith(b'POST data:'):
+            self._print_r = 'post'
+        elif self._callback is not None and message.startswith(b'GET data:'):
+            self._print_r = 'query'
+        elif message.startswith(b'Raw input data:'):
+            if self._callback is None or self._has_body:
+                self._start_callback(match)
+            self._has_body = True
+            self._add_fields('post', _body_fields(message.partition(b':')[2]))
+        elif b'esponse code' in message:
+            code = SEND_RESPONSE_CODE.match(message)
+            if code:
+                self.events.append({'t': _error_timestamp(match), 'vu': PHP_USER, 'op': 'send',
+                                    'to': None, 'status': int(code.group(1))})
+
+    def _start_callback(self, match):
+        self._callback = {'t': _error_timestamp(match), 'vu': PHP_USER, 'op': 'callback',
+                          'method': 'GET', 'query': [], 'post': []}
+        self._has_body = False
+        self.events.append(self._callback)
+
+    def _add_fields(self, part, names):
+        if not names:
+            return
+        self._callback[part] = sorted(set(self._callback[part]) | set(names))
+        if part == 'post':
+            self._callback['method'] = 'POST'
+
+    def trace(self):
+        """The events sorted by time, as offsets from the first, with seconds spread out"""
+        events = sorted(self.events, key=lambda e: e['t'])
+        if not events:
+            return []
+        origin = events[0]['t']
+        start = 0
+        while start < len(events):
+            end = start
+            while end < len(events) and events[end]['t'] == events[start]['t']:
+                end += 1
+            for i in range(start, end):
+                events[i]['t'] = round(events[i]['t'] - origin + (i - start) / (end - start), 3)
+            start = end
+        next_recipient = len(self.recipients)
+        for event in events:
+            if event['op'] == 'callback' and not event['post']:
+                del event['post']
+            if event['op'] == 'send' and event['to'] is None:
+                # error.log does not name recipients; give each send its own
+                event['to'] = next_recipient
+                next_recipient += 1
+        return events
+
+
+def extract(error_log=ERROR_LOG, bulk_log=BULK_LOG):
+    extractor = TraceExtractor()
+    sources = []
+    if bulk_log and os.path.exists(bulk_log):
+        sources.append(bulk_log)
+        for line, _ in read_lines(bulk_log):
+            extractor.feed_bulk(line)
+    if error_log and os.path.exists(error_log):
+        sources.append(error_log)
+        for line, _ in read_lines(error_log):
+            extractor.feed_error(line)
+    return extractor.trace(), sources
+
+
+def write_trace(events, path, sources=()):
+    with open(path, 'w') as f:
+        header = {'trace': 1, 'sources': [os.path.basename(s) for s in sources],
+                  'events': len(events), 'duration_s': events[-1]['t'] if events else 0}
+        f.write(json.dumps(header) + '\n')
+        for event in events:
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def read_trace(path):
+    """(header, events) from a trace file"""
+    with open(path) as f:
+        header = json.loads(f.readline())
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def compress_gaps(events, max_gap):
+    """Yield events with idle stretches longer than ``max_gap`` shortened to it"""
+    shift = 0.0
+    previous = None
+    for event in events:
+        if previous is not None and max_gap and event['t'] - previous > max_gap:
+            shift += event['t'] - previous - max_gap
+        previous = event['t']
+        yield event['t'] - shift, event
+
+
+def schedule(events, virtual_users=1, stagger=0.0, max_gap=DEFAULT_MAX_GAP):
+    """Yield (trace_time, copy, event) for ``virtual_users`` copies of the trace, in time order"""
+    compressed = list(compress_gaps(events, max_gap))
+
+    def copy(index):
+        for t, event in compressed:
+            yield t + index * stagger, index, event
+    return heapq.merge(*(copy(i) for i in range(virtual_users)), key=lambda item: item[0])
+
+
+class OperationStats:
+    def __init__(self):
+        self.latencies = []
+        self.lags = []
+        self.statuses = {}
+
+    def add(self, status, latency_ms, lag_ms):
+        self.latencies.append(latency_ms)
+        self.lags.append(lag_ms)
+        key = str(status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def as_dict(self, elapsed):
+        latencies = sorted(self.latencies)
+        lags = sorted(self.lags)
+        ok = sum(count for status, count in self.statuses.items() if status.startswith('2'))
+        return {
+            'requests': len(latencies),
+            'ok': ok,
+            'statuses': self.statuses,
+            'per_s': len(latencies) / elapsed if elapsed else None,
+            'latency_ms': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                           'p99': percentile(latencies, 99),
+                           'max': latencies[-1] if latencies else None},
+            'lag_ms': {'p95': percentile(lags, 95), 'max': lags[-1] if lags else None}
+        }
+
+
+class Replayer:
+    """Plays a trace against a mock API client and a callback server"""
+
+    def __init__(self, client, users, callback_server, access_token, max_in_flight):
+        self.client = client
+        self.users = users
+        self.callback_server = callback_server
+        self.access_token = access_token
+        self.max_in_flight = max_in_flight
+        self.stats = {}
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight,
+                                            thread_name_prefix='replay-callback')
+
+    def _recipient(self, copy, index):
+        return self.users[(copy * 7919 + index) % len(self.users)]['user_id']
+
+    async def _send(self, copy, event):
+        try:
+            await self.client.send_message(self._recipient(copy, event['to']), REPLAY_MESSAGE)
+            return 200
+        except KingsChatAPIError as e:
+            return e.status
+        except Exception as e:
+            return type(e).__name__
+
+    def _callback_request(self, event):
+        """(session, method, path, body) for the request a browser made for a logged callback"""
+        session = self.callback_server.open_session()
+        if event.get('method') == 'POST':
+            # The provider's post_redirect: a form POST, with the state in the redirect_uri
+            values = {'accessToken': self.access_token, 'access_token': self.access_token,
+                      'refreshToken': 'replay-refresh-token',
+                      'refresh_token': 'replay-refresh-token', 'error': 'access_denied'}
+            form = {name: values.get(name, 'replay') for name in event.get('post', [])}
+            return (session, 'POST', f"/callback/{session.state}",
+                    urllib.parse.urlencode(form).encode())
+
+        params = {'state': session.state}
+        fields = set(event.get('query', []))
+        if fields & {'access_token', 'accessToken'}:
+            path = '/callback' if 'access_token' in fields else '/token_callback'
+            params.update(access_token=self.access_token, refresh_token='replay-refresh-token')
+        elif 'code' in fields:
+            path = '/callback'
+            params['code'] = 'replay-code'
+        elif 'error' in fields:
+            path = '/callback'
+            params['error'] = 'access_denied'
+        else:
+            path = '/callback'  # Implicit flow: the page is fetched, tokens stay in the fragment
+        return session, 'GET', f"{path}?{urllib.parse.urlencode(params)}", None
+
+    def _callback(self, event):
+        session, method, path, body = self._callback_request(event)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else {}
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                *self.callback_server.httpd.server_address[:2], timeout=10
+            )
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self._local.conn = None
+            return type(e).__name__
+        finally:
+            self.callback_server.broker.close(session.state)
+
+    async def _run_one(self, copy, event, lag_ms):
+        started = time.perf_counter()
+        if event['op'] == 'send':
+            status = await self._send(copy, event)
+        else:
+            loop = asyncio.get_running_loop()
+            status = await loop.run_in_executor(self._executor, self._callback, event)
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.stats.setdefault(event['op'], OperationStats()).add(status, latency_ms, lag_ms)
+
+    async def replay(self, events, speed=DEFAULT_SPEED, virtual_users=1, stagger=0.0,
+                     max_gap=DEFAULT_MAX_GAP):
+        """Issue every scheduled event (open-loop unless ``speed`` is 0); returns elapsed seconds"""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        started = loop.time()
+
+        async def run(copy, event, lag_ms):
+            try:
+                await self._run_one(copy, event, lag_ms)
+            finally:
+                slots.release()
+
+        for t, copy, event in schedule(events, virtual_users, stagger, max_gap):
+            due = started + t / speed if speed else None
+            if due is not None and due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            await slots.acquire()
+            lag_ms = max(0.0, loop.time() - due) * 1000 if due is not None else 0.0
+            task = asyncio.create_task(run(copy, event, lag_ms))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        return loop.time() - started
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def run_replay(args):
+    header, events = read_trace(args.trace)
+    if args.only:
+        events = [e for e in events if e['op'] == args.only]
+    print(f"Trace: {len(events)} events over {header.get('duration_s', 0):.0f}s "
+          f"from {', '.join(header.get('sources', [])) or '-'}")
+
+    with MockKingsChatServer(latency=parse_latency(args.latency), faults=parse_faults(args.fault),
+                             accept_any_token=True) as mock, \
+            CallbackServer(CallbackHandler, port=0) as server:
+        tokens = mock.state.issue_tokens()
+        client = AsyncKingsChatClient(tokens['access_token'], mock.api_url,
+                                      pool_size=args.max_in_flight)
+        replayer = Replayer(client, mock.state.users, server, tokens['access_token'],
+                            args.max_in_flight)
+        try:
+            elapsed = await replayer.replay(events, args.speed, args.virtual_users, args.stagger,
+                                            args.max_gap)
+        finally:
+            await client.close()
+            replayer.close()
+
+    total = sum(len(s.latencies) for s in replayer.stats.values())
+    report = {
+        'speed': args.speed,
+        'virtual_users': args.virtual_users,
+        'events': total,
+        'elapsed_s': elapsed,
+        'events_per_s': total / elapsed if elapsed else None,
+        'operations': {op: stats.as_dict(elapsed) for op, stats in sorted(replayer.stats.items())}
+    }
+    return report
+
+
+def print_report(report):
+    speed = f"{report['speed']:g}×" if report['speed'] else 'max speed'
+    print(f"\n=== Replay at {speed}, {report['virtual_users']} virtual user(s) ===")
+    print(f"{report['events']} events in {report['elapsed_s']:.2f}s "
+          f"({report['events_per_s'] or 0:.1f}/s)")
+    for op, stats in report['operations'].items():
+        latency, lag = stats['latency_ms'], stats['lag_ms']
+        mark = '✓' if stats['ok'] == stats['requests'] else '✗'
+        print(f"{mark} {op:<9} {stats['ok']}/{stats['requests']} ok, {stats['per_s'] or 0:.1f}/s, "
+              f"p50 {latency['p50']:.1f}ms, p95 {latency['p95']:.1f}ms, "
+              f"p99 {latency['p99']:.1f}ms, max {latency['max']:.1f}ms, "
+              f"lag p95 {lag['p95']:.1f}ms")
+        if stats['ok'] != stats['requests']:
+            print(f"  statuses: {stats['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract and replay KingsChat traffic traces")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = subparsers.add_parser('extract', help="build a trace from the logs")
+    extract_parser.add_argument('--error-log', default=ERROR_LOG)
+    extract_parser.add_argument('--bulk-log', default=BULK_LOG)
+    extract_parser.add_argument('-o', '--output', default=DEFAULT_TRACE)
+
+    run_parser = subparsers.add_parser('run', help="replay a trace against the local stand-ins")
+    run_parser.add_argument('trace', nargs='?', default=DEFAULT_TRACE)
+    run_parser.add_argument('--speed', type=float, default=DEFAULT_SPEED,
+                            help="time acceleration, e.g. 1, 10 or 100; 0 for as fast as possible")
+    run_parser.add_argument('--virtual-users', type=int, default=1,
+                            help="copies of the trace played side by side")
+    run_parser.add_argument('--stagger', type=float, default=0.0,
+                            help="trace seconds between the start of consecutive copies")
+    run_parser.add_argument('--max-gap', type=float, default=DEFAULT_MAX_GAP,
+                            help="shorten idle stretches in the trace to this many seconds "
+                                 "(0 keeps them)")
+    run_parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    run_parser.add_argument('--only', choices=['send', 'callback'])
+    run_parser.add_argument('--latency', action='append', metavar='[ROUTE=]SPEC',
+                            help="mock latency, e.g. new_message=lognormal:40:0.5 (repeatable)")
+    run_parser.add_argument('--fault', action='append', metavar='STATUS=RATE',
+                            help="mock error rate, e.g. 429=0.01 (repeatable)")
+    run_parser.add_argument('--json', dest='json_path', metavar='PATH')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        events, sources = extract(args.error_log, args.bulk_log)
+        if not sources:
+            print("✗ Neither log file exists")
+            return 1
+        write_trace(events, args.output, sources)
+        counts = {}
+        for event in events:
+            counts[event['op']] = counts.get(event['op'], 0) + 1
+        print(f"✓ {len(events)} events ({', '.join(f'{k}={v}' for k, v in counts.items())}) "
+              f"from {', '.join(sources)} written to {args.output}")
+        return 0
+
+    report = asyncio.run(run_replay(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    failed = sum(s['requests'] - s['ok'] for s in report['operations'].values())
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
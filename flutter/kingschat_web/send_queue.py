@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+KingsChat Send Queue
+Durable, resumable queue for long broadcasts, backed by SQLite in WAL mode.
+
+Each (campaign, recipient) pair is stored once, so enqueueing the same list
+twice is a no-op. Workers lease jobs in batches and commit each batch as
+'sending' in one transaction before any of its messages go out; a lease
+that is not turned into 'sending' (because the process died in between)
+expires and the job is handed out again. 'sending' jobs are never leased
+again, so a crash cannot cause a resend: the batch a worker was on at the
+crash stays 'sending' (outcome unknown) until an operator releases it with
+`run --reclaim --resend-unknown`. Results are written back in batched
+transactions, and only by the worker that still owns the job.
+
+Usage:
+    python send_queue.py create launch --message "Hello" --recipients ids.txt
+    python send_queue.py run launch --concurrency 20 --rate 10
+    python send_queue.py status launch
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk_send import DryRunSender, bulk_send, read_recipients, shared_limiter
+from kingschat_client import API_BASE_URL, AsyncKingsChatClient
+from token_manager import CONFIG_FILE, TOKEN_URL, TokenManager
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+DEFAULT_DB = os.path.join(ROOT_DIR, 'send_queue.db')
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+INSERT_BATCH = 5000
+FLUSH_BATCH = 200
+FLUSH_INTERVAL = 1.0  # Seconds between result flushes when sends are slow
+
+PENDING, LEASED, SENDING, SENT, FAILED = 'pending', 'leased', 'sending', 'sent', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    id TEXT PRIMARY KEY,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    campaign_id TEXT NOT NULL REFERENCES campaigns(id),
+    recipient_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_status INTEGER,
+    last_error TEXT,
+    updated_at REAL,
+    UNIQUE (campaign_id, recipient_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs(campaign_id, status, id);
+"""
+
+
+class SendQueue:
+    """SQLite-backed job store.
+
+    Use one instance per worker, from one thread at a time (run_campaign
+    hands it to its database thread while it runs).
+    """
+
+    def __init__(self, db_path=DEFAULT_DB, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def _transaction(self):
+        return _Transaction(self.db)
+
+    def create_campaign(self, campaign_id, message):
+        with self._transaction():
+            self.db.execute(
+                'INSERT OR IGNORE INTO campaigns (id, message, created_at) VALUES (?, ?, ?)',
+                (campaign_id, message, time.time())
+            )
+
+    def campaign_message(self, campaign_id):
+        row = self.db.execute('SELECT message FROM campaigns WHERE id = ?', (campaign_id,)).fetchone()
+        return row[0] if row else None
+
+    def enqueue(self, campaign_id, recipients, batch_size=INSERT_BATCH):
+        """Add recipients (any iterable) in batched inserts; duplicates are ignored.
+
+        Returns the number of new jobs.
+        """
+        added = 0
+        batch = []
+        for recipient_id in recipients:
+            batch.append((campaign_id, recipient_id))
+            if len(batch) >= batch_size:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        return added
+
+    def _insert(self, batch):
+        with self._transaction():
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO jobs (campaign_id, recipient_id) VALUES (?, ?)', batch
+            )
+            return self.db.total_changes - before
+
+    def lease(self, campaign_id, owner, limit=100, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Claim up to ``limit`` pending (or abandoned) jobs for ``owner``.
+
+        Returns a list of (job_id, recipient_id).
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self.db.execute("""
+                UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?,
+                                attempts = attempts + 1, updated_at = ?
+                WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE campaign_id = ? AND (
+                        status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                    )
+                    ORDER BY id LIMIT ?
+                )
+                RETURNING id, recipient_id
+            """, (owner, now + lease_seconds, now, campaign_id, now, limit)).fetchall()
+        rows.sort()
+        return rows
+
+    def mark_sending(self, job_ids, owner):
+        """Commit leased jobs as 'sending' in one transaction, before their messages go out.
+
+        Returns the set of ids that were marked. Jobs ``owner`` no longer
+        holds (the lease expired and another worker took them) are left
+        alone and must not be sent.
+        """
+        now = time.time()
+        with self._transaction():
+            return {job_id for job_id in job_ids if self.db.execute("""
+                UPDATE jobs SET status = 'sending', lease_expires = NULL, updated_at = ?
+                WHERE id = ? AND status = 'leased' AND lease_owner = ? AND lease_expires >= ?
+            """, (now, job_id, owner, now)).rowcount}
+
+    def complete(self, results, owner):
+        """Record outcomes in one transaction.
+
+        ``results`` holds (job_id, ok, status, error) tuples. Only jobs
+        ``owner`` still holds are updated. Failed jobs go back to pending
+        until they have used up ``max_attempts``.
+        """
+        now = time.time()
+        sent = [(status, now, job_id, owner) for job_id, ok, status, _ in results if ok]
+        failed = [(self.max_attempts, status, error, now, job_id, owner)
+                  for job_id, ok, status, error in results if not ok]
+        with self._transaction():
+            self.db.executemany("""
+                UPDATE jobs SET status = 'sent', lease_owner = NULL, lease_expires = NULL,
+                                last_status = ?, last_error = NULL, updated_at = ?
+                WHERE id = ? AND lease_owner = ?
+            """, sent)
+            self.db.executemany("""
+                UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                lease_owner = NULL, lease_expires = NULL,
+                                last_status = ?, last_error = ?, updated_at = ?
+                WHERE id = ? AND lease_owner = ?
+            """, failed)
+
+    def release(self, campaign_id, owner=None, include_sending=False):
+        """Return leased jobs to pending right away (e.g. after a known crash).
+
+        With ``include_sending``, jobs whose send was interrupted (outcome
+        unknown) are released too, and may then be sent a second time.
+        """
+        statuses = "('leased', 'sending')" if include_sending else "('leased')"
+        query = "UPDATE jobs SET status = 'pending', lease_owner = NULL, lease_expires = NULL " \
+                f"WHERE campaign_id = ? AND status IN {statuses}"
+        params = [campaign_id]
+        if owner:
+            query += ' AND lease_owner = ?'
+            params.append(owner)
+        with self._transaction():
+            return self.db.execute(query, params).rowcount
+
+    def stats(self, campaign_id):
+        counts = dict(self.db.execute(
+            'SELECT status, COUNT(*) FROM jobs WHERE campaign_id = ? GROUP BY status', (campaign_id,)
+        ))
+        return {status: counts.get(status, 0)
+                for status in (PENDING, LEASED, SENDING, SENT, FAILED)}
+
+    def close(self):
+        self.db.close()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, so concurrent workers serialize on the write lock"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, *exc_info):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def run_campaign(queue, campaign_id, sender, concurrency=10, rate=None, burst=None,
+                       owner=None, lease_seconds=DEFAULT_LEASE_SECONDS, on_result=None,
+                       limiter=None):
+    """Send every outstanding job of a campaign; returns the number of results recorded.
+
+    Jobs are leased ``2 * concurrency`` at a time as the send pipeline asks
+    for more, and each batch is committed as 'sending' in one transaction
+    before it is handed to the senders. Outcomes are flushed every
+    FLUSH_BATCH results or FLUSH_INTERVAL seconds. Every database call runs
+    on one worker thread, so a write lock held by another process never
+    stalls the sends in flight.
+    """
+    owner = owner or default_owner()
+    message = queue.campaign_message(campaign_id)
+    if message is None:
+        raise KeyError(f"Unknown campaign: {campaign_id}")
+    loop = asyncio.get_running_loop()
+    database = ThreadPoolExecutor(max_workers=1, thread_name_prefix='send-queue')
+    job_ids = {}
+
+    def in_database(func, *args):
+        return loop.run_in_executor(database, func, *args)
+
+    async def claimed_recipients():
+        while True:
+            jobs = await in_database(queue.lease, campaign_id, owner, concurrency * 2,
+                                     lease_seconds)
+            if not jobs:
+                return
+            sending = await in_database(queue.mark_sending, [job_id for job_id, _ in jobs], owner)
+            for job_id, recipient_id in jobs:
+                if job_id in sending:
+                    job_ids[recipient_id] = job_id
+                    yield recipient_id
+
+    buffered = []
+    recorded = 0
+    last_flush = time.monotonic()
+    try:
+        async for result in bulk_send(sender, claimed_recipients(), message, concurrency, rate,
+                                      burst, limiter):
+            buffered.append((job_ids.pop(result.recipient_id), result.ok, result.status,
+                             result.error))
+            if on_result is not None:
+                on_result(result)
+            if len(buffered) >= FLUSH_BATCH or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                await in_database(queue.complete, buffered, owner)
+                recorded += len(buffered)
+                buffered = []
+                last_flush = time.monotonic()
+        if buffered:
+            await in_database(queue.complete, buffered, owner)
+            recorded += len(buffered)
+    finally:
+        database.shutdown(wait=True)
+    return recorded
+
+
+def print_stats(campaign_id, stats):
+    total = sum(stats.values())
+    print(f"Campaign {campaign_id}: {stats[SENT]}/{total} sent, {stats[PENDING]} pending, "
+          f"{stats[LEASED]} leased, {stats[SENDING]} sending, {stats[FAILED]} failed")
+
+
+async def run(args, queue):
+    if args.dry_run:
+        sender = DryRunSender(args.dry_run_latency, args.dry_run_failure_rate)
+    else:
+        sender = AsyncKingsChatClient(base_url=args.base_url, pool_size=args.concurrency,
+                                      token_manager=TokenManager(args.config,
+                                                                 token_url=args.token_url))
+    started = time.perf_counter()
+
+    def report(result):
+        if not result.ok:
+            print(f"✗ {result.recipient_id} {result.status or ''} {result.error or ''}")
+
+    limiter = shared_limiter(args)
+    try:
+        recorded = await run_campaign(queue, args.campaign, sender, args.concurrency, args.rate,
+                                      args.burst, lease_seconds=args.lease_seconds,
+                                      on_result=report, limiter=limiter)
+    finally:
+        await sender.close()
+        if limiter is not None:
+            limiter.close()
+    elapsed = time.perf_counter() - started
+    print(f"Processed {recorded} job(s) in {elapsed:.2f}s "
+          f"({recorded / elapsed if elapsed else 0:.1f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Durable, resumable KingsChat broadcast queue")
+    parser.add_argument('--db', default=DEFAULT_DB)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = subparsers.add_parser('create', help="create a campaign and enqueue recipients")
+    create_parser.add_argument('campaign')
+    create_parser.add_argument('--message', required=True)
+    create_parser.add_argument('--recipients', required=True,
+                               help="file with one user id per line ('-' for stdin)")
+
+    run_parser = subparsers.add_parser('run', help="send outstanding jobs of a campaign")
+    run_parser.add_argument('campaign')
+    run_parser.add_argument('--concurrency', type=int, default=10)
+    run_parser.add_argument('--rate', type=float, help="maximum messages per second")
+    run_parser.add_argument('--burst', type=int)
+    run_parser.add_argument('--shared-budget', action='store_true',
+                            help="share --rate with other processes and back off on 429/5xx")
+    run_parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS)
+    run_parser.add_argument('--reclaim', action='store_true',
+                            help="release every lease first (only when no other worker runs)")
+    run_parser.add_argument('--resend-unknown', action='store_true',
+                            help="with --reclaim, also release jobs whose send was interrupted; "
+                                 "these may be delivered twice")
+    run_parser.add_argument('--base-url', default=API_BASE_URL)
+    run_parser.add_argument('--token-url', default=TOKEN_URL)
+    run_parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    run_parser.add_argument('--dry-run', action='store_true')
+    run_parser.add_argument('--dry-run-latency', type=float, default=80)
+    run_parser.add_argument('--dry-run-failure-rate', type=float, default=0.0)
+
+    status_parser = subparsers.add_parser('status', help="show job counts")
+    status_parser.add_argument('campaign')
+    args = parser.parse_args()
+
+    queue = SendQueue(args.db)
+    try:
+        if args.command == 'create':
+            queue.create_campaign(args.campaign, args.message)
+            added = queue.enqueue(args.campaign, read_recipients(args.recipients))
+            print(f"✓ Enqueued {added} new recipient(s)")
+        elif args.command == 'run':
+            if args.reclaim:
+                released = queue.release(args.campaign, include_sending=args.resend_unknown)
+                print(f"Released {released} lease(s)")
+            asyncio.run(run(args, queue))
+        stats = queue.stats(args.campaign)
+        print_stats(args.campaign, stats)
+    finally:
+        queue.close()
+    return 0 if not stats[FAILED] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
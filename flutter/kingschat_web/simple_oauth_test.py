@@ -4,38 +4,36 @@ Simple KingsChat OAuth Test (No external dependencies)
 This script helps debug the OAuth flow and token extraction
 """
 
-import urllib.parse
+import sys
 import webbrowser
-import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-import time
 
-# Configuration (matching your Flutter app)
-CLIENT_ID = "619b30ea-a682-47fb-b90f-5b8e780b89ca"
-AUTH_URL = "https://accounts.kingsch.at"
-SCOPES = ["kingschat"]
-REDIRECT_URI = "http://localhost:8090/callback"
+from callback_server import CallbackServer
+from kingschat.config import REDIRECT_URI
+from structured_log import StructuredLogger
+from test_oauth_flow import EVENT_LOG, build_oauth_url
+from test_oauth_flow import CallbackHandler as OAuthCallbackHandler
 
-# Global variables
-callback_received = False
-callback_data = {}
+CALLBACK_TIMEOUT = 300  # Seconds to wait for the browser to finish the login
 
-class CallbackHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global callback_received, callback_data
-        
-        print(f"\n=== OAUTH CALLBACK RECEIVED ===")
-        print(f"Full path: {self.path}")
-        print(f"Complete URL: http://localhost:8090{self.path}")
-        
+class CallbackHandler(OAuthCallbackHandler):
+    """test_oauth_flow's handler with a callback page that shows its analysis"""
+
+    def handle_callback(self, state=None):
         # Parse the URL
-        parsed_url = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
+        parsed_url = self.parsed_url
+        query_params = self.query_params
         
-        print(f"Query string: {parsed_url.query}")
-        print(f"Query parameters: {query_params}")
-        print(f"Fragment: {parsed_url.fragment}")
+        # Token values are cut short; the full ones only go to the session
+        self.log_event('info', "=== OAUTH CALLBACK RECEIVED ===", path=parsed_url.path,
+                       query_params={k: [f"{v[:20]}..." for v in values]
+                                     for k, values in query_params.items()},
+                       fragment=bool(parsed_url.fragment))
+        
+        session = self.resolve_session(state)
+        if session is None:
+            self.log_event('error', "✗ Callback does not match any pending login "
+                                    "(unknown or expired state)")
+            return
         
         # Store callback data
         callback_data = {
@@ -44,6 +42,11 @@ class CallbackHandler(BaseHTTPRequestHandler):
             'query_params': query_params,
             'fragment': parsed_url.fragment
         }
+        if 'access_token' in query_params:
+            session.complete(callback_data=callback_data)
+        else:
+            # Tokens are in the fragment; wait for the page to report back
+            session.record(callback_data=callback_data)
         
         # Create response HTML with JavaScript to extract fragment
         html_response = """
@@ -104,12 +107,14 @@ class CallbackHandler(BaseHTTPRequestHandler):
                 let accessToken = null;
                 let refreshToken = null;
                 let tokenSource = 'none';
+                let state = new URLSearchParams(search).get('state') || '';
                 
                 // Check fragment (hash) first - common for implicit flow
                 if (hash && hash.length > 1) {
                     const hashParams = new URLSearchParams(hash.substring(1));
                     accessToken = hashParams.get('access_token');
                     refreshToken = hashParams.get('refresh_token');
+                    state = hashParams.get('state') || state;
                     if (accessToken) tokenSource = 'fragment';
                     
                     console.log('Fragment params:', Object.fromEntries(hashParams));
@@ -162,7 +167,7 @@ class CallbackHandler(BaseHTTPRequestHandler):
                 
                 // Try to send to Python server (ignore errors)
                 try {
-                    fetch('/debug', {
+                    fetch('/debug?state=' + encodeURIComponent(state), {
                         method: 'POST',
                         headers: {'Content-Type': 'application/json'},
                         body: JSON.stringify(debugInfo)
@@ -175,61 +180,46 @@ class CallbackHandler(BaseHTTPRequestHandler):
         </html>
         """
         
-        # Send response
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html')
-        self.end_headers()
-        self.wfile.write(html_response.encode())
-        
-        callback_received = True
-    
-    def do_POST(self):
-        if self.path == '/debug':
-            # Read debug info from JavaScript
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            try:
-                debug_info = json.loads(post_data.decode())
-                print(f"\n=== DEBUG INFO FROM JAVASCRIPT ===")
-                for key, value in debug_info.items():
-                    print(f"{key}: {value}")
-            except:
-                pass
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
-    
-    def log_message(self, format, *args):
-        pass  # Suppress server logs
+        self.send_html(html_response)
 
-def build_oauth_url():
-    """Build the OAuth URL matching your Flutter app"""
-    params = {
-        'client_id': CLIENT_ID,
-        'scopes': json.dumps(SCOPES),
-        'redirect_uri': REDIRECT_URI,
-        'response_type': 'token',  # Implicit flow
-        'post_redirect': 'true'
-    }
-    
-    query_string = urllib.parse.urlencode(params)
-    return f"{AUTH_URL}/?{query_string}"
+    def handle_form_callback(self, state=None):
+        form = self.read_form()
+        self.log_event('info', "=== OAUTH CALLBACK POST RECEIVED ===", path=self.parsed_url.path,
+                       form={k: [f"{v[:20]}..." for v in values] for k, values in form.items()})
+
+        session = self.resolve_session(state)
+        if session is None:
+            self.log_event('error', "✗ Callback does not match any pending login "
+                                    "(unknown or expired state)")
+            return
+
+        access_token, refresh_token = self.form_tokens(form)
+        session.complete(callback_data={'path': self.path, 'method': 'POST',
+                                        'form_keys': sorted(form)},
+                         access_token=access_token, refresh_token=refresh_token)
+        if access_token:
+            self.notify_login(access_token)
+        self.send_html("<!DOCTYPE html><html><head><title>OAuth Callback Debug</title></head>"
+                       "<body><h1>OAuth Callback Debug</h1>"
+                       f"<p>POST fields: {', '.join(sorted(form)) or 'none'}</p>"
+                       f"<p>Access token {'found' if access_token else 'not found'}</p>"
+                       "</body></html>")
 
 def main():
     print("=== Simple OAuth Debug Test ===\n")
     
+    # Start server
+    print(f"Starting callback server on {REDIRECT_URI}...")
+    event_log = StructuredLogger(EVENT_LOG, echo=sys.stdout)
+    server = CallbackServer(CallbackHandler, event_log=event_log).start()
+    session = server.open_session()
+    
     # Build OAuth URL
-    oauth_url = build_oauth_url()
+    oauth_url = build_oauth_url(session.state)
     print(f"OAuth URL:")
     print(oauth_url)
     print(f"\nRedirect URI: {REDIRECT_URI}")
     
-    # Start server
-    print(f"\nStarting callback server on {REDIRECT_URI}...")
-    server = HTTPServer(('localhost', 8090), CallbackHandler)
-    
     # Open browser
     print("Opening browser for OAuth...")
     print("Complete the login process in your browser.")
@@ -238,19 +228,29 @@ def main():
     
     # Handle callback
     print("\nWaiting for OAuth callback...")
-    server.handle_request()  # Handle the callback
+    try:
+        session.wait(CALLBACK_TIMEOUT)
+    finally:
+        server.stop()
+        event_log.close()
     
     # Show results
-    if callback_received:
+    callback_data = session.result.get('callback_data')
+    if callback_data:
         print(f"\n=== CALLBACK ANALYSIS ===")
         print(f"Path received: {callback_data.get('path', 'N/A')}")
         print(f"Query string: {callback_data.get('query', 'N/A')}")
         print(f"Query params: {callback_data.get('query_params', {})}")
         print(f"Fragment: {callback_data.get('fragment', 'N/A')}")
         
+        if callback_data.get('form_keys'):
+            print(f"POST fields: {callback_data['form_keys']}")
+
         # Check for tokens in query params
         query_params = callback_data.get('query_params', {})
-        if 'access_token' in query_params:
+        if session.result.get('access_token'):
+            print(f"\n✓ Access token found in POST data: {session.result['access_token'][:30]}...")
+        elif 'access_token' in query_params:
             token = query_params['access_token'][0]
             print(f"\n✓ Access token found in query: {token[:30]}...")
         else:
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+KingsChat Structured Log
+JSONL event log written by a background thread in batches.
+
+Callers only build a small dict and put it on a bounded queue, so logging
+never blocks the send path or a request thread; when the queue is full the
+event is dropped and counted instead. The writer thread truncates long
+strings, lists and nested objects (so a full contact list or response
+body cannot bloat a line), serializes a batch at a time with one write and
+one flush, and rotates the file by size and age. High-volume events such
+as successful sends can be sampled; how many were seen versus written is
+recorded in a summary line, so totals stay known. A batch that cannot be
+written (a full disk, a failed rotation, an unserializable value) is
+counted and skipped, and the file is reopened for the next one, so one bad
+write does not stop the writer thread.
+
+Lines use the same shape as logs/bot_notifications.log:
+    {"timestamp": "...", "type": "info", "message": "...", "data": {...}}
+
+Usage:
+    log = StructuredLogger('logs/bulk.jsonl', sample={'Message sent': 0.01})
+    log.info('Message sent', user_id=user_id, latency_ms=42)
+    log.close()
+
+    python structured_log.py --benchmark 200000
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_ROTATE_INTERVAL = 86400  # Seconds before a new file is started regardless of size
+DEFAULT_BACKUPS = 5
+DEFAULT_MAX_FIELD = 512  # Characters kept of any string value
+DEFAULT_MAX_ITEMS = 20  # Items kept of any list or dict
+DEFAULT_MAX_DEPTH = 4
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+def truncate(value, max_field=DEFAULT_MAX_FIELD, max_items=DEFAULT_MAX_ITEMS,
+             max_depth=DEFAULT_MAX_DEPTH):
+    """A JSON-safe copy of ``value`` with long strings, collections and nesting cut short"""
+    if isinstance(value, str):
+        if len(value) > max_field:
+            return f"{value[:max_field]}…(+{len(value) - max_field} chars)"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, bytes):
+        return truncate(value.decode(errors='replace'), max_field, max_items, max_depth)
+    if max_depth <= 0:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {str(k): truncate(v, max_field, max_items, max_depth - 1)
+                  for k, v in items[:max_items]}
+        if len(items) > max_items:
+            result['…'] = f"+{len(items) - max_items} keys"
+        return result
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [truncate(v, max_field, max_items, max_depth - 1) for v in items[:max_items]]
+        if len(items) > max_items:
+            result.append(f"…(+{len(items) - max_items} items)")
+        return result
+    return truncate(str(value), max_field, max_items, max_depth)
+
+
+class StructuredLogger:
+    """Queue-fed JSONL writer with batching, rotation, truncation and sampling.
+
+    ``sample`` maps a message to the fraction of its events to write, e.g.
+    {'Message sent': 0.01}. ``echo`` (a stream such as sys.stdout) also
+    receives a one-line human-readable copy of each written event, printed
+    from the writer thread. Event data is truncated on the writer thread,
+    so it must not be mutated after it is logged.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, rotate_interval=DEFAULT_ROTATE_INTERVAL,
+                 backups=DEFAULT_BACKUPS, max_field=DEFAULT_MAX_FIELD, max_items=DEFAULT_MAX_ITEMS,
+                 max_depth=DEFAULT_MAX_DEPTH, sample=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, echo=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.limits = (max_field, max_items, max_depth)
+        self.sample = sample or {}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self.dropped = 0
+        self.errors = 0  # Batches the writer thread failed to write
+        self.last_error = None
+        self.sampled = {}  # message -> [seen, written]
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._opened_at = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name='structured-log', daemon=True)
+        self._thread.start()
+
+    def log(self, type_, message, **data):
+        """Queue one event; never blocks"""
+        rate = self.sample.get(message)
+        if rate is not None:
+            with self._lock:
+                counts = self.sampled.setdefault(message, [0, 0])
+                counts[0] += 1
+                if self._random.random() >= rate:
+                    return
+                counts[1] += 1
+        try:
+            self._queue.put_nowait((time.time(), type_, message, data))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def info(self, message, **data):
+        self.log('info', message, **data)
+
+    def warning(self, message, **data):
+        self.log('warning', message, **data)
+
+    def error(self, message, **data):
+        self.log('error', message, **data)
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+        self._opened_at = time.time()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _format(self, event):
+        created, type_, message, data = event
+        record = {
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)),
+            'type': type_,
+            'message': truncate(message, *self.limits)
+        }
+        if data:
+            record['data'] = truncate(data, *self.limits)
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n'
+
+    def _write(self, events):
+        lines = [self._format(event) for event in events]
+        chunk = ''.join(lines)
+        if self._file is None:
+            self._open()
+        self._file.write(chunk)
+        self._file.flush()
+        self._size += len(chunk.encode('utf-8'))
+        if self._size >= self.max_bytes or time.time() - self._opened_at >= self.rotate_interval:
+            self._rotate()
+        if self.echo is not None:
+            for created, type_, message, data in events:
+                details = ' '.join(f"{k}={v}" for k, v in truncate(data, 80, 5, 2).items())
+                print(f"{message} {details}".rstrip(), file=self.echo)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while event is not None:
+                batch.append(event)
+                if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                    break
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if event is None:
+                stopping = True
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    self._write_failed(e)
+
+    def _write_failed(self, error):
+        self.errors += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        # Start over with a fresh file handle (e.g. after a half-done rotation)
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def summary(self):
+        return {
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'sampled': {message: {'seen': seen, 'written': written}
+                        for message, (seen, written) in self.sampled.items()}
+        }
+
+    def close(self):
+        """Write the sampling summary, drain the queue and close the file"""
+        if self.sampled or self.dropped or self.errors:
+            self._queue.put((time.time(), 'summary', 'Log summary', self.summary()))
+        self._queue.put(None)
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the structured JSONL logger")
+    parser.add_argument('--benchmark', type=int, default=100000, metavar='EVENTS')
+    parser.add_argument('--path', default='structured_log_benchmark.jsonl')
+    parser.add_argument('--sample', type=float, default=0.01,
+                        help="fraction of 'Message sent' events written")
+    args = parser.parse_args()
+
+    contacts = [{'user_id': f"{i:024x}", 'name': f"User {i}", 'bio': 'x' * 300} for i in range(200)]
+    log = StructuredLogger(args.path, sample={'Message sent': args.sample})
+    started = time.perf_counter()
+    for i in range(args.benchmark):
+        if i % 100 == 0:
+            log.error('Message failed', user_id=f"user{i}", status=500, contacts=contacts)
+        else:
+            log.info('Message sent', user_id=f"user{i}", latency_ms=42.0)
+    enqueue_us = (time.perf_counter() - started) * 1e6 / args.benchmark
+    log.close()
+    total_s = time.perf_counter() - started
+    size = os.path.getsize(args.path)
+    os.remove(args.path)
+    print(f"{args.benchmark} events: {enqueue_us:.2f}µs per log call, {total_s:.2f}s until flushed, "
+          f"{size / 1024:.0f} KiB written, {log.dropped} dropped", file=sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,72 +4,123 @@ KingsChat OAuth Flow Test
 This script tests the complete OAuth flow and token extraction
 """
 
-import requests
 import urllib.parse
-import webbrowser
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-import time
+import argparse
+import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 
-# Configuration (matching your Flutter app)
-CLIENT_ID = "619b30ea-a682-47fb-b90f-5b8e780b89ca"
-AUTH_URL = "https://accounts.kingsch.at"
-API_BASE_URL = "https://connect.kingsch.at/api"
-TOKEN_URL = "https://connect.kingsch.at/oauth2/token"
-SCOPES = ["kingschat"]
-REDIRECT_URI = "http://localhost:8090/callback"  # Using different port to avoid conflicts
-
-# Global variables to capture the callback
-callback_received = False
-auth_code = None
-access_token = None
-refresh_token = None
-error_message = None
-
-class CallbackHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global callback_received, auth_code, access_token, refresh_token, error_message
-        
-        print(f"\n=== CALLBACK RECEIVED ===")
-        print(f"Path: {self.path}")
-        print(f"Full URL: http://localhost:8090{self.path}")
-        
+from callback_server import CallbackServer, RoutingHandler
+from kingschat.config import API_BASE_URL, AUTH_URL, CLIENT_ID, REDIRECT_URI, SCOPES, TOKEN_URL
+from kingschat_client import ConnectionPool, KingsChatClient
+from percentiles import percentile
+from structured_log import StructuredLogger
+
+OAUTH_TIMEOUT = 60  # Seconds to wait for the OAuth callback
+EVENT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'logs',
+                         'oauth_callback.jsonl')
+
+class CallbackHandler(RoutingHandler):
+    routes = {
+        ('GET', '/callback'): 'handle_callback',
+        ('POST', '/callback'): 'handle_form_callback',
+        ('GET', '/token_callback'): 'handle_token_callback',
+        ('POST', '/debug'): 'handle_debug'
+    }
+    # The state in the redirect URI's path (build_oauth_url(state_in_path=True))
+    pattern_routes = [
+        ('GET', re.compile(r'/callback/(?P<state>[\w-]+)'), 'handle_callback'),
+        ('POST', re.compile(r'/callback/(?P<state>[\w-]+)'), 'handle_form_callback')
+    ]
+
+    def read_form(self):
+        """The form-encoded request body merged over the query parameters"""
+        form = dict(self.query_params)
+        form.update(urllib.parse.parse_qs(self.read_body().decode(errors='replace')))
+        return form
+
+    @staticmethod
+    def form_tokens(form):
+        """(access_token, refresh_token) from callback.php's camelCase or the snake_case names"""
+        def first(*names):
+            for name in names:
+                if form.get(name):
+                    return form[name][0]
+            return None
+        return first('accessToken', 'access_token'), first('refreshToken', 'refresh_token')
+
+    def handle_form_callback(self, state=None):
+        """The provider's post_redirect: a form POST carrying accessToken/refreshToken"""
+        form = self.read_form()
+        self.log_event('info', "=== CALLBACK POST RECEIVED ===", path=self.parsed_url.path,
+                       form_keys=sorted(form))
+        session = self.resolve_session(state)
+        if session is None:
+            self.log_event('error', "✗ Callback does not match any pending login "
+                                    "(unknown or expired state)")
+            return
+
+        access_token, refresh_token = self.form_tokens(form)
+        if access_token:
+            self.log_event('info', "✓ Found access token in POST data",
+                           access_token=f"{access_token[:20]}...",
+                           refresh_token=f"{refresh_token[:20]}..." if refresh_token else None)
+            session.complete(access_token=access_token, refresh_token=refresh_token)
+            self.notify_login(access_token)
+            self.send_html("<!DOCTYPE html><html><head><title>OAuth Callback</title></head>"
+                           "<body><h2 style=\"color: green;\">✓ Login complete</h2>"
+                           "<p>You can close this window.</p></body></html>")
+        else:
+            error_message = (form.get('error') or ["No access token in the POST data"])[0]
+            self.log_event('error', "✗ OAuth error", error=error_message)
+            session.complete(error_message=error_message)
+            self.send_html("<!DOCTYPE html><html><head><title>OAuth Callback</title></head>"
+                           "<body><h2 style=\"color: red;\">✗ No Access Token</h2></body></html>",
+                           status=400)
+
+    def handle_callback(self, state=None):
         # Parse the URL
-        parsed_url = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        fragment = parsed_url.fragment
+        query_params = self.query_params
+        fragment = self.parsed_url.fragment
         
-        print(f"Query parameters: {query_params}")
-        print(f"Fragment: {fragment}")
+        self.log_event('info', "=== CALLBACK RECEIVED ===", path=self.parsed_url.path,
+                       query_keys=sorted(query_params), fragment=bool(fragment))
+        
+        session = self.resolve_session(state)
+        if session is None:
+            self.log_event('error', "✗ Callback does not match any pending login "
+                                    "(unknown or expired state)")
+            return
         
         # Check for tokens in query parameters
         if 'access_token' in query_params:
             access_token = query_params['access_token'][0]
             refresh_token = query_params.get('refresh_token', [None])[0]
-            print(f"✓ Found access token in query: {access_token[:20]}...")
-            if refresh_token:
-                print(f"✓ Found refresh token in query: {refresh_token[:20]}...")
+            self.log_event('info', "✓ Found access token in query",
+                           access_token=f"{access_token[:20]}...",
+                           refresh_token=f"{refresh_token[:20]}..." if refresh_token else None)
+            session.complete(access_token=access_token, refresh_token=refresh_token)
+            self.notify_login(access_token)
         
         # Check for authorization code
         elif 'code' in query_params:
             auth_code = query_params['code'][0]
-            print(f"✓ Found authorization code: {auth_code[:20]}...")
+            self.log_event('info', "✓ Found authorization code", code=f"{auth_code[:20]}...")
+            session.complete(auth_code=auth_code)
         
         # Check for errors
         elif 'error' in query_params:
             error_message = query_params['error'][0]
-            print(f"✗ OAuth error: {error_message}")
+            self.log_event('error', "✗ OAuth error", error=error_message)
+            session.complete(error_message=error_message)
         
         else:
-            print("✗ No tokens or code found in callback")
-            print("This might be normal if tokens are in the fragment (implicit flow)")
-        
-        # Send response
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
+            self.log_event('info', "No tokens or code in the query; expecting them from the "
+                                   "fragment (implicit flow)")
+            session.record(callback_received=True)
         
         html_response = f"""
         <!DOCTYPE html>
@@ -87,6 +138,9 @@ class CallbackHandler(BaseHTTPRequestHandler):
                     
                     const accessToken = params.get('access_token');
                     const refreshToken = params.get('refresh_token');
+                    const state = params.get('state') ||
+                        new URLSearchParams(window.location.search).get('state') ||
+                        (window.location.pathname.split('/callback/')[1] || '');
                     
                     if (accessToken) {{
                         console.log('Access token found in fragment:', accessToken.substring(0, 20) + '...');
@@ -96,13 +150,19 @@ class CallbackHandler(BaseHTTPRequestHandler):
                             (refreshToken ? '<p>Refresh token found: ' + refreshToken.substring(0, 20) + '...</p>' : '');
                         
                         // Send tokens to Python script via a request
-                        fetch('/token_callback?access_token=' + encodeURIComponent(accessToken) + 
+                        fetch('/token_callback?state=' + encodeURIComponent(state) +
+                              '&access_token=' + encodeURIComponent(accessToken) + 
                               (refreshToken ? '&refresh_token=' + encodeURIComponent(refreshToken) : ''))
                             .then(() => console.log('Tokens sent to Python script'));
                     }} else {{
                         document.getElementById('status').innerHTML = 
                             '<h2 style="color: red;">✗ No Access Token</h2>' +
                             '<p>No access token found in URL fragment or query parameters</p>';
+                        fetch('/debug?state=' + encodeURIComponent(state), {{
+                            method: 'POST',
+                            headers: {{'Content-Type': 'application/json'}},
+                            body: JSON.stringify({{fullUrl: window.location.href, accessToken: 'not_found'}})
+                        }}).catch(() => {{}});
                     }}
                 }}
                 
@@ -116,7 +176,7 @@ class CallbackHandler(BaseHTTPRequestHandler):
             <hr>
             <h3>Debug Info:</h3>
             <p><strong>Full URL:</strong> <span id="fullUrl"></span></p>
-            <p><strong>Query:</strong> {parsed_url.query}</p>
+            <p><strong>Query:</strong> {self.parsed_url.query}</p>
             <p><strong>Fragment:</strong> {fragment}</p>
             <script>
                 document.getElementById('fullUrl').textContent = window.location.href;
@@ -125,86 +185,115 @@ class CallbackHandler(BaseHTTPRequestHandler):
         </html>
         """
         
-        self.wfile.write(html_response.encode())
-        callback_received = True
+        self.send_html(html_response)
     
-    def do_GET_token_callback(self):
+    def handle_token_callback(self):
         """Handle token extraction from JavaScript"""
-        global access_token, refresh_token
-        
-        parsed_url = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
+        query_params = self.query_params
+        session = self.resolve_session()
+        if session is None:
+            return
         
         if 'access_token' in query_params:
             access_token = query_params['access_token'][0]
             refresh_token = query_params.get('refresh_token', [None])[0]
-            print(f"✓ Tokens received from JavaScript:")
-            print(f"  Access token: {access_token[:20]}...")
-            if refresh_token:
-                print(f"  Refresh token: {refresh_token[:20]}...")
+            self.log_event('info', "✓ Tokens received from JavaScript",
+                           access_token=f"{access_token[:20]}...",
+                           refresh_token=f"{refresh_token[:20]}..." if refresh_token else None)
+            session.complete(access_token=access_token, refresh_token=refresh_token)
+            self.notify_login(access_token)
         
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'OK')
+        self.send_text('OK')
     
-    def log_message(self, format, *args):
-        # Suppress default logging
-        pass
+    def handle_debug(self):
+        """The callback page found no tokens anywhere; stop waiting"""
+        session = self.resolve_session()
+        if session is None:
+            return
+        debug_info = self.read_json() or {}
+        self.log_event('warning', "=== DEBUG INFO FROM JAVASCRIPT ===", debug=debug_info)
+        session.complete(debug_info=debug_info)
+        self.send_text('OK')
 
-def start_callback_server():
-    """Start the callback server in a separate thread"""
-    server = HTTPServer(('localhost', 8090), CallbackHandler)
-    print(f"✓ Callback server started on {REDIRECT_URI}")
-    server.handle_request()  # Handle one request and stop
-    return server
+def build_oauth_url(state=None, auth_url=AUTH_URL, redirect_uri=REDIRECT_URI, state_in_path=False):
+    """Build the OAuth URL; ``state`` ties the redirect back to one login session.
 
-def test_oauth_flow():
-    """Test the complete OAuth flow"""
-    print("=== KingsChat OAuth Flow Test ===\n")
-    
-    # Start callback server
-    print("1. Starting callback server...")
-    server_thread = threading.Thread(target=start_callback_server)
-    server_thread.daemon = True
-    server_thread.start()
-    time.sleep(1)  # Give server time to start
-    
-    # Build OAuth URL
-    print("2. Building OAuth URL...")
+    The provider does not echo ``state`` in its form POST, so with
+    ``state_in_path`` it also goes into the redirect URI as
+    ``/callback/<state>``, which lets concurrent logins share one listener.
+    """
+    if state and state_in_path:
+        redirect_uri = f"{redirect_uri.rstrip('/')}/{state}"
     params = {
         'client_id': CLIENT_ID,
         'scopes': json.dumps(SCOPES),
-        'redirect_uri': REDIRECT_URI,
+        'redirect_uri': redirect_uri,
         'response_type': 'token',  # Implicit flow
         'post_redirect': 'true'
     }
+    if state:
+        params['state'] = state
     
     query_string = urllib.parse.urlencode(params)
-    oauth_url = f"{AUTH_URL}/?{query_string}"
+    return f"{auth_url}/?{query_string}"
+
+def run_login(timeout=OAUTH_TIMEOUT, open_browser=True, handler_class=None, notifier=None):
+    """Run one browser login through the callback server.
+
+    Returns the session result (access_token, auth_code, error_message, ...)
+    or None if nothing arrived within ``timeout`` seconds. A login that
+    yields tokens is handed to ``notifier`` (see login_notifier.py).
+    """
+    # Start callback server
+    print("1. Starting callback server...")
+    event_log = StructuredLogger(EVENT_LOG, echo=sys.stdout)
+    server = CallbackServer(handler_class or CallbackHandler, event_log=event_log,
+                            notifier=notifier).start()
+    session = server.open_session()
+    print(f"✓ Callback server started on {REDIRECT_URI}")
+    
+    # Build OAuth URL
+    print("2. Building OAuth URL...")
+    oauth_url = build_oauth_url(session.state)
     
     print(f"OAuth URL: {oauth_url}")
     print(f"Redirect URI: {REDIRECT_URI}")
     
     # Open browser
-    print("\n3. Opening browser for OAuth...")
-    print("Please complete the OAuth flow in your browser.")
-    webbrowser.open(oauth_url)
+    if open_browser:
+        import webbrowser  # Slow to import; only logins need it
+
+        print("\n3. Opening browser for OAuth...")
+        print("Please complete the OAuth flow in your browser.")
+        webbrowser.open(oauth_url)
+    else:
+        print("\n3. Open the OAuth URL above in a browser to log in.")
     
-    # Wait for callback
+    # Wait for tokens (from the query or, for the implicit flow, the fragment)
     print("\n4. Waiting for OAuth callback...")
-    timeout = 60  # 1 minute timeout
-    start_time = time.time()
+    try:
+        completed = session.wait(timeout)
+    finally:
+        server.stop()
+        event_log.close()
     
-    while not callback_received and (time.time() - start_time) < timeout:
-        time.sleep(0.5)
+    if not completed and not session.result.get('callback_received'):
+        return None
+    return session.result
+
+def test_oauth_flow():
+    """Test the complete OAuth flow"""
+    print("=== KingsChat OAuth Flow Test ===\n")
     
-    if not callback_received:
+    result = run_login()
+    if result is None:
         print("✗ Timeout waiting for OAuth callback")
         return False
     
-    # Give JavaScript time to process tokens
-    time.sleep(2)
+    access_token = result.get('access_token')
+    refresh_token = result.get('refresh_token')
+    auth_code = result.get('auth_code')
+    error_message = result.get('error_message')
     
     # Check results
     print("\n=== RESULTS ===")
@@ -231,60 +320,228 @@ def test_oauth_flow():
         print("✗ No tokens received")
         return False
 
-def test_access_token(token):
+def test_access_token(token, base_url=API_BASE_URL):
     """Test the access token with the KingsChat API"""
     try:
         print("Testing profile API...")
-        response = requests.get(
-            f"{API_BASE_URL}/profile",
-            headers={
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            },
-            timeout=10
-        )
+        with KingsChatClient(token, base_url) as client:
+            response = client.request('GET', '/profile')
         
-        print(f"Profile API Response: {response.status_code}")
-        if response.status_code == 200:
+        print(f"Profile API Response: {response.status}")
+        if response.ok:
             data = response.json()
             print("✓ Profile API Success!")
             print(f"User: {data.get('profile', {}).get('user', {}).get('name', 'Unknown')}")
         else:
-            print(f"✗ Profile API Error: {response.text}")
+            print(f"✗ Profile API Error: {response.body.decode(errors='replace')}")
     
     except Exception as e:
         print(f"✗ Error testing access token: {e}")
 
-def test_api_endpoints():
-    """Test API endpoints without authentication"""
-    print("\n=== Testing API Endpoints ===")
-    
-    endpoints = [
+def endpoint_urls(base_url=None):
+    """Return the (name, url) pairs probed by --test-api.
+
+    With a base URL every endpoint is rooted there, so the probe can run
+    against a local stand-in server instead of the live KingsChat hosts.
+    """
+    if base_url:
+        base_url = base_url.rstrip('/')
+        return [
+            ("Profile API", f"{base_url}/api/profile"),
+            ("Contacts API", f"{base_url}/api/contacts"),
+            ("Auth URL", f"{base_url}/"),
+            ("Token URL", f"{base_url}/oauth2/token")
+        ]
+
+    return [
         ("Profile API", f"{API_BASE_URL}/profile"),
         ("Contacts API", f"{API_BASE_URL}/contacts"),
         ("Auth URL", AUTH_URL),
         ("Token URL", TOKEN_URL)
     ]
+
+def probe_once(pools, url):
+    """Time a single GET over a pooled keep-alive connection.
+
+    Returns a sample dict with connect/TTFB/total times in milliseconds.
+    connect_ms is 0 when an existing keep-alive connection was reused.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+
+    sample = {'status': None, 'error': None, 'connect_ms': 0.0, 'ttfb_ms': None, 'total_ms': None}
+    started = time.perf_counter()
+    try:
+        response = pools[(parsed_url.scheme, parsed_url.netloc)].request(
+            'GET', path, headers={'Accept': 'application/json'}
+        )
+        sample.update(status=response.status, connect_ms=response.connect_ms,
+                      ttfb_ms=response.ttfb_ms, total_ms=response.total_ms)
+    except Exception as e:
+        sample['error'] = f"{type(e).__name__}: {e}"
+        sample['total_ms'] = (time.perf_counter() - started) * 1000
+
+    return sample
+
+def summarize_samples(samples):
+    """Reduce the raw samples of one endpoint to latency percentiles and error rates"""
+    totals = sorted(s['total_ms'] for s in samples if s['error'] is None)
+    ttfbs = sorted(s['ttfb_ms'] for s in samples if s['error'] is None)
+    connects = sorted(s['connect_ms'] for s in samples if s['error'] is None and s['connect_ms'] > 0)
+
+    statuses = {}
+    errors = {}
+    for s in samples:
+        if s['error'] is not None:
+            errors[s['error']] = errors.get(s['error'], 0) + 1
+        else:
+            statuses[str(s['status'])] = statuses.get(str(s['status']), 0) + 1
+
+    failed = sum(errors.values()) + sum(
+        count for status, count in statuses.items() if int(status) >= 500
+    )
+
+    def _pcts(values):
+        return {
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99)
+        }
+
+    return {
+        'samples': len(samples),
+        'total_ms': _pcts(totals),
+        'ttfb_ms': _pcts(ttfbs),
+        'connect_ms': _pcts(connects),
+        'new_connections': len(connects),
+        'statuses': statuses,
+        'errors': errors,
+        'error_rate': failed / len(samples) if samples else 0.0
+    }
+
+def probe_endpoints(base_url=None, rounds=5, concurrency=4, timeout=5):
+    """Probe every endpoint concurrently for a number of rounds.
+
+    Each host gets a keep-alive connection pool as large as the worker
+    count, so after the first round the numbers reflect request latency
+    rather than connection setup. Returns a JSON-serialisable report.
+    """
+    endpoints = endpoint_urls(base_url)
+    pools = {}
+    for _, url in endpoints:
+        parsed_url = urllib.parse.urlparse(url)
+        key = (parsed_url.scheme, parsed_url.netloc)
+        if key not in pools:
+            pools[key] = ConnectionPool(f"{parsed_url.scheme}://{parsed_url.netloc}",
+                                        maxsize=concurrency, timeout=timeout,
+                                        connect_timeout=timeout)
+    samples = {name: [] for name, _ in endpoints}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        for _ in range(rounds):
+            for name, url in endpoints:
+                futures[pool.submit(probe_once, pools, url)] = name
+        for future in as_completed(futures):
+            samples[futures[future]].append(future.result())
+    elapsed = time.perf_counter() - started
+
+    for connection_pool in pools.values():
+        connection_pool.close()
+
+    return {
+        'base_url': base_url or API_BASE_URL,
+        'rounds': rounds,
+        'concurrency': concurrency,
+        'elapsed_s': elapsed,
+        'endpoints': {
+            name: dict(url=url, **summarize_samples(samples[name]))
+            for name, url in endpoints
+        }
+    }
+
+def print_probe_report(report):
+    """Print a probe report as a text table"""
+    def _ms(value):
+        return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+
+    print(f"Target: {report['base_url']}")
+    print(f"Rounds: {report['rounds']}, concurrency: {report['concurrency']}, "
+          f"elapsed: {report['elapsed_s']:.2f}s\n")
+    print(f"{'Endpoint':<14}{'p50':>8}{'p95':>8}{'p99':>8}"
+          f"{'conn p50':>10}{'ttfb p50':>10}{'errors':>8}  statuses")
+
+    for name, stats in report['endpoints'].items():
+        statuses = ', '.join(f"{code}x{count}" for code, count in sorted(stats['statuses'].items()))
+        print(f"{name:<14}{_ms(stats['total_ms']['p50'])}{_ms(stats['total_ms']['p95'])}"
+              f"{_ms(stats['total_ms']['p99'])}  {_ms(stats['connect_ms']['p50'])}"
+              f"  {_ms(stats['ttfb_ms']['p50'])}{stats['error_rate']:>7.0%}  {statuses or '-'}")
+        for error, count in stats['errors'].items():
+            print(f"    ✗ {count}x {error}")
+
+def test_api_endpoints(base_url=None, rounds=5, concurrency=4, timeout=5, json_path=None):
+    """Probe API endpoints without authentication and report latency percentiles"""
+    print("\n=== Testing API Endpoints ===")
+
+    report = probe_endpoints(base_url, rounds=rounds, concurrency=concurrency, timeout=timeout)
+    print_probe_report(report)
+
+    if json_path == '-':
+        print(json.dumps(report, indent=2))
+    elif json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ JSON report written to {json_path}")
+
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="KingsChat OAuth flow test and API probe")
+    parser.add_argument('--test-api', action='store_true',
+                        help="probe the API endpoints instead of running the OAuth flow")
+    parser.add_argument('--base-url',
+                        help="probe a stand-in server at this URL instead of the live hosts")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="number of times each endpoint is hit (default: 5)")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="number of concurrent probe workers (default: 4)")
+    parser.add_argument('--timeout', type=float, default=5,
+                        help="per-request timeout in seconds (default: 5)")
+    parser.add_argument('--json', dest='json_path', metavar='PATH',
+                        help="also write the probe report as JSON ('-' for stdout)")
+    parser.add_argument('--max-error-rate', type=float, default=0.0,
+                        help="exit non-zero if any endpoint's error rate (transport errors "
+                             "and 5xx) is above this (default: 0)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.test_api:
+        report = test_api_endpoints(args.base_url, rounds=args.rounds,
+                                    concurrency=args.concurrency, timeout=args.timeout,
+                                    json_path=args.json_path)
+        failing = [name for name, stats in report['endpoints'].items()
+                   if stats['error_rate'] > args.max_error_rate]
+        if failing:
+            print(f"✗ Error rate above {args.max_error_rate:.0%}: {', '.join(failing)}")
+            return 1
+        return 0
+
+    # Test complete OAuth flow
+    success = test_oauth_flow()
     
-    for name, url in endpoints:
-        try:
-            response = requests.get(url, timeout=5)
-            print(f"{name}: HTTP {response.status_code}")
-        except Exception as e:
-            print(f"{name}: Error - {e}")
+    if not success:
+        print("\n=== Troubleshooting ===")
+        print("1. Check if the OAuth provider allows the redirect URI")
+        print("2. Verify the client ID is correct")
+        print("3. Make sure you're logged into KingsChat")
+        print("4. Check the browser console for JavaScript errors")
+        
+    print("\nTo test API endpoints only, run: python test_oauth_flow.py --test-api")
+    return 0 if success else 1
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "--test-api":
-        test_api_endpoints()
-    else:
-        # Test complete OAuth flow
-        success = test_oauth_flow()
-        
-        if not success:
-            print("\n=== Troubleshooting ===")
-            print("1. Check if the OAuth provider allows the redirect URI")
-            print("2. Verify the client ID is correct")
-            print("3. Make sure you're logged into KingsChat")
-            print("4. Check the browser console for JavaScript errors")
-            
-        print("\nTo test API endpoints only, run: python test_oauth_flow.py --test-api") 
\ No newline at end of file
+    raise SystemExit(main()) 
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""Tests for jwt_verifier.py against a locally generated keypair"""
+
+import time
+import unittest
+from unittest import mock
+
+from jwt_verifier import (JWKSCache, JWTVerifier, RSAPublicKey, TokenVerificationError,
+                          b64url_encode, generate_keypair, sign_rs256)
+
+AUDIENCE = 'kingschat'
+
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JWTVerifierTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 1024 bits keeps key generation fast; the code paths are the same
+        cls.key = generate_keypair(1024, kid='key-1')
+        cls.other_key = generate_keypair(1024, kid='key-2')
+
+    def setUp(self):
+        self.jwks = JWKSCache.from_jwks({'keys': [self.key.public_key().to_jwk()]})
+        self.verifier = JWTVerifier(self.jwks, audience=AUDIENCE)
+
+    def token(self, key=None, **claims):
+        claims = {'sub': 'user1', 'aud': [AUDIENCE], 'exp': int(time.time()) + 3600, **claims}
+        return sign_rs256(claims, key or self.key)
+
+    def test_valid_token(self):
+        claims = self.verifier.verify(self.token())
+        self.assertEqual(claims['sub'], 'user1')
+        self.assertTrue(self.verifier.is_valid(self.token()))
+
+    def test_millisecond_exp(self):
+        exp = int((time.time() + 3600) * 1000)
+        self.assertEqual(self.verifier.verify(self.token(exp=exp))['exp'], exp)
+
+    def test_tampered_signature(self):
+        token = self.token()
+        head, _, signature = token.rpartition('.')
+        forged = head + '.' + ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        with self.assertRaisesRegex(TokenVerificationError, "Invalid signature"):
+            self.verifier.verify(forged)
+
+    def test_tampered_claims(self):
+        header, claims, signature = self.token().split('.')
+        other_claims = self.token(sub='admin').split('.')[1]
+        with self.assertRaisesRegex(TokenVerificationError, "Invalid signature"):
+            self.verifier.verify('.'.join((header, other_claims, signature)))
+
+    def test_expired(self):
+        token = self.token(exp=int(time.time()) - 3600)
+        with self.assertRaisesRegex(TokenVerificationError, "expired"):
+            self.verifier.verify(token)
+
+    def test_expired_within_leeway(self):
+        token = self.token(exp=int(time.time()) - 5)
+        self.assertEqual(self.verifier.verify(token)['sub'], 'user1')
+
+    def test_cached_token_expires(self):
+        exp = int(time.time()) + 60
+        token = self.token(exp=exp)
+        self.verifier.verify(token)
+        with self.assertRaisesRegex(TokenVerificationError, "expired"):
+            self.verifier.verify(token, now=exp + 3600)
+
+    def test_not_yet_valid(self):
+        token = self.token(nbf=int(time.time()) + 3600)
+        with self.assertRaisesRegex(TokenVerificationError, "not yet valid"):
+            self.verifier.verify(token)
+
+    def test_wrong_audience(self):
+        token = self.token(aud=['conference_calls'])
+        with self.assertRaisesRegex(TokenVerificationError, "audience"):
+            self.verifier.verify(token)
+
+    def test_malformed(self):
+        for token in ('', 'abc', 'a.b.c', None):
+            self.assertFalse(self.verifier.is_valid(token))
+
+    def test_unknown_kid_triggers_refetch(self):
+        jwks = {'keys': [self.key.public_key().to_jwk()]}
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            return jwks
+
+        cache = JWKSCache(fetch=fetch, min_refetch_interval=0)
+        verifier = JWTVerifier(cache, audience=AUDIENCE)
+        verifier.verify(self.token())
+        self.assertEqual(len(fetches), 1)
+
+        # The issuer rotates in a new key
+        jwks = {'keys': [self.key.public_key().to_jwk(), self.other_key.public_key().to_jwk()]}
+        self.assertEqual(verifier.verify(self.token(self.other_key))['sub'], 'user1')
+        self.assertEqual(len(fetches), 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(fetch=lambda: {'keys': [self.key.public_key().to_jwk()]},
+                          min_refetch_interval=60)
+        verifier = JWTVerifier(cache, audience=AUDIENCE)
+        verifier.verify(self.token())
+        for _ in range(3):
+            self.assertFalse(verifier.is_valid(self.token(self.other_key)))
+        self.assertEqual(cache.fetch_count, 1)
+
+    def test_jwks_ttl_expiry(self):
+        clock = Clock()
+        with mock.patch('jwt_verifier.time.monotonic', clock):
+            cache = JWKSCache(fetch=lambda: {'keys': [self.key.public_key().to_jwk()]}, ttl=60)
+            cache.get('key-1')
+            clock.now += 30
+            cache.get('key-1')
+            self.assertEqual(cache.fetch_count, 1)
+            clock.now += 31
+            cache.get('key-1')
+            self.assertEqual(cache.fetch_count, 2)
+
+    def test_failed_refetch_keeps_previous_keys(self):
+        clock = Clock()
+        responses = [{'keys': [self.key.public_key().to_jwk()]}]
+
+        def fetch():
+            if not responses:
+                raise OSError("connection refused")
+            return responses.pop()
+
+        with mock.patch('jwt_verifier.time.monotonic', clock):
+            cache = JWKSCache(fetch=fetch, ttl=60)
+            cache.get('key-1')
+            clock.now += 120
+            self.assertEqual(cache.get('key-1').kid, 'key-1')
+            self.assertEqual(cache.fetch_count, 2)
+
+    def test_fetch_failure_with_empty_cache(self):
+        def fetch():
+            raise OSError("connection refused")
+
+        verifier = JWTVerifier(JWKSCache(fetch=fetch), audience=AUDIENCE)
+        with self.assertRaisesRegex(TokenVerificationError, "Could not load signing keys"):
+            verifier.verify(self.token())
+        self.assertFalse(verifier.is_valid(self.token()))
+        results = list(verifier.verify_many([self.token(), self.token(sub='user2')]))
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(error is not None for _, _, error in results))
+
+    def test_short_modulus(self):
+        tiny = RSAPublicKey(generate_keypair(256).n, 65537, kid='tiny')
+        verifier = JWTVerifier(JWKSCache.from_jwks({'keys': [tiny.to_jwk()]}), audience=AUDIENCE)
+        head = self.token(self.other_key).rpartition('.')[0].split('.')
+        head[0] = b64url_encode(b'{"alg":"RS256","kid":"tiny","typ":"JWT"}')
+        token = '.'.join(head) + '.' + b64url_encode(b'\x00' * (tiny.size - 1) + b'\x01')
+        with self.assertRaisesRegex(TokenVerificationError, "Unusable signing key"):
+            verifier.verify(token)
+        results = list(verifier.verify_many([token, token]))
+        self.assertTrue(all(error is not None for _, _, error in results))
+
+    def test_verify_many(self):
+        tokens = [self.token(), self.token(exp=int(time.time()) - 3600), self.token(sub='user2')]
+        errors = [error for _, _, error in self.verifier.verify_many(tokens)]
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], TokenVerificationError)
+        self.assertIsNone(errors[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
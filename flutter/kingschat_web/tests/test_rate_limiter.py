@@ -0,0 +1,122 @@
+"""Tests for rate_limiter.py's shared AIMD budget against a temporary database"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from rate_limiter import DECREASE_COOLDOWN, LATENCY_WARMUP, MIN_RATE, SharedRateLimiter
+
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SharedRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('rate_limiter.time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, 'rate_limit.db')
+        self.limiter = self.open()
+
+    def open(self):
+        limiter = SharedRateLimiter(self.db_path, rate=10, burst=5)
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def state(self, limiter=None):
+        # flush() runs on the database thread after every queued update
+        limiter = limiter or self.limiter
+        limiter.flush()
+        self.assertEqual(limiter.errors, 0)
+        return limiter.state()
+
+    def test_429_halves_the_rate(self):
+        self.limiter.observe(429, 120)
+        state = self.state()
+        self.assertEqual(state['rate'], 5)
+        self.assertEqual(state['decreases'], 1)
+        self.assertLessEqual(state['tokens'], 0)
+        self.assertLess(self.limiter.concurrency, 10)
+
+    def test_5xx_and_timeouts_halve_the_rate(self):
+        self.limiter.observe(503, 120)
+        self.assertEqual(self.state()['rate'], 5)
+        self.clock.now += DECREASE_COOLDOWN
+        self.limiter.observe(None)
+        self.assertEqual(self.state()['rate'], 2.5)
+
+    def test_one_cut_per_cooldown(self):
+        for _ in range(10):
+            self.limiter.observe(429, 120)
+        self.assertEqual(self.state()['rate'], 5)
+        self.clock.now += DECREASE_COOLDOWN
+        self.limiter.observe(500, 120)
+        state = self.state()
+        self.assertEqual(state['rate'], 2.5)
+        self.assertEqual(state['decreases'], 2)
+
+    def test_rate_never_drops_below_minimum(self):
+        for _ in range(20):
+            self.limiter.observe(429)
+            self.state()
+            self.clock.now += DECREASE_COOLDOWN
+        self.assertEqual(self.state()['rate'], MIN_RATE)
+
+    def test_retry_after_blocks_everyone(self):
+        self.limiter.observe(429, 120, retry_after=30)
+        state = self.state()
+        self.assertEqual(state['blocked_until'], self.clock.now + 30)
+        other = self.open()
+        self.assertGreaterEqual(other.reserve(), 30)
+
+    def test_successes_raise_the_rate(self):
+        self.limiter.observe(429, 120)
+        self.assertEqual(self.state()['rate'], 5)
+        for _ in range(10):
+            self.limiter.observe(200, 120)
+        # One second of traffic at 5 req/s adds ADDITIVE_INCREASE twice over
+        self.assertEqual(self.state()['rate'], 7)
+        for _ in range(1000):
+            self.limiter.observe(201, 120)
+        self.assertEqual(self.state()['rate'], 10)
+
+    def test_client_errors_leave_the_rate_alone(self):
+        self.limiter.observe(400, 120)
+        self.limiter.observe(404, 120)
+        state = self.state()
+        self.assertEqual(state['rate'], 10)
+        self.assertEqual(state['decreases'], 0)
+
+    def test_latency_spike_counts_as_congestion(self):
+        for _ in range(LATENCY_WARMUP):
+            self.limiter.observe(200, 100)
+        self.assertEqual(self.state()['rate'], 10)
+        self.limiter.observe(200, 1000)
+        self.assertEqual(self.state()['rate'], 5)
+
+    def test_rate_cut_is_shared_between_instances(self):
+        other = self.open()
+        self.limiter.observe(429, 120)
+        self.state()
+        self.assertEqual(self.state(other)['rate'], 5)
+
+    def test_burst_is_shared_between_instances(self):
+        other = self.open()
+        waits = [self.limiter.reserve() if i % 2 else other.reserve() for i in range(6)]
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertAlmostEqual(waits[5], 0.1, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
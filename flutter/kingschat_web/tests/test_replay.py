@@ -0,0 +1,123 @@
+"""Tests for replay.py's trace extraction from error.log and callback replay"""
+
+import unittest
+
+from callback_server import CallbackServer
+from replay import ERROR_LOG, Replayer, TraceExtractor, extract
+from test_oauth_flow import CallbackHandler
+
+CALLBACK_PHP = b"""\
+[09-Mar-2025 10:48:13 Europe/Berlin] Callback.php started at 2025-03-09 10:48:13
+[09-Mar-2025 10:48:13 Europe/Berlin] POST data: Array
+(
+    [accessToken] => eyJhbGciOiJSUzI1NiJ9.e30.c2ln
+    [refreshToken] => 84JQpyM4CFNjGP+sQrypmzaIghCrxrRHoM+y7oOAj1c=
+)
+
+[09-Mar-2025 10:48:13 Europe/Berlin] GET data: Array
+(
+)
+
+[09-Mar-2025 10:48:13 Europe/Berlin] Raw input data: accessToken=eyJhbGciOiJSUzI1NiJ9.e30.c2ln&refreshToken=84JQ
+[09-Mar-2025 10:48:13 Europe/Berlin] Token found in POST data
+[09-Mar-2025 10:48:14 Europe/Berlin] Profile API Response Code: 200
+[09-Mar-2025 10:50:00 Europe/Berlin] Response code: 200
+[09-Mar-2025 10:50:00 Europe/Berlin] Response body: ""
+[09-Mar-2025 10:51:00 Europe/Berlin] Raw input data: accessToken=eyJhbGciOiJSUzI1NiJ9.e30.c2ln
+[09-Mar-2025 10:52:00 Europe/Berlin] Welcome message retry response code: 401
+"""
+
+CALLBACK_DEBUG = b"""\
+[10-Mar-2025 09:00:00 Europe/Berlin] === CALLBACK DEBUG START ===
+[10-Mar-2025 09:00:00 Europe/Berlin] REQUEST_METHOD: GET
+[10-Mar-2025 09:00:00 Europe/Berlin] REQUEST_URI: /callback.php?code=abc&state=xyz
+"""
+
+
+def feed(text):
+    extractor = TraceExtractor()
+    for line in text.splitlines():
+        extractor.feed_error(line)
+    return extractor.trace()
+
+
+class TraceExtractorTest(unittest.TestCase):
+    def test_callback_php_format(self):
+        events = feed(CALLBACK_PHP)
+        callbacks = [e for e in events if e['op'] == 'callback']
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(callbacks[0]['method'], 'POST')
+        self.assertEqual(callbacks[0]['post'], ['accessToken', 'refreshToken'])
+        self.assertEqual(callbacks[0]['query'], [])
+        self.assertEqual(callbacks[1]['post'], ['accessToken'])
+
+    def test_response_codes(self):
+        sends = [e for e in feed(CALLBACK_PHP) if e['op'] == 'send']
+        # The profile lookup is not a send
+        self.assertEqual([e['status'] for e in sends], [200, 401])
+        self.assertNotEqual(sends[0]['to'], sends[1]['to'])
+
+    def test_callback_debug_format(self):
+        (event,) = feed(CALLBACK_DEBUG)
+        self.assertEqual(event['method'], 'GET')
+        self.assertEqual(event['query'], ['code', 'state'])
+        self.assertNotIn('post', event)
+
+    def test_no_secrets_in_trace(self):
+        for event in feed(CALLBACK_PHP):
+            self.assertNotIn('eyJ', repr(event))
+
+    def test_checked_in_error_log(self):
+        events, _ = extract(ERROR_LOG, None)
+        ops = {}
+        for event in events:
+            ops[event['op']] = ops.get(event['op'], 0) + 1
+        self.assertGreater(ops.get('callback', 0), 0)
+        self.assertGreater(ops.get('send', 0), 0)
+
+
+class RecordingHandler(CallbackHandler):
+    """CallbackHandler that remembers the method and path of each request"""
+
+    requests = []
+
+    def _dispatch(self, method):
+        self.requests.append((method, self.path.partition('?')[0]))
+        super()._dispatch(method)
+
+
+class RecordingNotifier:
+    """Stand-in for the login notifier that keeps the tokens it is handed"""
+
+    def __init__(self):
+        self.tokens = []
+
+    def submit(self, user_id, name, access_token):
+        self.tokens.append(access_token)
+
+
+class ReplayerCallbackTest(unittest.TestCase):
+    def setUp(self):
+        RecordingHandler.requests = []
+        self.notifier = RecordingNotifier()
+        self.server = CallbackServer(RecordingHandler, port=0, notifier=self.notifier)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.replayer = Replayer(None, [], self.server, 'replay-access-token', max_in_flight=1)
+        self.addCleanup(self.replayer.close)
+
+    def test_post_callback_is_replayed_as_form_post(self):
+        event = [e for e in feed(CALLBACK_PHP) if e['op'] == 'callback'][0]
+        self.assertEqual(self.replayer._callback(event), 200)
+        ((method, path),) = RecordingHandler.requests
+        self.assertEqual(method, 'POST')
+        self.assertRegex(path, r'^/callback/[\w-]+$')
+        self.assertEqual(self.notifier.tokens, ['replay-access-token'])
+
+    def test_get_callback_is_replayed_as_get(self):
+        event = {'op': 'callback', 'method': 'GET', 'query': ['accessToken']}
+        self.assertEqual(self.replayer._callback(event), 200)
+        self.assertEqual(RecordingHandler.requests, [('GET', '/token_callback')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""Tests for send_queue.py's leases and its no-resend guarantee"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+from send_queue import FAILED, LEASED, PENDING, SENDING, SENT, SendQueue, run_campaign
+
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingSender:
+    """Async sender that remembers every recipient it was asked to send to"""
+
+    def __init__(self, fail=()):
+        self.sent = []
+        self.fail = set(fail)
+
+    async def send_message(self, user_id, text):
+        self.sent.append(user_id)
+        if user_id in self.fail:
+            raise OSError("connection reset")
+        return {}
+
+    async def close(self):
+        pass
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('send_queue.time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = SendQueue(':memory:', max_attempts=2)
+        self.addCleanup(self.queue.close)
+        self.queue.create_campaign('launch', "Hello")
+        self.queue.enqueue('launch', [f"user{i}" for i in range(10)])
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(self.queue.enqueue('launch', ['user0', 'user1', 'user10']), 1)
+        self.assertEqual(self.queue.stats('launch')[PENDING], 11)
+
+    def test_leases_do_not_overlap(self):
+        first = self.queue.lease('launch', 'a', 4)
+        second = self.queue.lease('launch', 'b', 4)
+        self.assertEqual(len(first), 4)
+        self.assertEqual(len(second), 4)
+        self.assertFalse({job_id for job_id, _ in first} & {job_id for job_id, _ in second})
+        self.assertEqual(self.queue.stats('launch')[LEASED], 8)
+
+    def test_expired_lease_is_taken_over(self):
+        jobs = self.queue.lease('launch', 'a', 3, lease_seconds=60)
+        self.clock.now += 30
+        self.assertEqual(len(self.queue.lease('launch', 'b', 10)), 7)
+        self.clock.now += 31
+        taken = self.queue.lease('launch', 'b', 10)
+        self.assertEqual(taken, jobs)
+
+    def test_mark_sending_after_losing_the_lease(self):
+        jobs = self.queue.lease('launch', 'a', 3, lease_seconds=60)
+        job_ids = [job_id for job_id, _ in jobs]
+        self.clock.now += 61
+        # Expired: even before anyone takes it over, 'a' must not send
+        self.assertEqual(self.queue.mark_sending(job_ids[:1], 'a'), set())
+        self.queue.lease('launch', 'b', 10)
+        self.assertEqual(self.queue.mark_sending(job_ids, 'a'), set())
+        self.assertEqual(self.queue.mark_sending(job_ids, 'b'), set(job_ids))
+
+    def test_sending_jobs_are_never_leased_again(self):
+        jobs = self.queue.lease('launch', 'a', 10, lease_seconds=60)
+        self.queue.mark_sending([job_id for job_id, _ in jobs[:4]], 'a')
+        self.clock.now += 3600
+        self.assertEqual(len(self.queue.lease('launch', 'b', 10)), 6)
+        self.assertEqual(self.queue.stats('launch')[SENDING], 4)
+
+    def test_complete_ignores_jobs_owned_by_another_worker(self):
+        jobs = self.queue.lease('launch', 'a', 2, lease_seconds=60)
+        job_ids = [job_id for job_id, _ in jobs]
+        self.clock.now += 61
+        self.queue.lease('launch', 'b', 2)
+        self.queue.mark_sending(job_ids, 'b')
+        # 'a' reports late; 'b' owns the jobs now
+        self.queue.complete([(job_id, False, 500, "boom") for job_id in job_ids], 'a')
+        self.assertEqual(self.queue.stats('launch')[SENDING], 2)
+        self.queue.complete([(job_id, True, 201, None) for job_id in job_ids], 'b')
+        stats = self.queue.stats('launch')
+        self.assertEqual(stats[SENT], 2)
+        statuses = self.queue.db.execute(
+            'SELECT DISTINCT last_status FROM jobs WHERE status = ?', (SENT,)
+        ).fetchall()
+        self.assertEqual(statuses, [(201,)])
+
+    def test_failures_are_retried_until_max_attempts(self):
+        for _ in range(2):
+            jobs = self.queue.lease('launch', 'a', 1)
+            self.queue.mark_sending([jobs[0][0]], 'a')
+            self.queue.complete([(jobs[0][0], False, 500, "boom")], 'a')
+        self.assertEqual(self.queue.stats('launch')[FAILED], 1)
+
+    def test_release_interrupted_sends(self):
+        jobs = self.queue.lease('launch', 'a', 3)
+        self.queue.mark_sending([job_id for job_id, _ in jobs], 'a')
+        self.assertEqual(self.queue.release('launch'), 0)
+        self.assertEqual(self.queue.release('launch', include_sending=True), 3)
+        self.assertEqual(self.queue.stats('launch')[PENDING], 10)
+
+
+class RunCampaignTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = SendQueue(':memory:')
+        self.addCleanup(self.queue.close)
+        self.queue.create_campaign('launch', "Hello")
+        self.recipients = [f"user{i}" for i in range(50)]
+        self.queue.enqueue('launch', self.recipients)
+
+    def run_campaign(self, sender, owner='worker'):
+        return asyncio.run(run_campaign(self.queue, 'launch', sender, concurrency=4, owner=owner))
+
+    def test_sends_each_recipient_once(self):
+        sender = RecordingSender()
+        self.assertEqual(self.run_campaign(sender), 50)
+        self.assertEqual(sorted(sender.sent), sorted(self.recipients))
+        # A second run has nothing left to send
+        again = RecordingSender()
+        self.assertEqual(self.run_campaign(again), 0)
+        self.assertEqual(again.sent, [])
+        self.assertEqual(self.queue.stats('launch')[SENT], 50)
+
+    def test_resume_after_crash_does_not_resend(self):
+        # A worker that died mid-batch: its claimed jobs stay 'sending'
+        jobs = self.queue.lease('launch', 'crashed', 8)
+        self.queue.mark_sending([job_id for job_id, _ in jobs], 'crashed')
+        sender = RecordingSender()
+        self.run_campaign(sender)
+        self.assertFalse(set(sender.sent) & {recipient for _, recipient in jobs})
+        stats = self.queue.stats('launch')
+        self.assertEqual(stats[SENT], 42)
+        self.assertEqual(stats[SENDING], 8)
+
+    def test_failed_sends_go_back_to_pending(self):
+        sender = RecordingSender(fail={'user3'})
+        self.run_campaign(sender)
+        self.assertEqual(self.queue.stats('launch')[SENT], 49)
+        self.assertEqual(self.queue.stats('launch')[SENDING], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
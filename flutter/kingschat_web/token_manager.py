@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+KingsChat Token Manager
+Keeps the access token in kc_config.json fresh without a refresh per request.
+
+The token's expiry is read locally from the JWT ``exp`` claim, and a refresh
+only happens inside a window before expiry (or after a 401). Concurrent
+callers share a single in-flight refresh instead of each hitting
+oauth2/token, and the config file is replaced atomically so the PHP pages
+never read a half-written file.
+
+Usage:
+    python token_manager.py            # show token status
+    python token_manager.py --refresh  # force a refresh
+"""
+
+import argparse
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from kingschat.config import CLIENT_ID, CONFIG_FILE, TOKEN_URL
+from kingschat_client import ConnectionPool
+from metrics import TOKEN_REFRESH_LATENCY, TOKEN_REFRESHES
+
+DEFAULT_REFRESH_WINDOW = 300  # Seconds before expiry to refresh, as in token_refresh.php
+DEFAULT_EXPIRES_IN_MILLIS = 3600000
+
+
+class TokenRefreshError(Exception):
+    """Raised when oauth2/token does not return a new access token"""
+
+
+def decode_jwt_claims(token):
+    """Decode a JWT payload without verifying it; returns {} if it is not a JWT"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except (AttributeError, IndexError, ValueError):
+        return {}
+
+
+def claim_timestamp(value):
+    """A JWT time claim as a Unix timestamp in seconds, or None.
+
+    KingsChat puts milliseconds in ``exp``; standard seconds are accepted too.
+    """
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return None
+    return value / 1000.0 if value > 1e11 else float(value)
+
+
+def token_expiry(token):
+    """Expiry of a JWT as a Unix timestamp in seconds, or None"""
+    return claim_timestamp(decode_jwt_claims(token).get('exp'))
+
+
+def load_config(path=CONFIG_FILE):
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def save_config(config, path=CONFIG_FILE):
+    """Write the config to a temp file in the same directory, then rename it into place"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.kc_config.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class _Refresh:
+    """One in-flight refresh that every concurrent caller waits on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+        self.error = None
+
+
+class TokenManager:
+    """Thread-safe source of a valid access token backed by kc_config.json"""
+
+    def __init__(self, config_path=CONFIG_FILE, refresh_window=DEFAULT_REFRESH_WINDOW,
+                 token_url=TOKEN_URL, client_id=CLIENT_ID, timeout=10):
+        self.config_path = config_path
+        self.refresh_window = refresh_window
+        self.client_id = client_id
+        self.refresh_count = 0
+
+        parsed_url = urllib.parse.urlparse(token_url)
+        self._token_path = parsed_url.path
+        self._pool = ConnectionPool(f"{parsed_url.scheme}://{parsed_url.netloc}",
+                                    maxsize=1, timeout=timeout, connect_timeout=timeout)
+        self._lock = threading.Lock()
+        self._inflight = None
+        self._config = None
+        self._expires_at = None
+
+    def _load(self):
+        self._config = load_config(self.config_path)
+        self._expires_at = self._expiry_of(self._config)
+
+    @staticmethod
+    def _expiry_of(config):
+        token = config.get('access_token')
+        if not token:
+            return None
+        return token_expiry(token) or config.get('expires_at') or None
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._load()
+        return self._config
+
+    def needs_refresh(self, now=None):
+        if self._config is None:
+            self._load()
+        if self._expires_at is None:
+            return True
+        return self._expires_at - (now or time.time()) < self.refresh_window
+
+    def get_token(self):
+        """Return a valid access token, refreshing only if it is about to expire"""
+        if not self.needs_refresh():
+            return self._config['access_token']
+        return self.refresh(stale_token=self.config.get('access_token'))
+
+    async def get_token_async(self):
+        import asyncio  # Only async callers pay for importing asyncio
+        return await asyncio.to_thread(self.get_token)
+
+    def refresh(self, stale_token=None):
+        """Refresh the access token, sharing the work with concurrent callers.
+
+        Pass the token that was rejected as ``stale_token``; if another caller
+        or process has already replaced it, the newer token is returned
+        without another round-trip.
+        """
+        with self._lock:
+            current = self.config.get('access_token')
+            if stale_token is not None and current and current != stale_token \
+                    and not self.needs_refresh():
+                return current
+            leader = self._inflight is None
+            if leader:
+                self._inflight = _Refresh()
+            flight = self._inflight
+
+        if leader:
+            started = time.perf_counter()
+            refresh_count = self.refresh_count
+            try:
+                flight.token = self._refresh_once(stale_token)
+                TOKEN_REFRESHES.inc('refreshed' if self.refresh_count > refresh_count else 'reused')
+            except Exception as e:
+                flight.error = e
+                TOKEN_REFRESHES.inc('error')
+            finally:
+                TOKEN_REFRESH_LATENCY.observe(time.perf_counter() - started)
+                with self._lock:
+                    self._inflight = None
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.token
+
+    def _refresh_once(self, stale_token):
+        # Another process (or a PHP page) may already have refreshed the file
+        self._load()
+        on_disk = self._config.get('access_token')
+        if stale_token is not None and on_disk and on_disk != stale_token \
+                and not self.needs_refresh():
+            return on_disk
+
+        refresh_token = self._config.get('refresh_token')
+        if not refresh_token:
+            raise TokenRefreshError(f"No refresh_token in {self.config_path}")
+
+        body = urllib.parse.urlencode({
+            'client_id': self.client_id,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token'
+        }).encode()
+        response = self._pool.request('POST', self._token_path, body=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json'
+        })
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        access_token = data.get('access_token') if isinstance(data, dict) else None
+        if not response.ok or not access_token:
+            raise TokenRefreshError(
+                f"Token refresh failed: HTTP {response.status} {response.body[:200]!r}"
+            )
+
+        expires_at = token_expiry(access_token) or (
+            time.time() + data.get('expires_in_millis', DEFAULT_EXPIRES_IN_MILLIS) / 1000.0
+        )
+        config = load_config(self.config_path)
+        config['access_token'] = access_token
+        config['expires_at'] = int(expires_at)
+        if data.get('refresh_token'):
+            config['refresh_token'] = data['refresh_token']
+        save_config(config, self.config_path)
+
+        self._config = config
+        self._expires_at = expires_at
+        self.refresh_count += 1
+        return access_token
+
+    def close(self):
+        self._pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or refresh the stored KingsChat token")
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    parser.add_argument('--refresh', action='store_true', help="force a token refresh")
+    parser.add_argument('--token-url', default=TOKEN_URL)
+    args = parser.parse_args()
+
+    manager = TokenManager(args.config, token_url=args.token_url)
+    if args.refresh:
+        try:
+            manager.refresh()
+            print("✓ Token refreshed")
+        except TokenRefreshError as e:
+            print(f"✗ {e}")
+            return 1
+
+    token = manager.config.get('access_token')
+    expires_at = token_expiry(token) if token else None
+    claims = decode_jwt_claims(token) if token else {}
+    if expires_at is None:
+        print("✗ No decodable access token in config")
+        return 1
+
+    remaining = expires_at - time.time()
+    print(f"Subject: {claims.get('sub', 'Unknown')}")
+    print(f"Expires: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}")
+    if remaining > 0:
+        print(f"✓ Token is valid for {remaining / 60:.1f} minutes")
+    else:
+        print("✗ Token has expired")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
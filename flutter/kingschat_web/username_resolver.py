@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+KingsChat Username Resolver
+Turns thousands of usernames into user ids concurrently.
+
+search_users.php resolves one username per blocking users?username= call
+and then retries lowercase, Capitalised and UPPERCASE spellings one by
+one. Here the whole list is cleaned up first (whitespace, a leading @,
+invalid names) and deduplicated case-insensitively, so each distinct
+user costs one lookup however often it appears. Lookups go through a
+ProfileCache over one pooled client with a bounded number in flight.
+Results stream back as they complete, one per distinct username, so a
+large import can be written out progressively.
+
+429s, 5xx and dropped connections are retried with backoff (honouring
+Retry-After); anything else is reported on the item and the run goes on.
+
+Usage:
+    python username_resolver.py usernames.txt --output resolved.csv
+    python username_resolver.py import.csv --column username --concurrency 32
+"""
+
+import argparse
+import csv
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from kingschat_client import API_BASE_URL, KingsChatAPIError, KingsChatClient
+from profile_cache import ProfileCache
+from rate_limiter import is_congestion
+from token_manager import CONFIG_FILE, TokenManager
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 0.5  # Seconds before the first retry; doubled for each one after
+USERNAME_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+NOT_FOUND = 'not found'
+INVALID = 'invalid username'
+
+
+def normalize_username(raw):
+    """``raw`` with whitespace, stray separators and a leading @ removed; None if not a username"""
+    name = raw.strip().strip(',;').strip().lstrip('@')
+    return name if USERNAME_PATTERN.fullmatch(name) else None
+
+
+def case_variants(name):
+    """The spellings search_users.php also tries, other than lowercase (which the cache uses)"""
+    variants = []
+    for variant in (name, name.lower().capitalize(), name.upper()):
+        if variant != name.lower() and variant not in variants:
+            variants.append(variant)
+    return variants
+
+
+class Resolution:
+    """Outcome for one distinct username and every input spelling of it"""
+
+    __slots__ = ('username', 'inputs', 'user', 'error')
+
+    def __init__(self, username, inputs, user=None, error=None):
+        self.username = username
+        self.inputs = inputs
+        self.user = user
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.user is not None
+
+    @property
+    def user_id(self):
+        return (self.user or {}).get('user_id') or (self.user or {}).get('id')
+
+    def as_dict(self):
+        return {
+            'username': self.username,
+            'inputs': self.inputs,
+            'user_id': self.user_id,
+            'name': (self.user or {}).get('name'),
+            'error': self.error
+        }
+
+
+class UsernameResolver:
+    """Bounded-concurrency username -> user lookups through a ProfileCache"""
+
+    def __init__(self, cache, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES,
+                 try_case_variants=True):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.try_case_variants = try_case_variants
+        self.stats = {'inputs': 0, 'duplicates': 0, 'invalid': 0, 'resolved': 0,
+                      'not_found': 0, 'errors': 0, 'retries': 0}
+        self._lock = threading.Lock()
+
+    def _with_retries(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except KingsChatAPIError as e:
+                if not is_congestion(e.status) or attempt == self.retries:
+                    raise
+                delay = e.retry_after or RETRY_BACKOFF * 2 ** attempt
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                delay = RETRY_BACKOFF * 2 ** attempt
+            with self._lock:
+                self.stats['retries'] += 1
+            time.sleep(delay)
+
+    def lookup(self, name):
+        """The user for ``name``, or None; API errors other than 404 are raised"""
+        user = self._with_retries(self.cache.get, None, name)
+        if user is None and self.try_case_variants:
+            for variant in case_variants(name):
+                user = self._with_retries(self.cache.client.user_by_username, variant)
+                if user is not None:
+                    self.cache.prime(user, username=name)
+                    break
+        return user
+
+    def _resolve_one(self, name, inputs):
+        try:
+            user = self.lookup(name)
+        except KingsChatAPIError as e:
+            return Resolution(name, inputs, error=f"HTTP {e.status}")
+        except Exception as e:
+            return Resolution(name, inputs, error=f"{type(e).__name__}: {e}")
+        return Resolution(name, inputs, user=user, error=None if user is not None else NOT_FOUND)
+
+    def group(self, usernames):
+        """{lowercase name: [input spellings]} in first-seen order, plus invalid inputs"""
+        groups = OrderedDict()
+        invalid = []
+        for raw in usernames:
+            self.stats['inputs'] += 1
+            name = normalize_username(raw)
+            if name is None:
+                invalid.append(raw)
+                continue
+            key = name.lower()
+            if key in groups:
+                self.stats['duplicates'] += 1
+                groups[key].append(raw)
+            else:
+                groups[key] = [raw]
+        return groups, invalid
+
+    def resolve(self, usernames):
+        """Yield a Resolution per distinct username as lookups complete.
+
+        Invalid inputs come first, each as its own Resolution with no lookup.
+        """
+        groups, invalid = self.group(usernames)
+        for raw in invalid:
+            self.stats['invalid'] += 1
+            yield Resolution(raw, [raw], error=INVALID)
+
+        items = iter(groups.items())
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='username-resolver') as executor:
+            running = set()
+            while True:
+                while len(running) < self.concurrency * 2:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    inputs = item[1]
+                    # Keep the first spelling seen; the cache lookup is case-insensitive anyway
+                    running.add(executor.submit(self._resolve_one, normalize_username(inputs[0]),
+                                                inputs))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    resolution = future.result()
+                    if resolution.ok:
+                        self.stats['resolved'] += 1
+                    elif resolution.error == NOT_FOUND:
+                        self.stats['not_found'] += 1
+                    else:
+                        self.stats['errors'] += 1
+                    yield resolution
+
+
+def read_usernames(path, column=None):
+    """Yield usernames from a text file (one per line) or a CSV column ('-' for stdin)"""
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        if column:
+            for row in csv.DictReader(f):
+                yield row.get(column) or ''
+        else:
+            for line in f:
+                if line.strip() and not line.lstrip().startswith('#'):
+                    yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resolve many KingsChat usernames to user ids")
+    parser.add_argument('input', help="text file with one username per line, or a CSV with "
+                                      "--column ('-' for stdin)")
+    parser.add_argument('--column', help="CSV column holding the usernames")
+    parser.add_argument('--output', '-o', help="CSV to write (default: stdout)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES)
+    parser.add_argument('--no-case-variants', action='store_true',
+                        help="only try the lowercase spelling of each name")
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    parser.add_argument('--config', default=CONFIG_FILE, help="path to kc_config.json")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(['username', 'user_id', 'name', 'error', 'inputs'])
+    started = time.perf_counter()
+    with KingsChatClient(base_url=args.base_url, pool_size=args.concurrency,
+                         token_manager=TokenManager(args.config)) as client:
+        cache = ProfileCache(client)
+        resolver = UsernameResolver(cache, args.concurrency, args.retries,
+                                    not args.no_case_variants)
+        try:
+            for resolution in resolver.resolve(read_usernames(args.input, args.column)):
+                row = resolution.as_dict()
+                writer.writerow([row['username'], row['user_id'] or '', row['name'] or '',
+                                 row['error'] or '', len(row['inputs'])])
+        finally:
+            cache.close()
+            if out is not sys.stdout:
+                out.close()
+
+    elapsed = time.perf_counter() - started
+    stats = resolver.stats
+    distinct = stats['inputs'] - stats['duplicates'] - stats['invalid']
+    print(f"{'✓' if not stats['errors'] else '✗'} {stats['inputs']} input(s), {distinct} distinct: "
+          f"{stats['resolved']} resolved, {stats['not_found']} not found, "
+          f"{stats['invalid']} invalid, {stats['errors']} error(s) in {elapsed:.2f}s "
+          f"({distinct / elapsed if elapsed else 0:.1f} names/s)", file=sys.stderr)
+    return 0 if not stats['errors'] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())